@@ -1,17 +1,34 @@
 import argparse
 import sys
 from larvinen import start
+from larvinen.repository import connect, migrate_doses
 
 
 parser = argparse.ArgumentParser(description='Start discord bot Lärvinen')
 parser.add_argument('-d', '--development', default=False, action='store_true',
                     help='Start lärvinen in development mode')
+parser.add_argument('-s', '--storage', default='firestore',
+                    help="Storage to use: 'firestore', 'firestore:buckets', 'sqlite:<path>' or 'memory'")
+parser.add_argument('--migrate-doses', default=None, metavar='TARGET',
+                    help='Copy all doses from the storage to the TARGET storage instead of starting, e.g. firestore:buckets')
+parser.add_argument('--metrics-port', default=None, type=int, metavar='PORT',
+                    help='Serve per command latencies in Prometheus text format at http://127.0.0.1:PORT/metrics')
+parser.add_argument('--read-budget', default=None, type=int, metavar='READS',
+                    help='Log the commands reading more Firestore documents than READS, default 100')
+parser.add_argument('--crawl-stock', default=False, action='store_true',
+                    help='Keep a snapshot of the stock of the standard selection in data/alko.db for the store filter')
 
 args = parser.parse_args()
 
 
 def run_larvinen():
-    start(args.development)
+    if args.migrate_doses != None:
+        copied = migrate_doses(connect(args.storage),
+                               connect(args.migrate_doses))
+        print(f'Copied {copied} doses')
+    else:
+        start(args.development, args.storage,
+              args.metrics_port, args.read_budget, args.crawl_stock)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,22 @@
 import sqlite3
 import os
+import time
+import asyncio
+import threading
+import aiohttp
 import pandas as pd
 import numpy as np
 import requests
 from bs4 import BeautifulSoup
 import json
 import googlemaps
+import functools
+
+from . import storage
+from .metrics import metrics, phase
+from .cache import LRUCache, SingleFlight
+from .sampling import DrinkSampler
+from .stores import StoreIndex, fold
 
 DRINK_QUERY_PARAMS = {'hinta_min': ' hinta > ?', 'hinta_max': ' hinta < ?', 'tyyppi': ' tyyppi like ?',
                       'vol_min': ' alkoholi > ?', 'vol_max': ' alkoholi < ?', 'alatyyppi': ' alatyyppi like ?',
@@ -14,17 +25,44 @@ DRINK_QUERY_PARAMS = {'hinta_min': ' hinta > ?', 'hinta_max': ' hinta < ?', 'tyy
 DB_NAME = 'data/alko.db'
 CATALOGUE_NAME = 'data/alkon-hinnasto-tekstitiedostona.xlsx'
 STORE_JSON_PATH = 'data/stores.json'
+# Products whose stock is checked before giving up on a store filter
+RANDOM_DRINK_MAX_PRODUCTS = 10
+
+# Stock changes slowly, a failed lookup is retried sooner
+STOCK_CACHE_MAX_PRODUCTS = 2000
+STOCK_CACHE_TTL_SECONDS = 30*60
+STOCK_FAILURE_TTL_SECONDS = 60
+STOCK_TIMEOUT_SECONDS = 10
+STOCK_URL = 'https://www.alko.fi/INTERSHOP/web/WFS/Alko-OnlineShop-Site/fi_FI/-/EUR/ViewProduct-Include?SKU='
+# Stock lookups of one recommendation made at once, and how long they may take altogether
+STOCK_PROBE_CONCURRENCY = 4
+STOCK_PROBE_DEADLINE_SECONDS = 8
+# Connections to alko.fi kept open between the lookups
+STOCK_CONNECTIONS = 8
+# The crawled stock snapshot is used for the store filter while its latest crawl is at most this old
+STOCK_SNAPSHOT_MAX_AGE_SECONDS = 2*24*60*60
+
+http_session = None
+
+stock_cache = LRUCache(STOCK_CACHE_MAX_PRODUCTS, STOCK_CACHE_TTL_SECONDS)
+stock_lookups = SingleFlight()
+metrics.register_cache('alko_stock', stock_cache, stock_lookups)
 
 
 class Alko():
     connection = None
+    lock = None
     stores = None
+    store_index = None
+    sampler = None
 
     def __init__(self):
         """Initialize the Alko db connection
         """
 
-        self.connection = sqlite3.connect(DB_NAME)
+        # The connection may be used from the storage threads, one statement at a time
+        self.connection = sqlite3.connect(DB_NAME, check_same_thread=False)
+        self.lock = threading.RLock()
         query = 'SELECT name FROM sqlite_master WHERE type="table" AND name="juomat";'
         cursor = self.connection.cursor()
         cursor.execute(query)
@@ -32,8 +70,17 @@ class Alko():
 
         if row == None and os.path.isfile(CATALOGUE_NAME):
             db_init()
+            row = True
+
+        # The random picks are made from an index of the catalogue, built once
+        self.sampler = DrinkSampler(self.connection) if row != None else None
+
+        if row != None:
+            with self.lock:
+                stock_init(self.connection)
 
         self.stores = json.load(open(STORE_JSON_PATH, 'r'))
+        self.store_index = StoreIndex(self.stores['stores'])
 
     def random_item(self):
         """Get a random item from Alko product catalogue
@@ -42,16 +89,21 @@ class Alko():
             dict: A dictionary describing the random product
         """
 
-        cursor = self.connection.cursor()
         fields = ['numero', 'nimi', 'alkoholi', 'hinta', 'pullokoko']
         str_fields = str(fields)[1:-1].replace("\'", "")
-        cursor.execute(
-            f'SELECT {str_fields} FROM juomat ORDER BY RANDOM() LIMIT 1')
-        row = cursor.fetchone()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                f'SELECT {str_fields} FROM juomat ORDER BY RANDOM() LIMIT 1')
+            row = cursor.fetchone()
         return({fields[i]: row[i] for i in range(len(fields))})
 
-    def random_drink(self, params):
-        """Get a random item from Alko product catalogue
+    async def random_drink(self, params):
+        """Get a random item from Alko product catalogue. With a store filter, the candidates are picked from the
+        products in the store according to the crawled stock snapshot, if it is recent, and the pick is confirmed
+        from alko.fi. Without a recent snapshot, or if none of its candidates is in the store anymore, the stock of
+        several candidates of the whole catalogue is checked at once, and the first one found in the store is
+        returned
 
         Args:
             params (dict): A dictionary containing the query params
@@ -60,64 +112,129 @@ class Alko():
             dict: A dictionary describing the random product
         """
 
-        cursor = self.connection.cursor()
+        if self.sampler == None:
+            return None
+
+        store = None
+        if 'myymälä' in params.keys():
+            # Resolved before any stock is looked up, a name that isn't one store matches nothing
+            store, _ = self.store_index.resolve(params['myymälä'])
+            if store == None:
+                return None
+
+        if store != None and await storage.run(self.snapshot_ready):
+            # The crawled snapshot tells which products are in the store, the live lookup only confirms the pick
+            ids = await storage.run(self.in_stock_ids, store)
+            drink = await self.pick(params, ids, store, 1)
+            if drink != None:
+                return drink
+
+        return await self.pick(params, None, store)
+
+    async def pick(self, params, ids, store, concurrency=STOCK_PROBE_CONCURRENCY):
+        """Picks random products and checks their stock. With a store, the first product found in the store is
+        returned
+
+        Args:
+            params (dict): A dictionary containing the query params
+            ids (np.array): Ids of the products in juomat to pick from, None for all products
+            store (str): The name of the store from the store index, None for any store
+            concurrency (int): Candidates whose stock is checked at once
+                (default STOCK_PROBE_CONCURRENCY)
+
+        Returns:
+            dict: A dictionary describing the random product, None if there is no such product
+        """
+
+        try:
+            candidates = await storage.run(self.candidates, params, ids)
+        except ValueError:
+            # A price or an alcohol limit that isn't a number matches nothing
+            return None
+
+        if len(candidates) == 0:
+            return None
+
+        if store == None:
+            drink = await storage.run(self.drink, candidates[0])
+            with phase('alko'):
+                drink['saatavuus'] = await get_alko_stock(drink['numero'])
+            return drink
+
+        with phase('alko'):
+            return await first_in_stock(candidates, functools.partial(storage.run, self.drink), store, concurrency)
+
+    def candidates(self, params, ids):
+        """Picks random products
+
+        Args:
+            params (dict): A dictionary containing the query params
+            ids (np.array): Ids of the products in juomat to pick from, None for all products
+
+        Raises:
+            ValueError: If a price or an alcohol limit isn't a number
+
+        Returns:
+            list: Ids of at most RANDOM_DRINK_MAX_PRODUCTS products in juomat
+        """
+
+        # Each product is tried at most once. Its row is read only once its stock is checked
+        return [row_id for _, row_id in zip(
+            range(RANDOM_DRINK_MAX_PRODUCTS), self.sampler.sample(params, ids))]
+
+    def snapshot_ready(self):
+        """Checks whether the crawled stock snapshot is recent enough to filter by store
+
+        Returns:
+            bool: True if a product was crawled within STOCK_SNAPSHOT_MAX_AGE_SECONDS
+        """
+
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT MAX(fetched_at) FROM stock_crawl')
+            row = cursor.fetchone()
+
+        return row[0] != None and row[0] > time.time() - STOCK_SNAPSHOT_MAX_AGE_SECONDS
+
+    def in_stock_ids(self, store):
+        """Get the products in stock in a store, according to the crawled snapshot
+
+        Args:
+            store (str): The name of the store from the store index
+
+        Returns:
+            np.array: Ordered ids of the products in juomat
+        """
+
+        # Answered from the store key index of the snapshot and the numero index of the catalogue
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT DISTINCT juomat.id FROM stock JOIN juomat ON juomat.numero = stock.numero '
+                           'WHERE stock.store_key = ? AND stock.qty > 0 ORDER BY juomat.id', (fold(store),))
+            rows = cursor.fetchall()
+
+        return np.array([row[0] for row in rows], dtype=int)
+
+    def drink(self, row_id):
+        """Get a product from Alko product catalogue
+
+        Args:
+            row_id (int): The id of the product in juomat
+
+        Returns:
+            dict: A dictionary describing the product
+        """
+
         fields = ['numero', 'nimi', 'alkoholi',
                   'hinta', 'pullokoko', 'luonnehdinta']
         str_fields = str(fields)[1:-1].replace("\'", "")
-        # {'hinta_min': ' hinta > ?', 'hinta_max': ' hinta < ?', 'tyyppi': ' tyyppi like ?', 'vol_min': ' alkoholi > ?', 'vol_max': ' alkoholi < ?', 'alatyyppi': ' alatyyppi like ?'}
-        params_dict = DRINK_QUERY_PARAMS
-        str_where = 'WHERE valikoima == "vakiovalikoima"'
-        params_list = []
-
-        for param in list(params_dict.keys()):
-            if param in params and param != 'myymälä':
-                if len(str_where) == 0:
-                    str_where = 'WHERE'
-                else:
-                    str_where += ' AND'
-
-                if param == 'tyyppi' or param == 'alatyyppi' or param == 'luonnehdinta':
-                    params_list.append('%'+params[param]+'%')
-                else:
-                    params_list.append(params[param])
-
-                str_where += params_dict[param]
-
-        qry = f'SELECT {str_fields} FROM juomat {str_where} ORDER BY RANDOM() LIMIT 1'
-
-        i = 0
-        max_products = 10
-        while i < max_products:
-            cursor.execute(qry, params_list)
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                f'SELECT {str_fields} FROM juomat WHERE id = ?', (row_id,))
             row = cursor.fetchone()
 
-            if row == None:
-                break
-
-            row = list(row)
-            stores = get_alko_stock(row[0])
-
-            if 'myymälä' in params.keys():
-                if params['myymälä'].lower() in ''.join(self.stores["stores"]).lower():
-                    for store in stores.keys():
-                        if params['myymälä'].lower() in store.lower():
-                            fields.append('saatavuus')
-                            row.append(stores)
-                            i = max_products
-                            break
-                else:
-                    return None
-            else:
-                fields.append('saatavuus')
-                row.append(stores)
-                i = max_products
-
-            i += 1
-
-        if row != None:
-            return {fields[i]: row[i] for i in range(len(fields))}
-        else:
-            return None
+        return {fields[i]: row[i] for i in range(len(fields))}
 
     def product_types(self):
         """Get list of product types
@@ -127,9 +244,10 @@ class Alko():
         """
 
         query = 'SELECT DISTINCT tyyppi FROM juomat;'
-        cursor = self.connection.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+            rows = cursor.fetchall()
 
         return [row[0] for row in rows if row[0] != None]
 
@@ -141,15 +259,55 @@ class Alko():
         """
 
         query = 'SELECT DISTINCT alatyyppi FROM juomat;'
-        cursor = self.connection.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+            rows = cursor.fetchall()
 
         return [row[0] for row in rows if row[0] != None]
 
 
-def get_alko_stock(id):
-    """Get products stock in stores
+async def get_alko_stock(id):
+    """Get products stock in stores. The stock is cached for STOCK_CACHE_TTL_SECONDS, and a failed lookup for
+    STOCK_FAILURE_TTL_SECONDS. Concurrent requests for the same product share one lookup
+
+    Args:
+        id (int): An integer describing the product
+
+    Returns:
+        dictionary: A dictionary representing stores and their stock saldos, empty if the lookup failed
+    """
+
+    stores = stock_cache.get(str(id))
+    if stores == None:
+        stores = await stock_lookups.run(str(id), cache_alko_stock, str(id))
+
+    return stores
+
+
+async def cache_alko_stock(id):
+    """Fetches products stock in stores to the stock cache
+
+    Args:
+        id (str): A string describing the product
+
+    Returns:
+        dictionary: A dictionary representing stores and their stock saldos, empty if the lookup failed
+    """
+
+    try:
+        stores = await fetch_alko_stock(id)
+        stock_cache.set(id, stores)
+    except Exception as ex:
+        print(f'Stock lookup of {id} failed: {ex!r}')
+        stores = {}
+        stock_cache.set(id, stores, STOCK_FAILURE_TTL_SECONDS)
+
+    return stores
+
+
+async def fetch_alko_stock(id):
+    """Get products stock in stores from alko.fi, over the pooled connections of stock_session
 
     Args:
         id (int): An integer describing the product
@@ -158,10 +316,26 @@ def get_alko_stock(id):
         dictionary: A dictionary representing stores and their stock saldos
     """
 
-    url = 'https://www.alko.fi/INTERSHOP/web/WFS/Alko-OnlineShop-Site/fi_FI/-/EUR/ViewProduct-Include?SKU='
+    async with stock_session().get(STOCK_URL+str(id)) as page:
+        page.raise_for_status()
+        content = await page.read()
 
-    page = requests.get(url+str(id))
-    soup = BeautifulSoup(page.content, 'html.parser')
+    # Parsing the page takes a while, so it is done off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parse_alko_stock, content)
+
+
+def parse_alko_stock(content):
+    """Parses products stock in stores from a stock page
+
+    Args:
+        content (bytes): The stock page
+
+    Returns:
+        dictionary: A dictionary representing stores and their stock saldos
+    """
+
+    soup = BeautifulSoup(content, 'html.parser')
 
     list_of_stores = soup.text.split('Määrä')[1].replace(
         '\n\n\n\n', '\n').strip().split('\n')
@@ -171,6 +345,74 @@ def get_alko_stock(id):
     return stores
 
 
+def stock_session():
+    """Gets the HTTP session of the stock lookups. The session keeps up to STOCK_CONNECTIONS connections to
+    alko.fi alive, and is created on the first lookup, as it belongs to the running event loop
+
+    Returns:
+        aiohttp.ClientSession: The session
+    """
+
+    global http_session
+
+    if http_session == None or http_session.closed:
+        http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=STOCK_CONNECTIONS),
+                                             timeout=aiohttp.ClientTimeout(total=STOCK_TIMEOUT_SECONDS))
+
+    return http_session
+
+
+async def close_stock_session():
+    """Closes the HTTP session of the stock lookups
+    """
+
+    if http_session != None:
+        await http_session.close()
+
+
+async def first_in_stock(candidates, drink, store, concurrency=STOCK_PROBE_CONCURRENCY):
+    """Checks the stock of the candidates, a few at a time, until one is found in the store or
+    STOCK_PROBE_DEADLINE_SECONDS have passed. A candidate is looked up only when its stock is checked, so the
+    candidates left unchecked cost nothing
+
+    Args:
+        candidates (list): Ids of the products in juomat
+        drink (coroutine function): A function getting the dictionary describing a product by its id
+        store (str): The name of the store from the store index
+        concurrency (int): Candidates checked at once
+            (default STOCK_PROBE_CONCURRENCY)
+
+    Returns:
+        dict: The first product found in the store, having its stock, None if there is no such product
+    """
+
+    slots = asyncio.Semaphore(concurrency)
+    key = fold(store)
+
+    async def probe(row_id):
+        async with slots:
+            product = await drink(row_id)
+            return product, await get_alko_stock(product['numero'])
+
+    probes = [asyncio.ensure_future(probe(row_id)) for row_id in candidates]
+
+    try:
+        for next_probe in asyncio.as_completed(probes, timeout=STOCK_PROBE_DEADLINE_SECONDS):
+            product, stores = await next_probe
+
+            if any([fold(name) == key for name in stores.keys()]):
+                product['saatavuus'] = stores
+                return product
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        # The lookups themselves are shared, so they finish to the cache in the background
+        for pending in probes:
+            pending.cancel()
+
+    return None
+
+
 def distance_to_alko(origin, destination, mode='driving'):
     """Get distance to specified alko
 
@@ -183,7 +425,9 @@ def distance_to_alko(origin, destination, mode='driving'):
     """
 
     gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_KEY'))
-    distance_matrix = gmaps.distance_matrix(origin, destination, mode=mode)
+    with phase('alko'):
+        distance_matrix = gmaps.distance_matrix(
+            origin, destination, mode=mode)
 
     if distance_matrix['rows'][0]['elements'][0]['status'] == 'OK':
         if int(distance_matrix['rows'][0]['elements'][0]['duration']['value']/60) > 60:
@@ -270,6 +514,36 @@ def db_init():
     data.to_sql('juomat', con=conn, if_exists='append', index=False)
 
 
+def stock_init(connection):
+    """Creates the tables of the crawled stock snapshot, if they don't exist
+
+    Args:
+        connection (sqlite3.Connection): Connection to the Alko database
+    """
+
+    c = connection.cursor()
+    # The stock of each product in each store as of fetched_at, store_key being the folded name of the store
+    c.execute("""CREATE TABLE IF NOT EXISTS stock (
+                                    numero text,
+                                    store text,
+                                    store_key text,
+                                    qty integer,
+                                    fetched_at real,
+                                    PRIMARY KEY (numero, store)
+                                );""")
+    # When each product was last crawled, and the validators of its page for conditional requests
+    c.execute("""CREATE TABLE IF NOT EXISTS stock_crawl (
+                                    numero text PRIMARY KEY,
+                                    fetched_at real,
+                                    etag text,
+                                    last_modified text
+                                );""")
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS stock_store_key ON stock (store_key, qty)')
+    c.execute('CREATE INDEX IF NOT EXISTS juomat_numero ON juomat (numero)')
+    connection.commit()
+
+
 def load_list_of_alkos():
     """Loads a list of alkos to a json file
     """
@@ -0,0 +1,287 @@
+import numpy as np
+
+FIRST_DOSE_DRINKING_TIME_MINUTES = 20
+
+# Rule of thumb for alcohol elimination without other information, 0.1 g/h/kg
+ELIMINATION_RATE = 0.1
+# Grams of pure alcohol in one centiliter
+ALCOHOL_DENSITY = 7.9
+
+
+def dose_grams(t_doses, pure_alcohol, mass):
+    """Computes body alcohol content in grams at every dose
+
+    The content follows g[i] = max(g[i-1] - elimination[i], 0) + dose[i], which is a
+    running sum clamped at zero. It is solved in closed form with a cumulative sum and
+    its running minimum instead of stepping through the doses one by one.
+
+    Args:
+        t_doses (np.array): Sorted unix timestamps of the doses
+        pure_alcohol (np.array): Pure alcohol of the doses in centiliters
+        mass (float): Mass of the user in kilograms
+
+    Returns:
+        np.array: Body alcohol content in grams right after each dose
+        np.array: Body alcohol content in grams right before each dose. Values below zero
+            tell how much more alcohol could have been eliminated before the dose
+
+    """
+
+    t_doses = np.asarray(t_doses, dtype=np.int64)
+    grams = np.asarray(pure_alcohol, dtype=float)*ALCOHOL_DENSITY
+
+    eliminated = np.zeros(len(t_doses), dtype=float)
+    eliminated[1:] = ELIMINATION_RATE*mass * \
+        np.maximum(np.diff(t_doses), 1)/60/60
+
+    steps = np.zeros(len(t_doses), dtype=float)
+    steps[1:] = grams[:-1] - eliminated[1:]
+    cumulative = np.cumsum(steps)
+
+    # Content before dose i is the cumulative sum minus its lowest value before i
+    lowest = np.minimum.accumulate(cumulative)
+    before = np.zeros(len(t_doses), dtype=float)
+    before[1:] = cumulative[1:] - lowest[:-1]
+
+    after = np.maximum(np.maximum(before, 0.0) + grams, 0.0)
+
+    return after, before
+
+
+def breakpoints(t_doses, pure_alcohol, mass):
+    """Computes the vertices of the piecewise linear body alcohol content curve
+
+    Besides the doses themselves, the curve has a vertex at zero whenever the alcohol
+    has been eliminated completely, and another one when the absorption of the next
+    dose starts.
+
+    Args:
+        t_doses (np.array): Sorted unix timestamps of the doses
+        pure_alcohol (np.array): Pure alcohol of the doses in centiliters
+        mass (float): Mass of the user in kilograms
+
+    Returns:
+        np.array: Timestamps of the vertices
+        np.array: Body alcohol content in grams at the vertices
+
+    """
+
+    t_doses = np.asarray(t_doses, dtype=np.int64)
+    num_doses = len(t_doses)
+    after, before = dose_grams(t_doses, pure_alcohol, mass)
+
+    absorption_time = np.full(
+        num_doses, FIRST_DOSE_DRINKING_TIME_MINUTES*60, dtype=np.int64)
+    absorption_time[1:] = np.minimum(absorption_time[1:], np.diff(t_doses))
+
+    t_absorption = t_doses - absorption_time
+    t_sober = np.trunc(t_doses + before/ELIMINATION_RATE /
+                       mass*60*60).astype(np.int64)
+
+    sober = before <= 0
+    absorption_first = t_absorption < t_sober
+    indices = np.arange(num_doses)
+
+    t_first = np.where(absorption_first, t_absorption, t_sober)
+    t_second = np.where(absorption_first, t_sober, t_absorption)
+    has_second = np.where(absorption_first, indices != 0,
+                          indices < num_doses-1)
+
+    # Every dose has up to two zeros preceding it, flattened row by row
+    t_points = np.stack([t_first, t_second, t_doses], axis=1)
+    g_points = np.stack([np.zeros(num_doses), np.zeros(num_doses), after], axis=1)
+    mask = np.stack([sober, sober & has_second,
+                    np.ones(num_doses, dtype=bool)], axis=1)
+
+    return t_points[mask], g_points[mask]
+
+
+def pad_start(t_points, g_points, t_start):
+    """Adds a zero vertex before the curve if it starts after t_start
+
+    Args:
+        t_points (np.array): Timestamps of the vertices
+        g_points (np.array): Body alcohol content in grams at the vertices
+        t_start (float): The first timestamp the curve should cover
+
+    Returns:
+        np.array: Timestamps of the vertices
+        np.array: Body alcohol content in grams at the vertices
+
+    """
+
+    if t_start < t_points[0]:
+        t_points = np.concatenate(([t_start-1], t_points))
+        g_points = np.concatenate(([0.0], g_points))
+
+    return t_points, g_points
+
+
+def interpolate(t_points, g_points, t_interp):
+    """Evaluates the body alcohol content curve at t_interp timestamps
+
+    Args:
+        t_points (np.array): Timestamps of the vertices
+        g_points (np.array): Body alcohol content in grams at the vertices
+        t_interp (np.array): Timestamps to evaluate the curve at
+
+    Returns:
+        np.array: Body alcohol content in grams at t_interp timestamps
+
+    """
+
+    order = np.argsort(t_points, kind='stable')
+
+    return np.interp(t_interp, np.asarray(t_points, dtype=float)[order],
+                     np.asarray(g_points, dtype=float)[order])
+
+
+def window(t_points, values, t_low, t_high):
+    """Cuts a piecewise linear curve to the vertices between t_low and t_high, plus the interpolated
+    end points. The curve is linear between its vertices, so the cut curve is exact
+
+    Args:
+        t_points (np.array): Ordered timestamps of the vertices
+        values (np.array): Values at the vertices
+        t_low (float): The first timestamp to keep
+        t_high (float): The last timestamp to keep
+
+    Returns:
+        np.array: Timestamps of the vertices, starting at t_low and ending at t_high
+        np.array: Values at the vertices
+
+    """
+
+    inside = (t_points > t_low) & (t_points < t_high)
+    t_ends = np.array([t_low, t_high], dtype=float)
+    ends = interpolate(t_points, values, t_ends)
+
+    return np.concatenate(([t_low], t_points[inside], [t_high])), np.concatenate(([ends[0]], values[inside], [ends[1]]))
+
+
+def time_over(t_points, values, threshold):
+    """Computes how long a piecewise linear curve stays above a threshold
+
+    Args:
+        t_points (np.array): Ordered timestamps of the vertices
+        values (np.array): Values at the vertices
+        threshold (float): The threshold
+
+    Returns:
+        float: Time in seconds the curve is above the threshold
+
+    """
+
+    dt = np.diff(np.asarray(t_points, dtype=float))
+    v_start = np.asarray(values, dtype=float)[:-1]
+    v_end = np.asarray(values, dtype=float)[1:]
+
+    # A segment crossing the threshold is above it for the share of its rise above the threshold
+    rise = np.abs(v_end - v_start)
+    above = np.maximum(np.maximum(v_start, v_end) - threshold, 0.0)
+    share = np.divide(above, rise, out=np.zeros_like(rise), where=rise > 0)
+    share = np.where((v_start >= threshold) & (v_end >= threshold), 1.0, np.minimum(share, 1.0))
+
+    return float(np.sum(dt*share))
+
+
+def _legacy_per_mille_values(t_doses, pure_alcohol, mass, t_interp):
+    """The former per dose loop of User.get_alcohol_grams and User.per_mille_values,
+    kept as a reference for the benchmark
+    """
+
+    from scipy import interpolate as sp_interpolate
+
+    t_doses = [int(t) for t in t_doses]
+    g_alcohol = 0.0
+    values = np.zeros(len(t_doses), dtype=float)
+    zeros_to_insert = []
+
+    for i in range(len(t_doses)):
+        if i == 0:
+            absorption_time = FIRST_DOSE_DRINKING_TIME_MINUTES*60
+        else:
+            absorption_time = min(
+                FIRST_DOSE_DRINKING_TIME_MINUTES*60, t_doses[i]-t_doses[i-1])
+
+            g_alcohol -= 0.1*mass*(max(t_doses[i]-t_doses[i-1], 1))/60/60
+
+        if g_alcohol <= 0:
+            if int(t_doses[i]-absorption_time) < int(t_doses[i] + g_alcohol/0.1/mass*60*60):
+                zeros_to_insert.append([i, int(t_doses[i]-absorption_time)])
+                if i != 0:
+                    zeros_to_insert.append(
+                        [i, int(t_doses[i] + g_alcohol/0.1/mass*60*60)])
+            else:
+                zeros_to_insert.append(
+                    [i, int(t_doses[i] + g_alcohol/0.1/mass*60*60)])
+
+                if i < (len(t_doses)-1):
+                    zeros_to_insert.append(
+                        [i, int(t_doses[i]-absorption_time)])
+
+            g_alcohol = 0.0
+
+        g_alcohol += pure_alcohol[i]*7.9
+        g_alcohol = max(g_alcohol, 0.0)
+        values[i] = g_alcohol
+
+    for i in range(len(zeros_to_insert)):
+        t_doses.insert(zeros_to_insert[i][0]+i, zeros_to_insert[i][1])
+        values = np.insert(values, zeros_to_insert[i][0]+i, 0.0)
+
+    if t_interp[0] < t_doses[0]:
+        t_doses.insert(0, t_interp[0]-1)
+        values = np.insert(values, 0, 0.0)
+
+    f = sp_interpolate.interp1d(t_doses, values, kind='linear')
+    return f(t_interp)
+
+
+def benchmark(dose_counts=(10, 100, 500, 2000), repeats=5, seed=0):
+    """Compares the vectorized engine to the former per dose loop
+
+    Args:
+        dose_counts (tuple): Numbers of doses to benchmark with
+        repeats (int): How many times each case is timed, the best time is reported
+        seed (int): Seed for generating the random doses
+
+    """
+
+    import timeit
+
+    rng = np.random.default_rng(seed)
+    mass = 80
+
+    print(f'{"doses":>8}{"loop [ms]":>14}{"vectorized [ms]":>18}{"speedup":>10}{"max diff":>12}')
+    for num_doses in dose_counts:
+        t_end = 1600000000
+        t_doses = np.sort(rng.integers(
+            t_end - 120*60*60, t_end, num_doses))
+        t_doses = np.unique(t_doses)
+        t_doses = np.append(t_doses, t_end)
+        pure_alcohol = rng.uniform(1.0, 3.0, len(t_doses))
+        pure_alcohol[-1] = 0.0
+        t_interp = np.arange(-24*60, 1)*60.0 + t_end
+
+        # The engine is timed the way User.get_alcohol_grams and the plots use it
+        def vectorized():
+            t_points, g_points = pad_start(
+                *breakpoints(t_doses, pure_alcohol, mass), t_interp[0])
+            return interpolate(t_points, g_points, t_interp)
+
+        legacy = _legacy_per_mille_values(
+            t_doses, pure_alcohol, mass, t_interp)
+        values = vectorized()
+
+        t_legacy = min(timeit.repeat(lambda: _legacy_per_mille_values(
+            t_doses, pure_alcohol, mass, t_interp), number=1, repeat=repeats))
+        t_vectorized = min(timeit.repeat(
+            vectorized, number=1, repeat=repeats))
+
+        print(f'{len(t_doses):>8}{t_legacy*1000:>14.3f}{t_vectorized*1000:>18.3f}'
+              + f'{t_legacy/t_vectorized:>10.1f}{np.max(np.abs(legacy-values)):>12.2e}')
+
+
+if __name__ == "__main__":
+    benchmark()
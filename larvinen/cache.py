@@ -0,0 +1,235 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    """A bounded least recently used cache whose entries expire after ttl_seconds. The cache may be
+    shared between threads"""
+
+    def __init__(self, max_size, ttl_seconds=None):
+        """Initialize cache
+
+        Args:
+            max_size (int): Maximum number of entries, the least recently used entry is evicted first
+            ttl_seconds (float): Time in seconds after which a set entry expires
+                (default None, entries never expire)
+        """
+
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None, valid=None):
+        """Gets a value from cache and counts a hit or a miss
+
+        Args:
+            key (hashable): The key of the value
+            default (object): Value returned on a miss
+                (default None)
+            valid (function): A function that takes the cached value and returns False when the
+                value can't answer the current request. Such a lookup counts as a miss but keeps the entry
+                (default None)
+
+        Returns:
+            object: The cached value or default
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry != None and entry[0] != None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+
+            if entry == None or (valid != None and not valid(entry[1])):
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """Gets a value from cache without counting a hit or a miss or refreshing its recency
+
+        Args:
+            key (hashable): The key of the value
+            default (object): Value returned if the key is not cached
+                (default None)
+
+        Returns:
+            object: The cached value or default
+        """
+
+        with self.lock:
+            if key in self:
+                return self.entries[key][1]
+
+            return default
+
+    def set(self, key, value, ttl_seconds=None):
+        """Sets a value to cache and restarts its time to live
+
+        Args:
+            key (hashable): The key of the value
+            value (object): The value to be cached
+            ttl_seconds (float): Time in seconds after which this entry expires
+                (default None, the ttl_seconds of the cache)
+        """
+
+        ttl_seconds = self.ttl_seconds if ttl_seconds == None else ttl_seconds
+        expires = time.monotonic() + ttl_seconds if ttl_seconds != None else None
+
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Removes a value from cache
+
+        Args:
+            key (hashable): The key of the value
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes all values from cache
+        """
+
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Gets the cache statistics
+
+        Returns:
+            dict: A dictionary having the number of hits, misses and entries
+        """
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry != None and (entry[0] == None or entry[0] >= time.monotonic())
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Versions():
+    """Sequence numbers of the latest changes of keys, used to tell whether a result computed from the keys
+    is still up to date. The numbers may be shared between threads"""
+
+    def __init__(self):
+        """Initialize versions
+        """
+
+        self.latest = 0
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def bump(self, *keys):
+        """Marks keys changed
+
+        Args:
+            *keys (hashable): The changed keys
+        """
+
+        with self.lock:
+            self.latest += 1
+            for key in keys:
+                self.versions[key] = self.latest
+
+    def current(self):
+        """Gets the sequence number of the latest change. Read it before computing a result
+
+        Returns:
+            int: The sequence number
+        """
+
+        return self.latest
+
+    def changed_since(self, keys, version):
+        """Checks whether any of keys has changed after a sequence number
+
+        Args:
+            keys (list): The keys a result was computed from
+            version (int): The sequence number read before computing the result
+
+        Returns:
+            bool: True if the result may be out of date
+        """
+
+        with self.lock:
+            return any(self.versions.get(key, 0) > version for key in keys)
+
+    def if_unchanged(self, keys, version, func, *args, **kwargs):
+        """Calls func unless any of keys has changed after a sequence number. No key is marked changed while
+        func runs, so a result stored by func can't miss a change made meanwhile
+
+        Args:
+            keys (list): The keys the result was computed from
+            version (int): The sequence number read before computing the result
+            func (function): The function to call, e.g. storing the result
+            *args: Positional arguments of the function
+            **kwargs: Keyword arguments of the function
+
+        Returns:
+            bool: True if func was called
+        """
+
+        with self.lock:
+            if any(self.versions.get(key, 0) > version for key in keys):
+                return False
+
+            func(*args, **kwargs)
+            return True
+
+
+class SingleFlight():
+    """Shares one call between the coroutines asking for the same key at the same time. The first coroutine starts
+    the call as a task and the others await the same task"""
+
+    def __init__(self):
+        """Initialize single flight
+        """
+
+        self.calls = {}
+        self.shared = 0
+
+    async def run(self, key, func, *args, **kwargs):
+        """Calls func, unless a call for key is already in flight, in which case waits for that call
+
+        Args:
+            key (hashable): The key of the call
+            func (coroutine function): The function to call
+            *args: Positional arguments of the function
+            **kwargs: Keyword arguments of the function
+
+        Returns:
+            object: The return value of the function
+        """
+
+        call = self.calls.get(key)
+
+        if call == None:
+            call = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = call
+            call.add_done_callback(lambda done: self.calls.pop(
+                key) if self.calls.get(key) is done else None)
+        else:
+            self.shared += 1
+
+        # A caller giving up doesn't cancel the call the others are waiting for
+        return await asyncio.shield(call)
@@ -0,0 +1,191 @@
+from . import metrics
+from . import tracing
+from .util import parse_command, parse_params
+
+# The arguments a command can declare, besides the message that is always passed first
+COMMAND_ARGS = ('user', 'params', 'capital_params')
+
+
+class Command():
+    """A command the bot answers to, and the arguments its handler takes"""
+
+    def __init__(self, name, handler, args=()):
+        """Initialize command
+
+        Args:
+            name (str): The name of the command in the metrics
+            handler (coroutine function): The function handling the command, called with the message and the
+                declared arguments
+            args (tuple): Names of the arguments from COMMAND_ARGS, in the order the handler takes them
+        """
+
+        for arg in args:
+            if arg not in COMMAND_ARGS:
+                raise ValueError(f'Unknown command argument {arg}')
+
+        self.name = name
+        self.handler = handler
+        self.args = tuple(args)
+
+
+class CommandRouter():
+    """Routes messages to commands by their first word. The message is parsed once, and the user is only read for
+    commands that declare it. Words that aren't commands can be handed to a fallback, e.g. the drinks"""
+
+    def __init__(self):
+        """Initialize router
+        """
+
+        self.commands = {}
+        self.fallback = None
+        self.fallback_match = None
+
+    def command(self, name, *args):
+        """Registers the decorated function as the handler of a command
+
+        Args:
+            name (str): The first word of the command, starting with %
+            args (str): The arguments the handler takes after the message, see COMMAND_ARGS
+
+        Returns:
+            function: A decorator returning the function unchanged
+        """
+
+        def register(handler):
+            if name in self.commands:
+                raise ValueError(f'Command {name} is already registered')
+
+            self.commands[name] = Command(name, handler, args)
+            return handler
+
+        return register
+
+    def default(self, name, match, *args):
+        """Registers the decorated function as the handler of the first words that aren't commands
+
+        Args:
+            name (str): The name of the fallback in the metrics
+            match (function): A function telling from the lower cased first word whether the fallback handles it
+            args (str): The arguments the handler takes after the message, see COMMAND_ARGS
+
+        Returns:
+            function: A decorator returning the function unchanged
+        """
+
+        def register(handler):
+            self.fallback = Command(name, handler, args)
+            self.fallback_match = match
+            return handler
+
+        return register
+
+    def resolve(self, content):
+        """Finds the command of a message
+
+        Args:
+            content (str): The content of the message
+
+        Returns:
+            Command: The command to run, None if the message isn't a command
+            list: A list of lower cased params
+            list: A list of non lower cased params
+        """
+
+        params, capital_params = parse_command(content)
+
+        command = self.commands.get(params[0])
+        if command == None and self.fallback != None and self.fallback_match(params[0]):
+            command = self.fallback
+
+        return command, params, capital_params
+
+    async def dispatch(self, message, content, get_user):
+        """Runs the command of a message, timing it into the metrics and tracing its database operations
+
+        Args:
+            message (discord.message): The message that triggered the event
+            content (str): The content of the message as written
+            get_user (coroutine function): A function returning the user who sent the message
+
+        Returns:
+            bool: True if the message was a command
+        """
+
+        command, params, capital_params = self.resolve(content)
+        if command == None:
+            return False
+
+        with metrics.command(command.name), tracing.trace(command.name):
+            values = {'params': params, 'capital_params': capital_params}
+            if 'user' in command.args:
+                values['user'] = await get_user()
+
+            await command.handler(message, *[values[arg] for arg in command.args])
+
+        return True
+
+
+def _legacy_route(msg, commands, drinks):
+    """The former if-elif chain, used as the reference in the benchmark
+
+    Args:
+        msg (str): The content of the message
+        commands (list): Command names in the order the chain tested them
+        drinks (dict): The drinks, keyed by their names
+
+    Returns:
+        str: The name of the command, None if the message isn't one
+    """
+
+    parse_params(msg)
+    msg = msg.lower()
+    params = parse_params(msg)
+
+    for name in commands:
+        if msg.startswith(name):
+            return name
+
+    if drinks.get(params[0]) != None:
+        return params[0]
+
+    return None
+
+
+def benchmark(number=100000, repeats=5):
+    """Compares routing a message by its first word to the former if-elif chain
+
+    Args:
+        number (int): How many messages are routed in each timing
+        repeats (int): How many times each case is timed, the best time is reported
+
+    """
+
+    import timeit
+
+    names = ['%alkoholin_vaikutukset', '%help', '%tuotetyypit', '%alatyypit', '%menu', '%tiedot', '%kuvaaja',
+             '%humala', '%suosittele', '%alkoon', '%peruuta', '%annokset', '%highscore']
+    drinks = {'%olut': {}, '%aolut': {}, '%viini': {}, '%viina': {}, '%siideri': {}}
+
+    router = CommandRouter()
+    for name in names:
+        router.command(name, 'params')(None)
+    router.default('drink', lambda name: drinks.get(name) != None, 'params')(None)
+
+    messages = {'first command': '%alkoholin_vaikutukset',
+                'last command': '%highscore',
+                'command with params': '%kuvaaja 48 [Matti,Teppo] 2021-03-30T12:00',
+                'drink': '%olut 50 5.2',
+                'not a command': '%Hei kaikki'}
+
+    print(f'{"message":>22}{"chain [us]":>14}{"router [us]":>14}{"speedup":>10}')
+    for label, msg in messages.items():
+        t_chain = min(timeit.repeat(lambda: _legacy_route(
+            msg, names, drinks), number=number, repeat=repeats))
+        t_router = min(timeit.repeat(
+            lambda: router.resolve(msg), number=number, repeat=repeats))
+
+        print(f'{label:>22}{t_chain/number*1e6:>14.3f}{t_router/number*1e6:>14.3f}{t_chain/t_router:>10.1f}')
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,234 @@
+import re
+import time
+import sqlite3
+import asyncio
+import threading
+import aiohttp
+from collections import Counter
+
+from . import storage
+from .metrics import metrics
+from .stores import fold
+from .alko import DB_NAME, STOCK_URL, STOCK_TIMEOUT_SECONDS, parse_alko_stock, stock_init
+
+# Stock pages fetched at once, and the time between starting two fetches, to go easy on alko.fi
+STOCK_CRAWL_CONCURRENCY = 2
+STOCK_CRAWL_INTERVAL_SECONDS = 0.5
+# A product is crawled again when its stock is older than this
+STOCK_CRAWL_MAX_AGE_SECONDS = 24*60*60
+# Time between checking for products to crawl
+STOCK_CRAWL_PAUSE_SECONDS = 10*60
+
+
+class StockCrawler():
+    """Refreshes the stock of the standard selection to the stock snapshot in the Alko database. The products
+    whose stock is the oldest are crawled first, and each product is saved as soon as it is fetched, so a
+    stopped crawl continues where it was left. Pages that haven't changed since the last crawl are not
+    downloaded again"""
+
+    def __init__(self, db_name=DB_NAME, url=STOCK_URL, concurrency=STOCK_CRAWL_CONCURRENCY,
+                 interval=STOCK_CRAWL_INTERVAL_SECONDS, max_age=STOCK_CRAWL_MAX_AGE_SECONDS):
+        """Initialize crawler
+
+        Args:
+            db_name (str): Path of the Alko database having the juomat table
+                (default DB_NAME)
+            url (str): The stock page, completed with the product number
+                (default STOCK_URL, a local server can be given for testing)
+            concurrency (int): Stock pages fetched at once
+                (default STOCK_CRAWL_CONCURRENCY)
+            interval (float): Seconds between starting two fetches
+                (default STOCK_CRAWL_INTERVAL_SECONDS)
+            max_age (float): Seconds after which the stock of a product is crawled again
+                (default STOCK_CRAWL_MAX_AGE_SECONDS)
+        """
+
+        # The connection is used from the storage threads, one transaction at a time
+        self.connection = sqlite3.connect(db_name, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        # The bot keeps reading the snapshot while it is written
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        stock_init(self.connection)
+
+        self.url = url
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_age = max_age
+        self.next_start = 0.0
+        self.turn = None
+        self.results = Counter()
+        self.lock = threading.Lock()
+
+        metrics.register(self.collect)
+
+    def stale_products(self):
+        """Get the products of the standard selection whose stock is missing or older than max_age
+
+        Returns:
+            list: A list of (numero, etag, last modified) tuples, the oldest first
+        """
+
+        with self.db_lock:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT juomat.numero, stock_crawl.etag, stock_crawl.last_modified FROM juomat '
+                           'LEFT JOIN stock_crawl ON stock_crawl.numero = juomat.numero '
+                           'WHERE juomat.valikoima == "vakiovalikoima" AND (stock_crawl.fetched_at IS NULL OR stock_crawl.fetched_at < ?) '
+                           'ORDER BY stock_crawl.fetched_at', (time.time() - self.max_age,))
+
+            return cursor.fetchall()
+
+    async def crawl(self):
+        """Crawls the stale products once
+
+        Returns:
+            Counter: The number of products 'fetched', 'unchanged' and 'failed'
+        """
+
+        products = iter(await storage.run(self.stale_products))
+        results = Counter()
+        self.turn = asyncio.Lock()
+
+        async def worker(session):
+            # The workers share the iterator, so each product is crawled by one of them
+            for numero, etag, last_modified in products:
+                result = await self.refresh(session, numero, etag, last_modified)
+                results[result] += 1
+
+                with self.lock:
+                    self.results[result] += 1
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=STOCK_TIMEOUT_SECONDS)) as session:
+            await asyncio.gather(*[worker(session) for _ in range(self.concurrency)])
+
+        return results
+
+    async def run(self):
+        """Crawls the stale products every STOCK_CRAWL_PAUSE_SECONDS until cancelled
+        """
+
+        while True:
+            try:
+                results = await self.crawl()
+                if sum(results.values()) > 0:
+                    print(f'Stock crawl: {dict(results)}')
+            except Exception as ex:
+                print(f'Stock crawl failed: {ex!r}')
+
+            await asyncio.sleep(STOCK_CRAWL_PAUSE_SECONDS)
+
+    async def wait_turn(self):
+        """Waits until interval has passed since starting the previous fetch
+        """
+
+        async with self.turn:
+            delay = self.next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.next_start = time.monotonic() + self.interval
+
+    async def refresh(self, session, numero, etag, last_modified):
+        """Fetches the stock of a product to the snapshot, unless its page hasn't changed
+
+        Args:
+            session (aiohttp.ClientSession): The session to fetch with
+            numero (str): The product number
+            etag (str): The ETag of the page at the last crawl, None if unknown
+            last_modified (str): The Last-Modified of the page at the last crawl, None if unknown
+
+        Returns:
+            str: 'fetched', 'unchanged' or 'failed'
+        """
+
+        headers = {}
+        if etag != None:
+            headers['If-None-Match'] = etag
+        if last_modified != None:
+            headers['If-Modified-Since'] = last_modified
+
+        await self.wait_turn()
+
+        try:
+            async with session.get(self.url+str(numero), headers=headers) as page:
+                if page.status == 304:
+                    await storage.run(self.save, numero, None, etag, last_modified)
+                    return 'unchanged'
+
+                page.raise_for_status()
+                content = await page.read()
+                etag = page.headers.get('ETag')
+                last_modified = page.headers.get('Last-Modified')
+
+            loop = asyncio.get_running_loop()
+            stores = await loop.run_in_executor(None, parse_alko_stock, content)
+        except Exception as ex:
+            # Left stale, so it is crawled again first
+            print(f'Stock crawl of {numero} failed: {ex!r}')
+            return 'failed'
+
+        await storage.run(self.save, numero, stores, etag, last_modified)
+        return 'fetched'
+
+    def save(self, numero, stores, etag, last_modified):
+        """Saves the stock of a product to the snapshot
+
+        Args:
+            numero (str): The product number
+            stores (dict): A dictionary of stores and their stock saldos, None if the stock hasn't changed
+            etag (str): The ETag of the page
+            last_modified (str): The Last-Modified of the page
+        """
+
+        fetched_at = time.time()
+
+        with self.db_lock, self.connection:
+            if stores == None:
+                self.connection.execute(
+                    'UPDATE stock SET fetched_at = ? WHERE numero = ?', (fetched_at, numero))
+            else:
+                self.connection.execute(
+                    'DELETE FROM stock WHERE numero = ?', (numero,))
+                self.connection.executemany('INSERT INTO stock (numero, store, store_key, qty, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                                            [(numero, store, fold(store), qty, fetched_at) for store, qty in parse_quantities(stores).items()])
+
+            self.connection.execute('INSERT OR REPLACE INTO stock_crawl VALUES (?, ?, ?, ?)',
+                                    (numero, fetched_at, etag, last_modified))
+
+    def collect(self):
+        """Renders the crawled products
+
+        Returns:
+            list: A list of lines in Prometheus text format
+        """
+
+        lines = ['# HELP larvinen_stock_crawl_products_total Products crawled to the stock snapshot, by result',
+                 '# TYPE larvinen_stock_crawl_products_total counter']
+
+        with self.lock:
+            lines += [f'larvinen_stock_crawl_products_total{{result="{result}"}} {count}'
+                      for result, count in sorted(self.results.items())]
+
+        return lines
+
+
+def parse_quantities(stores):
+    """Converts the stock saldos of a stock page to numbers
+
+    Args:
+        stores (dict): A dictionary of stores and their stock saldos as text
+
+    Returns:
+        dict: A dictionary of stores and their stock saldos, leaving out the saldos without a number
+    """
+
+    quantities = {}
+    for store, qty in stores.items():
+        digits = re.sub(r'\D', '', str(qty))
+        if digits != '':
+            quantities[store] = int(digits)
+
+    return quantities
+
+
+if __name__ == "__main__":
+    print(asyncio.run(StockCrawler().crawl()))
@@ -0,0 +1,93 @@
+import threading
+
+
+class DrinkRegistry():
+    """The basic drinks kept in process, so that looking up a drink or listing the menu doesn't read the database.
+    The registry is loaded once and kept up to date by the database's change notifications, when it has them, and by
+    the drinks the bot itself saves"""
+
+    def __init__(self):
+        """Initialize registry
+        """
+
+        self.drinks = None
+        self.menu = ''
+        self.watch = None
+        self.lock = threading.Lock()
+
+    def load(self, db):
+        """Reads all basic drinks from the database and starts following their changes
+
+        Args:
+            db (Repository): The database client
+        """
+
+        self.replace(db.get_basic_drinks())
+
+        if self.watch == None:
+            self.watch = db.watch_basic_drinks(self.replace)
+
+    def replace(self, drinks):
+        """Replaces all drinks and renders the menu
+
+        Args:
+            drinks (dict): A dictionary of the drinks keyed by their names
+        """
+
+        drinks = dict(sorted(drinks.items()))
+        menu = ''.join([f'{name}\t\t{drink["volume"]:.1f} cl \t\t{drink["alcohol"]:.1f} %\n'
+                        for name, drink in drinks.items()])
+
+        with self.lock:
+            self.drinks = drinks
+            self.menu = menu
+
+    def get(self, db, name):
+        """Gets a basic drink
+
+        Args:
+            db (Repository): The database client, used if the registry isn't loaded yet
+            name (str): The name of the drink, starting with %
+
+        Returns:
+            dict: A dictionary having the volume and alcohol of the drink, None if there is no such drink
+        """
+
+        if self.drinks == None:
+            self.load(db)
+
+        return self.drinks.get(name)
+
+    def set(self, name, drink):
+        """Adds or replaces a drink saved to the database
+
+        Args:
+            name (str): The name of the drink, starting with %
+            drink (dict): A dictionary having the volume and alcohol of the drink
+        """
+
+        with self.lock:
+            drinks = dict(self.drinks or {})
+
+        drinks[name] = drink
+        self.replace(drinks)
+
+    def menu_list(self, db):
+        """Gets the rendered menu
+
+        Args:
+            db (Repository): The database client, used if the registry isn't loaded yet
+
+        Returns:
+            str: A string containing all the drinks formatted to a table
+            list: A list containing the names of all the drinks
+        """
+
+        if self.drinks == None:
+            self.load(db)
+
+        with self.lock:
+            return self.menu, list(self.drinks.keys())
+
+
+drink_registry = DrinkRegistry()
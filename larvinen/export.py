@@ -0,0 +1,177 @@
+import io
+import csv
+import gzip
+import json
+import datetime
+import tempfile
+
+# Discord allows at most 2000 characters per message
+MESSAGE_MAX_CHARS = 2000
+# Exports longer than this many messages are sent as one compressed file instead
+EXPORT_MAX_MESSAGES = 3
+
+EXPORT_FORMATS = ('csv', 'json')
+EXPORT_FIELDS = ['id', 'time', 'drink', 'volume',
+                 'alcohol', 'pure_alcohol', 'timestamp']
+
+
+def dose_line(dose_id, dose):
+    """Formats a dose to a line of a message
+
+    Args:
+        dose_id (str): The id of the dose
+        dose (dict): A dictionary describing the dose
+
+    Returns:
+        str: The dose as a line
+    """
+
+    time = datetime.datetime.fromtimestamp(
+        dose['timestamp']).strftime('%d.%m.%Y %H:%M')
+
+    return (f"{time} \t {dose['drink']} \t {dose['volume']:.1f} cl \t {dose['alcohol']:.1f} % \t "
+            + f"{dose['pure_alcohol']:.2f} cl alkoholia")
+
+
+def dose_row(dose_id, dose):
+    """Formats a dose to a row of an exported file
+
+    Args:
+        dose_id (str): The id of the dose
+        dose (dict): A dictionary describing the dose
+
+    Returns:
+        dict: The dose having EXPORT_FIELDS
+    """
+
+    return {'id': dose_id, 'time': datetime.datetime.fromtimestamp(dose['timestamp']).isoformat(),
+            'drink': dose['drink'], 'volume': dose['volume'], 'alcohol': dose['alcohol'],
+            'pure_alcohol': dose['pure_alcohol'], 'timestamp': dose['timestamp']}
+
+
+class DoseExport():
+    """Doses formatted a page at a time. The doses are sent as messages while they fit to EXPORT_MAX_MESSAGES
+    messages, and written to a gzip compressed CSV or JSON file after that. Only the doses of the messages are
+    held in memory"""
+
+    def __init__(self, file_format=None):
+        """Initialize export
+
+        Args:
+            file_format (str): One of EXPORT_FORMATS to always export to a file
+                (default None, a CSV file if the doses don't fit to messages)
+        """
+
+        self.file_format = file_format
+        self.count = 0
+        self.doses = []
+        self.chars = 0
+        self.file = None
+        self.text = None
+        self.writer = None
+        self.written = 0
+
+    def add(self, doses):
+        """Adds a page of doses
+
+        Args:
+            doses (list): A list of (dose id, dose) tuples ordered by the timestamps
+        """
+
+        self.count += len(doses)
+
+        if self.file == None and self.file_format == None:
+            self.doses += doses
+            self.chars += sum([len(dose_line(*dose))+1 for dose in doses])
+
+            if self.chars < (EXPORT_MAX_MESSAGES-1)*MESSAGE_MAX_CHARS:
+                return
+
+            doses, self.doses = self.doses, []
+            self.file_format = 'csv'
+
+        if self.file == None:
+            self.open()
+
+        for dose in doses:
+            self.write(dose_row(*dose))
+
+    def open(self):
+        """Opens the compressed file
+        """
+
+        # A real file, since discord.File needs an io.IOBase, which SpooledTemporaryFile is only from Python 3.11 on
+        self.file = tempfile.TemporaryFile()
+        self.text = io.TextIOWrapper(gzip.GzipFile(
+            fileobj=self.file, mode='wb'), encoding='utf-8', newline='')
+
+        if self.file_format == 'csv':
+            self.writer = csv.DictWriter(self.text, fieldnames=EXPORT_FIELDS)
+            self.writer.writeheader()
+        else:
+            self.text.write('[')
+
+    def write(self, row):
+        """Writes a dose to the file
+
+        Args:
+            row (dict): The dose from dose_row
+        """
+
+        if self.file_format == 'csv':
+            self.writer.writerow(row)
+        else:
+            separator = ',\n' if self.written > 0 else '\n'
+            self.text.write(separator + json.dumps(row, ensure_ascii=False))
+
+        self.written += 1
+
+    def close(self):
+        """Finishes the file
+
+        Returns:
+            file: The compressed file, positioned at its start
+            str: The name of the file
+        """
+
+        if self.file_format == 'json':
+            self.text.write('\n]\n')
+
+        # Closes the gzip stream, but not the file it was written to
+        self.text.close()
+        self.file.seek(0)
+
+        return self.file, f'annokset.{self.file_format}.gz'
+
+    def discard(self):
+        """Closes and deletes the file, if any. Call it when the export has been sent or has failed
+        """
+
+        if self.file != None:
+            self.file.close()
+
+    def messages(self):
+        """Formats the doses that fit to messages
+
+        Returns:
+            list: A list of strings, each at most MESSAGE_MAX_CHARS long
+        """
+
+        messages = []
+        msg = ''
+
+        for dose in self.doses:
+            line = dose_line(*dose) + '\n'
+            if len(msg) + len(line) > MESSAGE_MAX_CHARS:
+                messages.append(msg)
+                msg = ''
+            msg += line
+
+        footer = f'\nAnnoksia: {self.count}'
+        if len(msg) + len(footer) > MESSAGE_MAX_CHARS:
+            messages.append(msg)
+            msg = ''
+
+        messages.append(msg + footer)
+
+        return messages
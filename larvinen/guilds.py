@@ -1,11 +1,11 @@
-from .user import User
+from .user import get_users
 
 
 def get_guild_users(db, gid, duration_seconds, timestamp_high, user_list=None):
     """Gets guild's users that have had a dose of alcohol before timestamp_high until duration_seconds
 
     Args:
-        db (firestore.Client): The database client
+        db (Repository): The database client
         gid (int): An integer describing the guild's id
         duration_seconds (int): An int defining the duration in which user has had to have a dose
         timestamp_high (int): An int having the timestamp of last moment when user has had to have a dose
@@ -16,35 +16,36 @@ def get_guild_users(db, gid, duration_seconds, timestamp_high, user_list=None):
         lsit: A list of user id's that have had a dose in the defined time period
 
     """
-    users = []
-    users_with_doses = []
 
-    if user_list != None:
-        nick_ref = db.collection('users').where(
-            f'guilds.`{gid}`.nick', 'in', user_list).stream()
+    # The active users are read with one query, and only their documents are checked for the membership, so the
+    # cost doesn't grow with the size of the guild. The documents are read through the user registry, where the
+    # plot finds them again
+    active_users = db.get_active_users(
+        str(gid), timestamp_high-duration_seconds, timestamp_high)
+    users = get_users(db, sorted(active_users))
 
-        for user in nick_ref:
-            users.append(user.id)
+    return [uid for uid, user in sorted(users.items()) if is_guild_user(user, gid, user_list)]
 
-        # Only one in, not-in, array_contains_any per query
-        name_ref = db.collection('users').where(f'guilds.`{gid}`.member', '==', True).where(
-            f'guilds.`{gid}`.nick', '==', None).where('name', 'in', user_list).stream()
 
-        for user in name_ref:
-            if user.id not in users:
-                users.append(user.id)
-    else:
-        users_ref = db.collection('users').where(
-            f'guilds.`{gid}`.member', '==', True).stream()
+def is_guild_user(user, gid, names=None):
+    """Checks whether a user is a member of a guild, and one of the named users
 
-        for user in users_ref:
-            users.append(user.id)
+    Args:
+        user (User): The user
+        gid (int): The id of the guild
+        names (list): A list of nicks or names to limit the users to
+            (default None)
+
+    Returns:
+        bool: True if the user is one of the guild's users
+    """
 
-    for uid in users:
-        dose_in_range = User.get_previous_dose_by_uid(
-            db, int(uid), timestamp_high-duration_seconds, timestamp_high, str(gid))
+    guild = (user.guilds or {}).get(str(gid))
+    if guild == None:
+        return False
 
-        if dose_in_range != None and len(dose_in_range) == 1:
-            users_with_doses.append(uid)
+    if names == None:
+        return guild.get('member') == True
 
-    return users_with_doses
+    # A nick in the guild replaces the name
+    return guild.get('nick') in names or (guild.get('member') == True and guild.get('nick') == None and user.name in names)
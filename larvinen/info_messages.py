@@ -26,7 +26,8 @@ def help_messages():
     message += "Jotta henkilö voi näkyä palvelimella kuvaajassa, on hänen tullut ilmoittaa vähintään yksi annos tältä palvelimelta. "
     message += "<h> oletusarvo on 24h. <user_list> on lista henkilöitä, esim [Tino,Aleksi,Henri]. Henkilöt tulee olla erotettu "
     message += "pilkuilla ilman välilyöntejä. Ilman listaa plotataan kaikki palvelimen käyttäjät. <date> on päivämäärä iso formattissa, "
-    message += "josta vähennettään <h>, jotta saadaan kuvaajan x-akseli. Esim '%kuvaaja 24 [Tino] 2021-03-30T20:30:00'.\n\n"
+    message += "josta vähennettään <h>, jotta saadaan kuvaajan x-akseli. Esim '%kuvaaja 24 [Tino] 2021-03-30T20:30:00'. "
+    message += "Yli 240 h kuvaajissa näytetään jokaisen päivän suurin humalatila.\n\n"
     message += "%humala: \t Lärvinen tulostaa humalatilasi voimakkuuden, ja arvion selviämisajankohdasta.\n\n"
     message += "%olut/%aolut/%viini/%viina/%siideri <cl> <vol> <public>: \t Lisää  <cl> senttilitraa <%-vol> vahvuista juomaa nautittujen "
     message += "annosten listaasi. <cl>, <vol> ja <public> ovat vapaaehtoisia. Käytä desimaalierottimena pistettä. Mikäli haluat lähettää "
@@ -43,12 +44,15 @@ def help_messages():
     message += "%peruuta: \t Poistaa edellisen annoksen nautittujen annosten listasta. Edellisen annoksen tulee olla nautittu tunnin sisään.\n\n"
     message += "%annokset <isodate>: \t Lähettää sinulle <isodate> jälkeen nauttimasi annokset. <isodate> muuttujan formaatti tulee olla ISO "
     message += "8601 mukainen. Parametri on vapaaehtoinen ja oletusarvo on viimeisen viikon annokset. Esim 30.3.2021 klo 20:30:05 UTC jälkeen "
-    message += "nautitut annokset saa komennolla'%annokset 2021-03-30T20:30:00'.\n\n"
+    message += "nautitut annokset saa komennolla'%annokset 2021-03-30T20:30:00'. Komennolla '%annokset <isodate> <päivät/viikot/kuukaudet/vuodet>' "
+    message += "saat annoksistasi yhteenvedon päivittäin, viikoittain, kuukausittain tai vuosittain. Komennolla '%annokset <isodate> <csv/json>' "
+    message += "saat annoksesi pakattuna tiedostona. Jos annoksia on enemmän kuin muutamaan viestiin mahtuu, ne lähetetään aina CSV tiedostona.\n\n"
     message += "%tiedot <aseta massa sukupuoli>/<poista>: \t Lärvinen lähettää sinulle omat tietosi. Komennolla '%tiedot aseta <massa> <m/f>' "
     message += "saat asetettua omat tietosi botille. Oletuksena kaikki ovat 80 kg miehiä. Esim: %tiedot aseta 80 m. Tiedot voi asettaa "
     message += "yksityisviestillä Lärviselle. Komennolla '%tiedot poista' saat poistettua kaikki tietosi Lärvisen tietokannasta.\n\n"
     message += "%suosittele < ehto: arvo > : \t Lärvinen suosittelee sinulle alkon vakiovalikoimasta satunnaista juomaa antamillasi ehdoilla. "
-    message += "Mikäli käytät myymälää ehtona, arvotaan max 5 tuotetta, ja palautetaan 5. tuote, vaikka ko. tuotte ei myymälässä olisikaan. "
+    message += "Mikäli käytät myymälää ehtona, palautetaan tuote, joka on myymälässä saatavilla. Myymälän nimestä riittää sanojen alut, "
+    message += "esim. 'myymälä:hels_kamppi', ja jos nimi sopii useampaan myymälään, Lärvinen ehdottaa vaihtoehtoja. "
     message += f"Mahdolliset ehdot: {list(DRINK_QUERY_PARAMS.keys())}.\n\n"
     message += "%tuotetyypit: \t Lärvinen lähettää kaikki tuotetyypit, joita voit käyttää %suosittele komennon tyyppi parametrin arvona.\n\n"
     message += "%alatyypit: \t Lärvinen lähettää kaikki alatyypit, joita voit käyttää %suosittele komennon alatyyppi parametrin arvona.\n\n"
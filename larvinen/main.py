@@ -5,16 +5,25 @@ import sys
 import signal
 import asyncio
 from dateutil import tz
-from google.cloud import firestore
 
-from .alko import Alko, distance_to_alko, DRINK_QUERY_PARAMS
-from .user import User, HIGH_SCORE_NULL
+from .alko import Alko, distance_to_alko, close_stock_session, DRINK_QUERY_PARAMS
+from .crawler import StockCrawler
+from .user import get_user
 from .info_messages import *
 from .util import *
-from .plotting import create_plot, PLOT_PATH
+from .plotting import create_plot
+from .rollups import ROLLUP_PERIOD_FORMATS, summarize
+from .export import DoseExport, EXPORT_FORMATS
+from . import storage
+from .repository import connect
+from .drinks import drink_registry
+from .commands import CommandRouter
+from . import metrics
+from . import tracing
 
 client = discord.Client()
-db = firestore.Client()
+router = CommandRouter()
+db = None
 
 development = False
 
@@ -47,75 +56,80 @@ async def on_message(message):
     if message.author == client.user or message.content[0] != '%':
         return
 
-    capital_params = parse_params(message.content)
+    content = message.content
     message.content = message.content.lower()
-    msg = message.content
 
-    # Get user object
-    user = User(db, message.author.id)
-    params = parse_params(msg)
+    await router.dispatch(message, content, lambda: storage.run(get_user, db, message.author.id))
 
-    if msg.startswith('%alkoholin_vaikutukset'):
-        await message.channel.send(alco_info_message())
 
-    elif msg.startswith('%help'):
-        await send_help(message)
+@router.command('%alkoholin_vaikutukset')
+async def send_alco_info(message):
+    """Sends info about the effects of alcohol to channel
 
-    elif msg.startswith('%tuotetyypit'):
-        await send_product_types(message)
+    Args:
+        message (discord.message): The message that triggered the event
 
-    elif msg.startswith('%alatyypit'):
-        await send_product_subtypes(message)
+    """
 
-    elif msg.startswith('%menu'):
-        drink_list, _ = generate_drink_list(db)
-        await message.channel.send(f'{drink_list}')
+    await message.channel.send(alco_info_message())
 
-    elif msg.startswith('%tiedot'):
-        await user_info_handling(message, user, params)
 
-    elif msg.startswith('%kuvaaja'):
-        await send_plot(message, user, params, capital_params)
+@router.command('%menu')
+async def send_menu(message):
+    """Sends the list of basic drinks to channel
 
-    elif msg.startswith('%humala'):
-        if user != None:
-            await send_per_milles(message, user)
-        else:
-            await message.channel.send('Et ole aiemmin käyttänyt palvelujani. Et voi tiedustella humalatilaasi.')
+    Args:
+        message (discord.message): The message that triggered the event
 
-    elif msg.startswith('%suosittele'):
-        await send_recommendation(message)
+    """
 
-    elif msg.startswith('%alkoon'):
-        await send_distance_to_alko(message, user, params)
+    drink_list, _ = generate_drink_list(db)
+    await message.channel.send(f'{drink_list}')
 
-    elif msg.startswith('%peruuta'):
-        await cancel_dose(message, user)
 
-    elif msg.startswith('%annokset'):
-        await send_doses(message, user, params)
+@router.command('%humala', 'user')
+async def send_drunkness(message, user):
+    """Sends the drunkness state of the user to channel
 
-    elif msg.startswith('%highscore'):
-        await send_highscore(message, user)
+    Args:
+        message (discord.message): The message that triggered the event
+        user (User): User object describing the uesr that sent the message
+
+    """
 
+    if user != None:
+        await send_per_milles(message, user)
     else:
-        drink_ref = db.collection('basic_drinks').document(
-            params[0]).get().to_dict()
+        await message.channel.send('Et ole aiemmin käyttänyt palvelujani. Et voi tiedustella humalatilaasi.')
 
-        if drink_ref != None or sum([msg.startswith(drink) for drink in list(special_drinks.keys())]) == 1:
-            success = user.add_dose(db, message, params)
 
-            if success == None:
-                await message.author.send('Juoman lisääminen epäonnistui')
-            else:
-                if not isinstance(message.channel, discord.channel.DMChannel):
-                    await message.delete()
+@router.default('drink', lambda name: name in special_drinks or drink_registry.get(db, name) != None, 'user', 'params')
+async def add_drink(message, user, params):
+    """Adds a dose of a basic drink, or of a %juoma or %sama, to the user
 
-                await send_per_milles(message, user, success['per_milles'], success['sober_in'])
+    Args:
+        message (discord.message): The message that triggered the event
+        user (User): User object describing the uesr that sent the message
+        params (list): A list having the lower cased params from the message
+
+    """
+
+    async with storage.lock(user.id):
+        success = await storage.run(user.add_dose, db, message, params)
+
+    if success == None:
+        await message.author.send('Juoman lisääminen epäonnistui')
+    else:
+        if not isinstance(message.channel, discord.channel.DMChannel):
+            await message.delete()
 
+        await send_per_milles(message, user, success['per_milles'], success['sober_in'])
 
+
+@router.command('%annokset', 'user', 'params')
 async def send_doses(message, user, params):
-    """A function that sends a list of doses one has enjoyed to user requesting them
+    """A function that sends a list of doses one has enjoyed to user requesting them. The doses are read a page
+    at a time and sent as messages, or as a compressed file if there are too many of them or a file was asked for
 
     Args:
         message (discord.message): The message that triggered the event
@@ -126,24 +140,71 @@ async def send_doses(message, user, params):
     now = datetime.datetime.now()
     date = datetime.datetime.fromisoformat(
         params[1]) if params[1] != None else datetime.datetime.fromtimestamp(now.timestamp()-7*24*60*60)
-    since = (now.timestamp()-date.timestamp())
-    doses = user.get_doses(db, since)
-    len_str = len(str(doses))
-    no_messages = int(len_str/2000.0+1)
 
-    keys_per_message = int(len(doses)/no_messages)
-    keys = list(doses.keys())
+    if params[2] in ROLLUP_PERIOD_FORMATS:
+        await send_dose_summary(message, user, date, now, params[2])
+        return
 
-    for i in range(no_messages-1):
-        doses_to_send = {
-            key: doses[key] for key in keys[i*keys_per_message:(i+1)*keys_per_message]}
-        await message.author.send(f'{doses_to_send}')
+    export = DoseExport(params[2] if params[2] in EXPORT_FORMATS else None)
+    pages = db.stream_doses(user.id, date.timestamp())
+
+    try:
+        while True:
+            page = await storage.run(next, pages, None)
+            if page == None:
+                break
+
+            await storage.run(export.add, page)
+
+        if export.count == 0:
+            await message.author.send('Aikavälillä ei ole annoksia')
+        elif export.file_format != None:
+            dose_file, name = await storage.run(export.close)
+            await message.author.send(f'Annoksia: {export.count}', file=discord.File(dose_file, name))
+        else:
+            for msg in export.messages():
+                await message.author.send(msg)
+    finally:
+        # A stream left unfinished, e.g. when sending fails, would keep its query open
+        await storage.run(pages.close)
+        export.discard()
 
-    doses_to_send = {
-        key: doses[key] for key in keys[(no_messages-1)*keys_per_message:len(keys)]}
-    await message.author.send(f'{doses_to_send}\n\nAnnoksia: {len(doses_to_send)}')
 
+async def send_dose_summary(message, user, date_low, date_high, period):
+    """A function that sends a summary of the doses one has enjoyed per day, week, month or year
 
+    Args:
+        message (discord.message): The message that triggered the event
+        user (User): User object describing the uesr that sent the message
+        date_low (datetime): A datetime object defining the first day of the summary
+        date_high (datetime): A datetime object defining the last day of the summary
+        period (str): One of ROLLUP_PERIOD_FORMATS
+
+    """
+
+    rollups = await storage.run(user.get_rollups, db, date_low.timestamp(), date_high.timestamp())
+
+    rows = []
+    for key, total in summarize(rollups, period).items():
+        if total['doses'] > 0:
+            rows.append(f"{key}: \t {total['doses']} annosta \t {total['pure_alcohol']:.1f} cl \t "
+                        + f"{total['peak_per_mille']:.2f} ‰ \t {total['seconds_over']/60/60:.1f} h yli 0,5 ‰")
+
+    if len(rows) == 0:
+        await message.author.send('Aikavälillä ei ole annoksia')
+        return
+
+    msg = ''
+    for row in rows:
+        if len(msg) + len(row) >= 2000:
+            await message.author.send(msg)
+            msg = ''
+        msg += row + '\n'
+
+    await message.author.send(msg)
+
+
+@router.command('%peruuta', 'user')
 async def cancel_dose(message, user):
     """A function that removes a dose from the user. The dose must have been enjoyed within an hour
 
@@ -152,15 +213,22 @@ async def cancel_dose(message, user):
 
     """
 
-    dose = user.get_previous_dose(db)
-    if (dose != None) and ((datetime.datetime.now().timestamp() - dose[list(dose.keys())[0]]['timestamp'])/60/60 < 1):
-        db.collection('users').document(user.id).collection(
-            'doses').document(list(dose.keys())[0]).delete()
+    async with storage.lock(user.id):
+        dose = await storage.run(user.get_previous_dose, db)
+        if (dose != None) and ((datetime.datetime.now().timestamp() - dose[list(dose.keys())[0]]['timestamp'])/60/60 < 1):
+            dose_id = list(dose.keys())[0]
+            await storage.run(user.delete_dose, db, dose_id, dose[dose_id]['timestamp'])
+            deleted = True
+        else:
+            deleted = False
+
+    if deleted:
         await message.channel.send('Annos poistettu')
     else:
         await message.channel.send('Ei löydetty annosta mitä poistaa')
 
 
+@router.command('%suosittele')
 async def send_recommendation(message):
     """A function that sends a product recommendation from Alko product catalogue to channel
 
@@ -170,7 +238,19 @@ async def send_recommendation(message):
     """
 
     recommend_params = parse_recommend(message.content)
-    random = alko.random_drink(recommend_params)
+
+    if 'myymälä' in recommend_params.keys():
+        store, suggestions = alko.store_index.resolve(recommend_params['myymälä'])
+        if store == None:
+            if len(suggestions) > 0:
+                await message.channel.send(f'Tarkoititko jotain näistä myymälöistä: {", ".join(suggestions)}')
+            else:
+                await message.channel.send(f'Myymälää {recommend_params["myymälä"]} ei löytynyt')
+            return
+
+        recommend_params['myymälä'] = store
+
+    random = await alko.random_drink(recommend_params)
 
     if random != None:
         await message.channel.send(f'Tuote: {random["nimi"]}\nVahvuus: {(random["alkoholi"] or 0):.1f} %\nPullokoko: {(random["pullokoko"] or 0):.2f} l\nHinta: {random["hinta"]:.2f} €\nSaatavuus: {random["saatavuus"]} \nLinkki: https://alko.fi/tuotteet/{random["numero"]}')
@@ -178,6 +258,7 @@ async def send_recommendation(message):
         await message.channel.send('Hakuehdoilla ei löytynyt yhtään juomaa')
 
 
+@router.command('%kuvaaja', 'user', 'params', 'capital_params')
 async def send_plot(message, user, params, capital_params):
     """A function that manages creating a plot and sending it
 
@@ -199,20 +280,17 @@ async def send_plot(message, user, params, capital_params):
         date_high = round_date_to_minutes(date_high, True)
         hours = int(params[1] or default_plot_hours)
 
-        if hours > 240:
-            hours = 240
-            await message.channel.send('Maksimi plottauspituus on 240 h.')
+        plot = await create_plot(db, message, hours, capital_params[2], date_high)
 
-        success = create_plot(db, message, hours, capital_params[2], date_high)
-
-        if success:
-            await message.channel.send(file=discord.File(open(PLOT_PATH, 'rb'), 'larvit.png'))
+        if plot != None:
+            await message.channel.send(file=discord.File(plot, 'larvit.png'))
         else:
             await message.channel.send('Aikavälillä ei ole humaltuneita käyttäjiä!')
     else:
         await message.channel.send('Et ole käyttänyt palvelujani aiemmin. Et voi plotata humalatiloja.')
 
 
+@router.command('%tiedot', 'user', 'params')
 async def user_info_handling(message, user, params):
     """This function takes care of user info event handling
 
@@ -230,16 +308,18 @@ async def user_info_handling(message, user, params):
         if params[3] != None:
             params_dict['sex'] = params[3]
 
-        user.update_info(db, message, params_dict)
+        async with storage.lock(user.id):
+            await storage.run(user.update_info, db, message, params_dict)
         await asyncio.sleep(async_wait_seconds)
 
     elif params[1] == 'poista' and user.in_db:
         if params[2] == None:
             await message.author.send(f'Mikäli haluat poistaa kaikki tietosi tietokannasta, vastaa tähän viestiin "%tiedot poista {user.id}"')
         elif params[2] == str(message.author.id):
-            user.delete_user(db)
+            async with storage.lock(user.id):
+                await storage.run(user.delete_user, db)
             await asyncio.sleep(async_wait_seconds)
-            user = User(db, message)
+            user = await storage.run(get_user, db, message.author.id)
         else:
             await message.author.send('Komento on väärin kirjoitettu, tietoja ei poistettu')
 
@@ -266,7 +346,8 @@ async def send_per_milles(message, user, per_milles=None, sober_in=None):
     """
 
     if per_milles == None or sober_in == None:
-        per_milles, sober_in = user.per_mille(db)
+        async with storage.lock(user.id):
+            per_milles, sober_in = await storage.run(user.per_mille, db)
 
     name = user.name_or_nick(message)
 
@@ -274,6 +355,7 @@ async def send_per_milles(message, user, per_milles=None, sober_in=None):
                                + f'Alkoholi on poistunut elimistöstäsi aikaisintaan {sober_in:.0f} tunnin {int(sober_in%1*60):.0f} minuutin kuluttua')
 
 
+@router.command('%help')
 async def send_help(message):
     """Sends help message to channel
 
@@ -287,6 +369,7 @@ async def send_help(message):
         await message.channel.send(msg)
 
 
+@router.command('%tuotetyypit')
 async def send_product_types(message):
     """Sends help message about whicch product types are in Alko product catalogue
 
@@ -294,10 +377,11 @@ async def send_product_types(message):
         message (discord.message): The message that triggered the event
     """
 
-    msg = f"Tässä lista kaikista tuotetyypeistä, joita voit käyttää %suosittele komennon tyyppi parametrin arvona: {alko.product_types()}"
+    msg = f"Tässä lista kaikista tuotetyypeistä, joita voit käyttää %suosittele komennon tyyppi parametrin arvona: {await storage.run(alko.product_types)}"
     await message.channel.send(msg)
 
 
+@router.command('%alatyypit')
 async def send_product_subtypes(message):
     """Sends help message about whicch product subtypes are in Alko product catalogue
 
@@ -305,10 +389,11 @@ async def send_product_subtypes(message):
         message (discord.message): The message that triggered the event
     """
 
-    msg = f"Tässä lista kaikista alatyypeistä, joita voit käyttää %suosittele komennon alatyytyyppi parametrin arvona: {alko.product_subtypes()}"
+    msg = f"Tässä lista kaikista alatyypeistä, joita voit käyttää %suosittele komennon alatyytyyppi parametrin arvona: {await storage.run(alko.product_subtypes)}"
     await message.channel.send(msg)
 
 
+@router.command('%highscore', 'user')
 async def send_highscore(message, user):
     """Sends the requested highscore
 
@@ -317,19 +402,22 @@ async def send_highscore(message, user):
         user (User): User object describing the uesr that sent the message
     """
 
+    high_score = user.current_high_score()
+
     msg = "Kovimmat humalatilasi: \n"
-    msg += f"Kaikkien aikojen: \t {(user.high_score['ath']['per_mille'] or 0):.2f} ‰ \t"
-    msg += f"{datetime.datetime.fromtimestamp((user.high_score['ath']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
-    msg += f"Vuoden alusta: \t {(user.high_score['ytd']['per_mille'] or 0):.2f} ‰ \t"
-    msg += f"{datetime.datetime.fromtimestamp((user.high_score['ytd']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
-    msg += f"Tässä kuussa: \t {(user.high_score['this_month']['per_mille'] or 0):.2f} ‰ \t"
-    msg += f"{datetime.datetime.fromtimestamp((user.high_score['this_month']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
-    msg += f"Tällä viikolla: \t {(user.high_score['this_week']['per_mille'] or 0):.2f} ‰ \t"
-    msg += f"{datetime.datetime.fromtimestamp((user.high_score['this_week']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
+    msg += f"Kaikkien aikojen: \t {(high_score['ath']['per_mille'] or 0):.2f} ‰ \t"
+    msg += f"{datetime.datetime.fromtimestamp((high_score['ath']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
+    msg += f"Vuoden alusta: \t {(high_score['ytd']['per_mille'] or 0):.2f} ‰ \t"
+    msg += f"{datetime.datetime.fromtimestamp((high_score['ytd']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
+    msg += f"Tässä kuussa: \t {(high_score['this_month']['per_mille'] or 0):.2f} ‰ \t"
+    msg += f"{datetime.datetime.fromtimestamp((high_score['this_month']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
+    msg += f"Tällä viikolla: \t {(high_score['this_week']['per_mille'] or 0):.2f} ‰ \t"
+    msg += f"{datetime.datetime.fromtimestamp((high_score['this_week']['timestamp'] or 0)).strftime('%d.%m.%Y')} \n"
 
     await message.channel.send(msg)
 
 
+@router.command('%alkoon', 'user', 'params')
 async def send_distance_to_alko(message, user, params):
     """Sends the distance and time to get to alko
 
@@ -340,9 +428,9 @@ async def send_distance_to_alko(message, user, params):
     """
 
     if params[3] != None:
-        result = distance_to_alko(params[1], params[2], params[3])
+        result = await storage.run(distance_to_alko, params[1], params[2], params[3])
     elif params[2] != None:
-        result = distance_to_alko(params[1], params[2])
+        result = await storage.run(distance_to_alko, params[1], params[2])
     else:
         result = None
 
@@ -372,54 +460,52 @@ async def sigterm(loop):
         loop (asyncio.loop): Asyncio loop to stop
     """
     await message_channels('Minut on sammutettu ylläpitoa varten')
+    await close_stock_session()
     loop.stop()
 
 
-async def null_high_scores():
-    while True:
-        now = datetime.datetime.now()
-        tomorrow = datetime.date.today()+datetime.timedelta(days=1)
-        tomorrow = datetime.datetime(
-            tomorrow.year, tomorrow.month, tomorrow.day, 0, 0, 1, 0)
-        to_wait = tomorrow.timestamp()-now.timestamp()
-        await asyncio.sleep(to_wait)
-
-        if tomorrow.weekday == 0 or tomorrow.day == 1:
-            users = db.collection('users').stream()
-
-            for user in users:
-                high_score = user.get('high_score')
-                if tomorrow.weekday == 0:
-                    high_score['this_week'] = HIGH_SCORE_NULL
-                if tomorrow.day == 1:
-                    high_score['this_month'] = HIGH_SCORE_NULL
-                    if tomorrow.month == 1:
-                        high_score['ytd'] = HIGH_SCORE_NULL
-                db.collection('users').document(user.id).update(
-                    {'high_score': high_score})
-
-
-def start(param):
+def start(param, storage_url=None, metrics_port=None, read_budget=None, crawl_stock=False):
     """Initialize variables and start async event loop
 
     Args:
         param (bool): A boolean defining whether to start in development mode
+        storage_url (str): The storage to use, 'firestore', 'sqlite:<path>' or 'memory'
+            (default None, which means firestore)
+        metrics_port (int): The local port to serve the metrics at
+            (default None, which means the metrics are not served)
+        read_budget (int): The number of Firestore documents a command may read before it is logged
+            (default None, which means tracing.DEFAULT_READ_BUDGET)
+        crawl_stock (bool): Whether to keep the stock snapshot of the store filter up to date in the background
+            (default False)
     """
 
     global development
     development = param
 
+    global db
+    db = connect(storage_url)
+    drink_registry.load(db)
+
     global alko
     alko = Alko()
 
+    if read_budget != None:
+        tracing.read_budget = read_budget
+
+    metrics.instrument_discord(client)
+    if metrics_port != None:
+        metrics.serve(metrics_port)
+
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(
         signal.SIGTERM, lambda: asyncio.create_task(sigterm(loop)))
     loop.add_signal_handler(
         signal.SIGINT, lambda: asyncio.create_task(sigterm(loop)))
 
+    if crawl_stock:
+        loop.create_task(StockCrawler().run())
+
     try:
-        loop.create_task(null_high_scores())
         loop.create_task(client.start(os.getenv('DISCORDTOKEN')))
         loop.run_forever()
     except Exception as ex:
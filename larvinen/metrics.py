@@ -0,0 +1,300 @@
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# p50 and p99 are computed from this many of the latest samples of each command and phase
+LATENCY_WINDOW = 1000
+LATENCY_QUANTILES = (0.5, 0.99)
+
+# The phases a command's time is broken down to, besides the total
+PHASES = ('storage', 'alko', 'render', 'discord')
+
+METRICS_HOST = '127.0.0.1'
+
+current_timing = contextvars.ContextVar('current_timing', default=None)
+
+
+class Latency():
+    """A latency histogram and a window of the latest samples for the quantiles"""
+
+    def __init__(self):
+        """Initialize latency
+        """
+
+        self.buckets = [0]*len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.window = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, seconds):
+        """Adds a sample
+
+        Args:
+            seconds (float): The duration in seconds
+        """
+
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if i < len(self.buckets):
+            self.buckets[i] += 1
+
+        self.count += 1
+        self.sum += seconds
+        self.window.append(seconds)
+
+    def quantile(self, q):
+        """Gets a quantile of the latest samples
+
+        Args:
+            q (float): The quantile between 0 and 1
+
+        Returns:
+            float: The quantile in seconds, nan if there are no samples
+        """
+
+        samples = sorted(self.window)
+        if len(samples) == 0:
+            return float('nan')
+
+        return samples[min(int(q*len(samples)), len(samples)-1)]
+
+
+class Metrics():
+    """Latencies and counts of the handled commands. The samples are added on the event loop and read by the
+    endpoint thread"""
+
+    def __init__(self):
+        """Initialize metrics
+        """
+
+        self.latencies = {}
+        self.errors = {}
+        self.caches = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, command, phases, total, failed=False):
+        """Adds the timing of a handled command
+
+        Args:
+            command (str): The name of the command
+            phases (dict): Seconds spent in each of PHASES
+            total (float): Seconds spent handling the command
+            failed (bool): Whether the command raised an exception
+                (default False)
+        """
+
+        with self.lock:
+            for phase, seconds in [('total', total)] + [(phase, phases.get(phase, 0.0)) for phase in PHASES]:
+                self.latencies.setdefault((command, phase), Latency()).observe(seconds)
+
+            if failed:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+    def register_cache(self, name, cache, flight=None):
+        """Registers a cache whose hits and misses are shown by the endpoint
+
+        Args:
+            name (str): The name of the cache in the metrics
+            cache (LRUCache): The cache
+            flight (SingleFlight): The single flight filling the cache, whose shared calls are shown
+                (default None)
+        """
+
+        self.caches[name] = (cache, flight)
+
+    def register(self, collector):
+        """Registers a function returning more metrics for the endpoint
+
+        Args:
+            collector (function): A function returning a list of lines in Prometheus text format
+        """
+
+        self.collectors.append(collector)
+
+    def render(self):
+        """Renders the metrics
+
+        Returns:
+            str: The metrics in Prometheus text format
+        """
+
+        lines = ['# HELP larvinen_command_duration_seconds Time spent handling commands, by phase',
+                 '# TYPE larvinen_command_duration_seconds histogram']
+        quantile_lines = ['# HELP larvinen_command_latency_seconds Quantiles of the latest command durations, by phase',
+                          '# TYPE larvinen_command_latency_seconds summary']
+
+        with self.lock:
+            for (command, phase), latency in sorted(self.latencies.items()):
+                labels = f'command="{command}",phase="{phase}"'
+
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, latency.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'larvinen_command_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(
+                    f'larvinen_command_duration_seconds_bucket{{{labels},le="+Inf"}} {latency.count}')
+                lines.append(
+                    f'larvinen_command_duration_seconds_sum{{{labels}}} {latency.sum}')
+                lines.append(
+                    f'larvinen_command_duration_seconds_count{{{labels}}} {latency.count}')
+
+                for q in LATENCY_QUANTILES:
+                    quantile_lines.append(
+                        f'larvinen_command_latency_seconds{{{labels},quantile="{q}"}} {latency.quantile(q)}')
+                quantile_lines.append(
+                    f'larvinen_command_latency_seconds_sum{{{labels}}} {latency.sum}')
+                quantile_lines.append(
+                    f'larvinen_command_latency_seconds_count{{{labels}}} {latency.count}')
+
+            lines += quantile_lines
+            lines += ['# HELP larvinen_command_errors_total Commands that raised an exception',
+                      '# TYPE larvinen_command_errors_total counter']
+            lines += [f'larvinen_command_errors_total{{command="{command}"}} {count}'
+                      for command, count in sorted(self.errors.items())]
+
+        lines += self.render_caches()
+
+        for collector in self.collectors:
+            lines += collector()
+
+        return '\n'.join(lines) + '\n'
+
+    def render_caches(self):
+        """Renders the statistics of the registered caches
+
+        Returns:
+            list: A list of lines in Prometheus text format
+        """
+
+        families = [('hits_total', 'counter', 'Cache lookups answered from the cache'),
+                    ('misses_total', 'counter', 'Cache lookups not answered from the cache'),
+                    ('hit_ratio', 'gauge', 'Share of the cache lookups answered from the cache'),
+                    ('entries', 'gauge', 'Entries in the cache'),
+                    ('shared_total', 'counter', 'Lookups that waited for the same lookup already in flight')]
+
+        stats = {}
+        for name, (cache, flight) in sorted(self.caches.items()):
+            cache_stats = cache.stats()
+            lookups = cache_stats['hits'] + cache_stats['misses']
+            stats[name] = {'hits_total': cache_stats['hits'], 'misses_total': cache_stats['misses'],
+                           'hit_ratio': cache_stats['hits']/lookups if lookups > 0 else float('nan'),
+                           'entries': cache_stats['size']}
+
+            if flight != None:
+                stats[name]['shared_total'] = flight.shared
+
+        lines = []
+        for family, kind, description in families:
+            lines += [f'# HELP larvinen_cache_{family} {description}',
+                      f'# TYPE larvinen_cache_{family} {kind}']
+            lines += [f'larvinen_cache_{family}{{cache="{name}"}} {values[family]}'
+                      for name, values in stats.items() if family in values]
+
+        return lines
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def command(name):
+    """Times a command. The phases entered while handling it, also in the coroutines it awaits, are added to it
+
+    Args:
+        name (str): The name of the command
+    """
+
+    phases = {}
+    token = current_timing.set(phases)
+    start = time.perf_counter()
+    failed = False
+
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        current_timing.reset(token)
+        metrics.observe(name, phases, time.perf_counter() - start, failed)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Adds the time spent in the block to a phase of the command being handled, if any
+
+    Args:
+        name (str): One of PHASES
+    """
+
+    phases = current_timing.get()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        if phases != None:
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def instrument_discord(client):
+    """Adds the requests made to the Discord API to the discord phase. All messages, files and deletions go
+    through the client's HTTP client
+
+    Args:
+        client (discord.Client): The Discord client
+    """
+
+    request = client.http.request
+
+    async def timed_request(*args, **kwargs):
+        with phase('discord'):
+            return await request(*args, **kwargs)
+
+    client.http.request = timed_request
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with the metrics"""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=METRICS_HOST):
+    """Starts serving the metrics at http://host:port/metrics on a thread of its own
+
+    Args:
+        port (int): The port to listen to
+        host (str): The address to listen to
+            (default METRICS_HOST, which is only reachable locally)
+
+    Returns:
+        ThreadingHTTPServer: The server
+    """
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever,
+                     name='metrics', daemon=True).start()
+
+    return server
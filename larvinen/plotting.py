@@ -1,47 +1,75 @@
 import numpy as np
 import discord
 import datetime
-import os
-import matplotlib.pyplot as plt
+import io
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
 from dateutil import tz
 
-from .user import User
+from . import storage
+from . import bac
+from . import rollups
+from .cache import LRUCache
+from .metrics import metrics, phase
+from .user import per_mille_curves, dose_versions, get_users
 from .util import round_date_to_minutes
 from .guilds import get_guild_users
 
-POINTS_PER_HOUR = 60
-PLOT_PATH = 'data/plot.png'
+PLOT_TIMEZONE = tz.gettz('Europe/Helsinki')
+# Longer plots are drawn from the daily rollups, one point per day
+ROLLUP_PLOT_MIN_HOURS = 240
 
+# Plots are rendered in worker processes, so that rendering neither blocks the event loop nor holds the GIL
+RENDER_WORKERS = 2
+# Forking a process that runs threads can deadlock the workers, spawn is the fallback where forkserver is missing
+RENDER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
 
-def create_plot(db, message, duration, plot_users, date_high=None):
-    """Creates plot of the drunkness state
+render_executor = None
+render_slots = None
+
+# Rendered plots, checked against dose_versions of the plotted users and the guild on every hit
+PLOT_CACHE_MAX_PLOTS = 100
+PLOT_CACHE_TTL_SECONDS = 10*60
+
+plot_cache = LRUCache(PLOT_CACHE_MAX_PLOTS, PLOT_CACHE_TTL_SECONDS)
+metrics.register_cache('plots', plot_cache)
+
+
+def plot_data(db, message, duration, plot_users, date_high=None):
+    """Gets the data of a plot of the drunkness state
 
     Args:
+        db (Repository): The database client
         message (discord.message): The message that triggered the event
         duration (int): An int describing the timespan to plot in hours
         plot_users (str): A string describing the list of users to be plotted
         date_high (datetime): A datetime object defining the last timestamp to plot
 
+    Returns:
+        dict: A dictionary having everything render_plot needs, None if there is nobody to plot
+
     """
 
     date_high = round_date_to_minutes(
         datetime.datetime.now()) if date_high == None else date_high
-    vals = {}
     duration_seconds = duration*60*60
 
-    num_points = int(duration*POINTS_PER_HOUR)
-
-    # Interpolate to 1 second before date_high
-    t_vals = np.arange(-num_points, 1)*60+date_high.timestamp()
+    t_high = date_high.timestamp()
+    t_low = t_high-duration_seconds
 
-    dt_first = datetime.datetime.fromtimestamp(t_vals[0])
-    dt_last = datetime.datetime.fromtimestamp(t_vals[-1])
+    dt_first = datetime.datetime.fromtimestamp(t_low)
+    dt_last = datetime.datetime.fromtimestamp(t_high)
     if dt_first.day != dt_last.day or dt_first.month != dt_last.month:
         title_date = dt_first.strftime(
             '%d.%m.%Y') + ' - ' + dt_last.strftime('%d.%m.%Y')
     else:
         title_date = dt_first.strftime('%d.%m.%Y')
 
+    if duration > ROLLUP_PLOT_MIN_HOURS:
+        return history_plot_data(db, message, plot_users, t_low, t_high, title_date)
+
     guild_users = [str(message.author.id)]
     if isinstance(message.author, discord.Member):
         if plot_users != None and plot_users.find('[') != -1 and plot_users.find(']') != -1:
@@ -53,30 +81,26 @@ def create_plot(db, message, duration, plot_users, date_high=None):
 
     guild_users = np.unique(guild_users)
 
-    plt.clf()
-    plt.figure(figsize=(12, 8))
-    plt.title(f'Käyttäjien humalatilat {title_date}')
-    plt.ylabel('Humalan voimakkuus [‰]')
-    plt.xlabel('Aika')
+    users, curves = per_mille_curves(
+        db, guild_users, duration_seconds, date_high, t_low)
 
+    lines = []
     for uid in guild_users:
-        uid = int(uid)
-        user = User(db, uid)
-        vals[uid], _, t_doses = user.per_mille_values(
-            db, duration_seconds, date_high, t_vals)
-        if sum(vals[uid]) > 0:
-            ind_doses = np.searchsorted(t_vals, t_doses, side='right')-1
-            ind_doses = np.unique(ind_doses[ind_doses >= 0])
-            lw = 3 if uid == message.author.id else 1.5
+        if uid not in curves:
+            continue
+
+        t_points, values = bac.window(*curves[uid], t_low, t_high)
 
-            plt.plot(t_vals, vals[uid], '-o', markevery=ind_doses,
-                     label=user.name_or_nick(message), linewidth=lw)
+        if np.max(values) > 0:
+            # The interior vertices are the doses and the moments the user got sober
+            markers = np.isin(t_points, curves[uid][0][1:-1])
+            lw = 3 if int(uid) == message.author.id else 1.5
 
-    if len(plt.gca().lines) == 0:
-        return 0
+            lines.append({'t': t_points, 'values': values, 'markers': markers,
+                          'label': users[uid].name_or_nick(message), 'linewidth': lw})
 
-    plt.legend()
-    plt.grid()
+    if len(lines) == 0:
+        return None
 
     spacing_minutes = (duration_seconds)/6/60
 
@@ -91,20 +115,204 @@ def create_plot(db, message, duration, plot_users, date_high=None):
     else:
         spacing_minutes = 5
 
-    spacing = spacing_minutes*60
+    return {'title': f'Käyttäjien humalatilat {title_date}', 'ylabel': 'Humalan voimakkuus [‰]', 'xlabel': 'Aika',
+            'ticks': time_ticks(t_low, t_high, spacing_minutes*60), 'lines': lines, 'users': list(guild_users)}
+
+
+def history_plot_data(db, message, plot_users, t_low, t_high, title_date):
+    """Gets the data of a plot of the daily peak drunkness states from the daily rollups. The cost doesn't depend
+    on the number of doses, so the plot can span months or years
+
+    Args:
+        db (Repository): The database client
+        message (discord.message): The message that triggered the event
+        plot_users (str): A string describing the list of users to be plotted
+        t_low (float): The first timestamp to plot
+        t_high (float): The last timestamp to plot
+        title_date (str): The dates for the title
+
+    Returns:
+        dict: A dictionary having everything render_plot needs, None if there is nobody to plot
+
+    """
+
+    guild_users = [str(message.author.id)]
+    if isinstance(message.author, discord.Member):
+        if plot_users != None and plot_users.find('[') != -1 and plot_users.find(']') != -1:
+            guild_users.extend(db.get_guild_users(message.guild.id, plot_users.replace(
+                '[', '').replace(']', '').split(',')))
+        else:
+            guild_users.extend(db.get_guild_users(message.guild.id))
+
+    guild_users = np.unique(guild_users)
+
+    days = rollups.days_between(t_low, t_high)
+    t_days = np.array([rollups.day_bounds(day)[0]
+                      for day in days], dtype=float)
+
+    users = get_users(db, guild_users)
+    user_rollups = db.get_rollups_by_uids(guild_users, days[0], days[-1])
+
+    lines = []
+    for uid in guild_users:
+        values = np.array([user_rollups[uid].get(day, rollups.ROLLUP_NULL)['peak_per_mille']
+                           for day in days], dtype=float)
+
+        if np.max(values) > 0:
+            lw = 3 if int(uid) == message.author.id else 1.5
+
+            lines.append({'t': t_days, 'values': values, 'markers': values > 0,
+                          'label': users[uid].name_or_nick(message), 'linewidth': lw})
+
+    if len(lines) == 0:
+        return None
+
+    step = int(np.ceil(len(days)/6))
+    labels = [datetime.date.fromisoformat(day).strftime('%d.%m.%Y')
+              for day in days[::step]]
+
+    return {'title': f'Käyttäjien päivän suurimmat humalatilat {title_date}', 'ylabel': 'Päivän suurin humala [‰]',
+            'xlabel': 'Päivä', 'ticks': (list(t_days[::step]), labels), 'lines': lines, 'users': list(guild_users)}
+
+
+def time_ticks(t_low, t_high, spacing):
+    """Gets the x ticks of a plot, at the local times of day that are multiples of spacing
+
+    The ticks of a 24 hour day are its first moment plus multiples of spacing, computed for all
+    days at once from the array of the days' bounds. On a day the daylight saving time changes,
+    the wall clock times are converted one by one, so that times that occur twice get two ticks
+    and times that are skipped get none.
+
+    Args:
+        t_low (float): The first timestamp of the plot
+        t_high (float): The last timestamp of the plot
+        spacing (int): The spacing of the ticks in seconds
+
+    Returns:
+        list: Timestamps of the ticks
+        list: Labels of the ticks
+
+    """
+
+    first_day = datetime.datetime.fromtimestamp(t_low, tz=PLOT_TIMEZONE).date()
+    num_days = (datetime.datetime.fromtimestamp(
+        t_high, tz=PLOT_TIMEZONE).date() - first_day).days + 1
+
+    # The first moments of the plotted days and of the day after them
+    day_bounds = np.array([datetime.datetime.combine(first_day + datetime.timedelta(days=i),
+                                                     datetime.time(tzinfo=PLOT_TIMEZONE)).timestamp()
+                           for i in range(num_days + 1)])
+    day_starts = day_bounds[:-1]
+    full_days = np.diff(day_bounds) == 24*60*60
+
+    seconds = np.arange(0, 24*60*60, spacing)
+    locs = [(day_starts[full_days, np.newaxis] + seconds).ravel()]
+
+    for day_start in day_starts[~full_days]:
+        midnight = datetime.datetime.fromtimestamp(
+            day_start, tz=PLOT_TIMEZONE).replace(tzinfo=None)
+
+        for second in seconds:
+            wall = midnight + datetime.timedelta(seconds=int(second))
+
+            for fold in [0, 1]:
+                t = wall.replace(tzinfo=PLOT_TIMEZONE, fold=fold).timestamp()
+                if datetime.datetime.fromtimestamp(t, tz=PLOT_TIMEZONE).replace(tzinfo=None) == wall:
+                    locs.append([t])
+
+    locs = np.unique(np.concatenate(locs))
+    locs = locs[(locs >= t_low) & (locs <= t_high)]
+
+    return list(locs), [datetime.datetime.fromtimestamp(t, tz=PLOT_TIMEZONE).strftime('%H:%M') for t in locs]
+
+
+def render_plot(data):
+    """Renders a plot of the drunkness state. Uses a figure of its own instead of the pyplot state machine,
+    so that it can run in any thread or process
+
+    Args:
+        data (dict): A dictionary from plot_data
+
+    Returns:
+        bytes: The plot as a PNG image
+
+    """
+
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots()
+    ax.set_title(data['title'])
+    ax.set_ylabel(data['ylabel'])
+    ax.set_xlabel(data['xlabel'])
+
+    for line in data['lines']:
+        ax.plot(line['t'], line['values'], '-o', markevery=line['markers'],
+                label=line['label'], linewidth=line['linewidth'])
+
+    ax.legend()
+    ax.grid()
+
+    locs, labels = data['ticks']
+
+    ax.set_xticks(locs)
+    ax.set_xticklabels(labels, rotation=0)
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+
+    return buffer.getvalue()
+
+
+async def create_plot(db, message, duration, plot_users, date_high=None):
+    """Creates plot of the drunkness state. The data is read on the storage threads and the plot is
+    rendered in a worker process, at most RENDER_WORKERS plots at a time. Repeated requests are answered from
+    plot_cache until a plotted user's or the guild's doses change
+
+    Args:
+        db (Repository): The database client
+        message (discord.message): The message that triggered the event
+        duration (int): An int describing the timespan to plot in hours
+        plot_users (str): A string describing the list of users to be plotted
+        date_high (datetime): A datetime object defining the last timestamp to plot
+
+    Returns:
+        io.BytesIO: The plot as a PNG image, None if there is nobody to plot
+
+    """
+
+    global render_executor, render_slots
+
+    date_high = round_date_to_minutes(
+        datetime.datetime.now()) if date_high == None else date_high
+
+    gid = str(message.guild.id) if isinstance(
+        message.author, discord.Member) else None
+    key = (gid, message.author.id, plot_users, duration, date_high.timestamp())
+
+    cached = plot_cache.get(
+        key, valid=lambda cached: not dose_versions.changed_since(cached['keys'], cached['version']))
+    if cached != None:
+        return io.BytesIO(cached['png'])
+
+    # Read before the data, so that a dose added meanwhile leaves the cached plot out of date
+    version = dose_versions.current()
+
+    data = await storage.run(plot_data, db, message, duration, plot_users, date_high)
+    if data == None:
+        return None
 
-    locs = []
-    labels = []
+    if render_executor == None:
+        # The storage and metrics threads are already running, so the workers aren't forked from this process
+        render_executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context(RENDER_START_METHOD))
+        render_slots = asyncio.Semaphore(RENDER_WORKERS)
 
-    for i in range(len(t_vals)):
-        date = datetime.datetime.fromtimestamp(
-            t_vals[i], tz=tz.gettz('Europe/Helsinki'))
-        if (date.second+date.minute*60+date.hour*60*60) % spacing == 0:
-            labels.append(date.strftime('%H:%M'))
-            locs.append(t_vals[i])
+    async with render_slots:
+        loop = asyncio.get_running_loop()
+        with phase('render'):
+            png = await loop.run_in_executor(render_executor, render_plot, data)
 
-    plt.xticks(locs, labels, rotation=0)
-    plt.tight_layout()
-    plt.savefig(PLOT_PATH)
+    keys = data['users'] + ([gid] if gid != None else [])
+    plot_cache.set(key, {'png': png, 'keys': keys, 'version': version})
 
-    return 1
+    return io.BytesIO(png)
@@ -0,0 +1,1136 @@
+import json
+import sqlite3
+import threading
+import datetime
+
+from .util import delete_collection
+from .tracing import TracedClient, unwrap, record_writes
+
+# Firestore allows at most 10 values in an 'in' filter
+IN_QUERY_MAX_VALUES = 10
+MAX_TIMESTAMP = 90000000000
+DEFAULT_SQLITE_PATH = 'data/larvinen.db'
+# Doses of one UTC day are kept in one bucket document in the bucketed Firestore layout
+BUCKET_SECONDS = 24*60*60
+BUCKET_FIELDS = ['timestamp', 'pure_alcohol', 'volume', 'alcohol', 'drink']
+# Doses copied per committed batch when migrating, Firestore allows 500 writes per batch
+MIGRATION_BATCH_DOSES = 400
+# Doses, or buckets in the bucketed layout, read per page when streaming doses
+DOSE_PAGE_SIZE = 200
+DOSE_PAGE_BUCKETS = 31
+
+
+class Repository():
+    """The stored users, their doses and the basic drinks. Subclasses implement the operations for a specific database
+    """
+
+    def get_user(self, uid):
+        """Gets a user document
+
+        Args:
+            uid (str): The id of the user
+
+        Returns:
+            dict: A dictionary representing the user, None if the user doesn't exist
+        """
+
+        raise NotImplementedError
+
+    def get_users(self, uids):
+        """Gets several user documents at once
+
+        Args:
+            uids (list): A list of user ids
+
+        Returns:
+            dict: A dictionary of user documents keyed by the string user id, None for users that don't exist
+        """
+
+        raise NotImplementedError
+
+    def set_user(self, uid, data):
+        """Creates or replaces a user document
+
+        Args:
+            uid (str): The id of the user
+            data (dict): A dictionary representing the user
+        """
+
+        raise NotImplementedError
+
+    def update_user(self, uid, changes):
+        """Updates fields of an existing user document
+
+        Args:
+            uid (str): The id of the user
+            changes (dict): A dictionary of the changed fields keyed by field paths, e.g. guilds.`123`.nick
+        """
+
+        raise NotImplementedError
+
+    def delete_user(self, uid):
+        """Deletes a user document along with the user's doses
+
+        Args:
+            uid (str): The id of the user
+        """
+
+        raise NotImplementedError
+
+    def stream_users(self):
+        """Iterates over all user documents
+
+        Returns:
+            iterator: An iterator of (user id, user document) tuples
+        """
+
+        raise NotImplementedError
+
+    def get_guild_users(self, gid, names=None):
+        """Gets the users that are members of a guild
+
+        Args:
+            gid (int): The id of the guild
+            names (list): A list of nicks or names to limit the users to
+                (default None)
+
+        Returns:
+            list: A list of string user ids
+        """
+
+        raise NotImplementedError
+
+    def get_active_users(self, gid, time_low, time_high):
+        """Gets the users that have a dose visible in a guild between time_low and time_high, limits included
+
+        Args:
+            gid (str): The id of the guild, or 'private'
+            time_low (float): A float defining the lower limit for the dose timestamps
+            time_high (float): A float defining the upper limit for the dose timestamps
+
+        Returns:
+            set: A set of string user ids
+        """
+
+        raise NotImplementedError
+
+    def get_doses(self, uid, time_low, time_high=None):
+        """Gets user's doses between time_low and time_high, limits excluded
+
+        Args:
+            uid (str): The id of the user
+            time_low (float): A float defining the lower limit for the dose timestamps
+            time_high (float): A float defining the upper limit for the dose timestamps
+                (default None, no upper limit)
+
+        Returns:
+            dict: A dictionary of the doses keyed by the dose id, ordered by the timestamps
+        """
+
+        raise NotImplementedError
+
+    def get_doses_by_uids(self, uids, time_low, time_high=None):
+        """Gets several users' doses between time_low and time_high, limits excluded
+
+        Args:
+            uids (list): A list of user ids
+            time_low (float): A float defining the lower limit for the dose timestamps
+            time_high (float): A float defining the upper limit for the dose timestamps
+                (default None, no upper limit)
+
+        Returns:
+            dict: A dictionary having a dictionary of doses per string user id
+        """
+
+        raise NotImplementedError
+
+    def stream_doses(self, uid, time_low, time_high=None):
+        """Reads user's doses between time_low and time_high, limits excluded, a page at a time. Only one page is
+        held in memory, so the range can span the user's whole history
+
+        Args:
+            uid (str): The id of the user
+            time_low (float): A float defining the lower limit for the dose timestamps
+            time_high (float): A float defining the upper limit for the dose timestamps
+                (default None, no upper limit)
+
+        Yields:
+            list: A list of (dose id, dose) tuples ordered by the timestamps
+        """
+
+        raise NotImplementedError
+
+    def get_previous_dose(self, uid, time_low=0, time_high=MAX_TIMESTAMP, guild=None):
+        """Gets user's latest dose between time_low and time_high, limits included
+
+        Args:
+            uid (str): The id of the user
+            time_low (float): A float defining the lower limit for the dose timestamp
+                (default 0)
+            time_high (float): A float defining the upper limit for the dose timestamp
+                (default MAX_TIMESTAMP)
+            guild (str): The id of a guild the dose has to be visible in
+                (default None, any dose)
+
+        Returns:
+            dict: A dictionary having the dose keyed by its id, empty if there is no such dose
+        """
+
+        raise NotImplementedError
+
+    def set_dose(self, uid, dose_id, dose):
+        """Creates or replaces a dose
+
+        Args:
+            uid (str): The id of the user
+            dose_id (str): The id of the dose
+            dose (dict): A dictionary representing the dose
+        """
+
+        raise NotImplementedError
+
+    def delete_dose(self, uid, dose_id):
+        """Deletes a dose
+
+        Args:
+            uid (str): The id of the user
+            dose_id (str): The id of the dose
+        """
+
+        raise NotImplementedError
+
+    def get_rollups(self, uid, day_low, day_high):
+        """Gets user's daily rollups between day_low and day_high, limits included
+
+        Args:
+            uid (str): The id of the user
+            day_low (str): The first day as an ISO date
+            day_high (str): The last day as an ISO date
+
+        Returns:
+            dict: A dictionary of the rollups keyed by the ISO dates, ordered by the dates
+        """
+
+        raise NotImplementedError
+
+    def get_rollups_by_uids(self, uids, day_low, day_high):
+        """Gets several users' daily rollups between day_low and day_high, limits included
+
+        Args:
+            uids (list): A list of user ids
+            day_low (str): The first day as an ISO date
+            day_high (str): The last day as an ISO date
+
+        Returns:
+            dict: A dictionary having a dictionary of rollups per string user id
+        """
+
+        raise NotImplementedError
+
+    def set_rollup(self, uid, day, rollup):
+        """Creates or replaces a daily rollup
+
+        Args:
+            uid (str): The id of the user
+            day (str): The day as an ISO date
+            rollup (dict): A dictionary having the aggregates of the day
+        """
+
+        raise NotImplementedError
+
+    def get_basic_drink(self, name):
+        """Gets a basic drink
+
+        Args:
+            name (str): The name of the drink, starting with %
+
+        Returns:
+            dict: A dictionary having the volume and alcohol of the drink, None if there is no such drink
+        """
+
+        raise NotImplementedError
+
+    def get_basic_drinks(self):
+        """Gets all basic drinks
+
+        Returns:
+            dict: A dictionary of the drinks keyed by their names
+        """
+
+        raise NotImplementedError
+
+    def set_basic_drink(self, name, drink):
+        """Creates or replaces a basic drink
+
+        Args:
+            name (str): The name of the drink, starting with %
+            drink (dict): A dictionary having the volume and alcohol of the drink
+        """
+
+        raise NotImplementedError
+
+    def watch_basic_drinks(self, callback):
+        """Starts following the changes of the basic drinks made by other processes
+
+        Args:
+            callback (function): A function called with a dictionary of all drinks keyed by their names whenever
+                they change
+
+        Returns:
+            object: A handle of the listener, None if the database doesn't notify about changes
+        """
+
+        return None
+
+    def batch(self):
+        """Starts a batch of writes that are committed at once
+
+        Returns:
+            object: A batch having set_user, update_user, set_dose, set_rollup, set_basic_drink and commit methods
+        """
+
+        raise NotImplementedError
+
+
+class FirestoreRepository(Repository):
+    """Users, doses and basic drinks stored in Google Firestore. Doses are kept in a doses subcollection of each user
+    """
+
+    def __init__(self, client=None):
+        """Initialize the Firestore repository
+
+        Args:
+            client (firestore.Client): The Firestore client
+                (default None, a client is created from the environment)
+        """
+
+        from google.cloud import firestore
+
+        self.client = TracedClient(
+            firestore.Client() if client == None else client)
+
+    def users(self):
+        return self.client.collection('users')
+
+    def doses(self, uid):
+        return self.users().document(str(uid)).collection('doses')
+
+    def rollups(self, uid):
+        return self.users().document(str(uid)).collection('rollups')
+
+    def get_user(self, uid):
+        return self.users().document(str(uid)).get().to_dict()
+
+    def get_users(self, uids):
+        refs = [self.users().document(str(uid)) for uid in uids]
+        return {snapshot.id: snapshot.to_dict() for snapshot in self.client.get_all(refs)}
+
+    def set_user(self, uid, data):
+        self.users().document(str(uid)).set(data)
+
+    def update_user(self, uid, changes):
+        self.users().document(str(uid)).update(changes)
+
+    def delete_user(self, uid):
+        delete_collection(self.doses(uid), 16)
+        delete_collection(self.users().document(
+            str(uid)).collection('dose_buckets'), 16)
+        delete_collection(self.rollups(uid), 16)
+        self.users().document(str(uid)).delete()
+
+    def stream_users(self):
+        for user in self.users().stream():
+            yield user.id, user.to_dict()
+
+    def get_guild_users(self, gid, names=None):
+        users = []
+
+        if names != None:
+            nick_ref = self.users().where(
+                f'guilds.`{gid}`.nick', 'in', names).stream()
+
+            for user in nick_ref:
+                users.append(user.id)
+
+            # Only one in, not-in, array_contains_any per query
+            name_ref = self.users().where(f'guilds.`{gid}`.member', '==', True).where(
+                f'guilds.`{gid}`.nick', '==', None).where('name', 'in', names).stream()
+
+            for user in name_ref:
+                if user.id not in users:
+                    users.append(user.id)
+        else:
+            users_ref = self.users().where(
+                f'guilds.`{gid}`.member', '==', True).stream()
+
+            for user in users_ref:
+                users.append(user.id)
+
+        return users
+
+    def get_active_users(self, gid, time_low, time_high):
+        # One collection group query over all users' doses, needs a composite index on guild and timestamp
+        doses_ref = self.client.collection_group('doses').where('guild', 'array_contains', str(gid)).where(
+            'timestamp', '>=', time_low).where('timestamp', '<=', time_high).select(['user'])
+
+        return {dose.reference.parent.parent.id for dose in doses_ref.stream()}
+
+    def get_doses(self, uid, time_low, time_high=None):
+        doses_ref = self.doses(uid).where('timestamp', '>', time_low)
+        if time_high != None:
+            doses_ref = doses_ref.where('timestamp', '<', time_high)
+
+        return {dose.id: dose.to_dict() for dose in doses_ref.stream()}
+
+    def get_doses_by_uids(self, uids, time_low, time_high=None):
+        uids = [str(uid) for uid in uids]
+        doses = {uid: {} for uid in uids}
+
+        for i in range(0, len(uids), IN_QUERY_MAX_VALUES):
+            doses_ref = self.client.collection_group('doses').where(
+                'user', 'in', uids[i:i+IN_QUERY_MAX_VALUES]).where('timestamp', '>', time_low)
+
+            if time_high != None:
+                doses_ref = doses_ref.where('timestamp', '<', time_high)
+
+            for dose in doses_ref.stream():
+                doses[dose.reference.parent.parent.id][dose.id] = dose.to_dict()
+
+        return doses
+
+    def stream_doses(self, uid, time_low, time_high=None):
+        doses_ref = self.doses(uid).where('timestamp', '>', time_low)
+        if time_high != None:
+            doses_ref = doses_ref.where('timestamp', '<', time_high)
+
+        doses_ref = doses_ref.order_by('timestamp').limit(DOSE_PAGE_SIZE)
+        page_ref = doses_ref
+
+        while True:
+            page = list(page_ref.stream())
+            if len(page) > 0:
+                yield [(dose.id, dose.to_dict()) for dose in page]
+
+            if len(page) < DOSE_PAGE_SIZE:
+                return
+
+            page_ref = doses_ref.start_after(page[-1])
+
+    def get_previous_dose(self, uid, time_low=0, time_high=MAX_TIMESTAMP, guild=None):
+        from google.cloud import firestore
+
+        doses_ref = self.doses(uid).where('timestamp', '>=', time_low).where(
+            'timestamp', '<=', time_high)
+
+        if guild != None:
+            doses_ref = doses_ref.where('guild', 'array_contains', guild)
+
+        doses_ref = doses_ref.order_by(
+            'timestamp', direction=firestore.Query.DESCENDING).limit(1)
+
+        return {dose.id: dose.to_dict() for dose in doses_ref.stream()}
+
+    def set_dose(self, uid, dose_id, dose):
+        self.doses(uid).document(dose_id).set(dose)
+
+    def delete_dose(self, uid, dose_id):
+        self.doses(uid).document(dose_id).delete()
+
+    def get_rollups(self, uid, day_low, day_high):
+        rollups_ref = self.rollups(uid).where('day', '>=', day_low).where(
+            'day', '<=', day_high).order_by('day')
+
+        return {rollup.id: rollup.to_dict() for rollup in rollups_ref.stream()}
+
+    def get_rollups_by_uids(self, uids, day_low, day_high):
+        uids = [str(uid) for uid in uids]
+        rollups = {uid: {} for uid in uids}
+
+        for i in range(0, len(uids), IN_QUERY_MAX_VALUES):
+            rollups_ref = self.client.collection_group('rollups').where(
+                'user', 'in', uids[i:i+IN_QUERY_MAX_VALUES]).where('day', '>=', day_low).where('day', '<=', day_high).order_by('day')
+
+            for rollup in rollups_ref.stream():
+                rollups[rollup.reference.parent.parent.id][rollup.id] = rollup.to_dict()
+
+        return rollups
+
+    def set_rollup(self, uid, day, rollup):
+        self.rollups(uid).document(day).set(
+            dict(rollup, day=day, user=str(uid)))
+
+    def get_basic_drink(self, name):
+        return self.client.collection('basic_drinks').document(name).get().to_dict()
+
+    def get_basic_drinks(self):
+        return {drink.id: drink.to_dict() for drink in self.client.collection('basic_drinks').stream()}
+
+    def set_basic_drink(self, name, drink):
+        self.client.collection('basic_drinks').document(name).set(drink)
+
+    def watch_basic_drinks(self, callback):
+        return self.client.collection('basic_drinks').on_snapshot(
+            lambda snapshots, changes, read_time: callback({drink.id: drink.to_dict() for drink in snapshots}))
+
+    def batch(self):
+        return FirestoreBatch(self)
+
+
+class FirestoreBatch():
+    """Writes committed at once with a Firestore WriteBatch
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.batch = repository.client.batch()
+
+    def set_user(self, uid, data):
+        self.batch.set(self.repository.users().document(str(uid)), data)
+
+    def update_user(self, uid, changes):
+        self.batch.update(self.repository.users().document(str(uid)), changes)
+
+    def set_dose(self, uid, dose_id, dose):
+        self.batch.set(self.repository.doses(uid).document(dose_id), dose)
+
+    def set_rollup(self, uid, day, rollup):
+        self.batch.set(self.repository.rollups(uid).document(
+            day), dict(rollup, day=day, user=str(uid)))
+
+    def set_basic_drink(self, name, drink):
+        self.batch.set(self.repository.client.collection(
+            'basic_drinks').document(name), drink)
+
+    def commit(self):
+        self.batch.commit()
+
+
+class FirestoreBucketRepository(FirestoreRepository):
+    """Users, doses and basic drinks stored in Google Firestore, with the doses of each user and UTC day kept in one
+    bucket document of parallel arrays. Reading a window of doses takes a document per day instead of one per dose
+    """
+
+    def buckets(self, uid):
+        return self.users().document(str(uid)).collection('dose_buckets')
+
+    def bucket_ref(self, uid, timestamp):
+        day = datetime.datetime.utcfromtimestamp(
+            timestamp).strftime('%Y-%m-%d')
+        return self.buckets(uid).document(day)
+
+    def get_doses(self, uid, time_low, time_high=None):
+        buckets_ref = self.buckets(uid).where('start', '>', time_low-BUCKET_SECONDS).where(
+            'start', '<', time_high if time_high != None else MAX_TIMESTAMP)
+
+        return bucket_doses([bucket.to_dict() for bucket in buckets_ref.stream()], time_low, time_high)
+
+    def get_doses_by_uids(self, uids, time_low, time_high=None):
+        uids = [str(uid) for uid in uids]
+        buckets = {uid: [] for uid in uids}
+
+        for i in range(0, len(uids), IN_QUERY_MAX_VALUES):
+            buckets_ref = self.client.collection_group('dose_buckets').where(
+                'user', 'in', uids[i:i+IN_QUERY_MAX_VALUES]).where('start', '>', time_low-BUCKET_SECONDS).where(
+                'start', '<', time_high if time_high != None else MAX_TIMESTAMP)
+
+            for bucket in buckets_ref.stream():
+                buckets[bucket.reference.parent.parent.id].append(
+                    bucket.to_dict())
+
+        return {uid: bucket_doses(buckets[uid], time_low, time_high) for uid in uids}
+
+    def stream_doses(self, uid, time_low, time_high=None):
+        buckets_ref = self.buckets(uid).where('start', '>', time_low-BUCKET_SECONDS).where(
+            'start', '<', time_high if time_high != None else MAX_TIMESTAMP).order_by('start').limit(DOSE_PAGE_BUCKETS)
+        page_ref = buckets_ref
+
+        while True:
+            page = list(page_ref.stream())
+            doses = bucket_doses([bucket.to_dict()
+                                 for bucket in page], time_low, time_high)
+            if len(doses) > 0:
+                yield list(doses.items())
+
+            if len(page) < DOSE_PAGE_BUCKETS:
+                return
+
+            page_ref = buckets_ref.start_after(page[-1])
+
+    def get_previous_dose(self, uid, time_low=0, time_high=MAX_TIMESTAMP, guild=None):
+        from google.cloud import firestore
+
+        buckets_ref = self.buckets(uid).where('start', '>', time_low-BUCKET_SECONDS).where(
+            'start', '<=', time_high)
+
+        if guild != None:
+            buckets_ref = buckets_ref.where('guild', 'array_contains', guild)
+
+        buckets_ref = buckets_ref.order_by(
+            'start', direction=firestore.Query.DESCENDING)
+
+        # The latest buckets may only have doses after time_high, so they are read one by one until a dose is found
+        for bucket in buckets_ref.stream():
+            doses = bucket_doses([bucket.to_dict()],
+                                 time_low, time_high, guild, inclusive=True)
+            if len(doses) > 0:
+                return dict(list(doses.items())[-1:])
+
+        return {}
+
+    def get_active_users(self, gid, time_low, time_high):
+        buckets_ref = self.client.collection_group('dose_buckets').where('guild', 'array_contains', str(gid)).where(
+            'start', '>', time_low-BUCKET_SECONDS).where('start', '<=', time_high)
+
+        users = set()
+        for bucket in buckets_ref.stream():
+            if len(bucket_doses([bucket.to_dict()], time_low, time_high, str(gid), inclusive=True)) > 0:
+                users.add(bucket.reference.parent.parent.id)
+
+        return users
+
+    def set_dose(self, uid, dose_id, dose):
+        batch = self.batch()
+        batch.set_dose(uid, dose_id, dose)
+        batch.commit()
+
+    def delete_dose(self, uid, dose_id):
+        from google.cloud import firestore
+
+        # The bucket is read again in a transaction, which Firestore retries if the bucket changes meanwhile
+        @firestore.transactional
+        def remove(transaction, bucket_ref):
+            bucket = bucket_ref.get(transaction=transaction).to_dict()
+            if bucket == None or dose_id not in bucket['ids']:
+                return
+
+            remaining = bucket_remove(bucket, dose_id)
+            if len(remaining['ids']) > 0:
+                transaction.set(unwrap(bucket_ref), remaining)
+            else:
+                transaction.delete(unwrap(bucket_ref))
+
+        for bucket in self.buckets(uid).where('ids', 'array_contains', dose_id).stream():
+            remove(self.client.transaction(), bucket.reference)
+            record_writes([bucket.reference])
+
+    def batch(self):
+        return FirestoreBucketBatch(self)
+
+
+class FirestoreBucketBatch(FirestoreBatch):
+    """Writes committed at once in a Firestore transaction. Every bucket a batch adds doses to is read in the
+    transaction and written once, so the doses other writers add to the same bucket meanwhile aren't lost
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.batch = PendingWrites()
+        self.buckets = {}
+
+    def set_dose(self, uid, dose_id, dose):
+        bucket_ref = self.repository.bucket_ref(uid, dose['timestamp'])
+        self.buckets.setdefault(bucket_ref.path, (bucket_ref, uid, []))[
+            2].append((dose_id, dose))
+
+    def commit(self):
+        from google.cloud import firestore
+
+        # Firestore runs the function again if a bucket changes before the commit
+        @firestore.transactional
+        def write(transaction):
+            buckets = []
+            for bucket_ref, uid, doses in self.buckets.values():
+                bucket = bucket_ref.get(transaction=transaction).to_dict()
+                for dose_id, dose in doses:
+                    bucket = bucket_add(bucket, uid, dose_id, dose)
+
+                buckets.append((bucket_ref, bucket))
+
+            # All reads of a transaction come before its writes
+            for bucket_ref, bucket in buckets:
+                transaction.set(unwrap(bucket_ref), bucket)
+
+            self.batch.apply(transaction)
+
+        write(self.repository.client.transaction())
+        record_writes([bucket_ref for bucket_ref, _, _ in self.buckets.values()] + self.batch.refs())
+
+
+class PendingWrites():
+    """Writes kept until they are applied to a Firestore transaction, which may run them several times
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, *args, **kwargs):
+        self.writes.append(('set', ref, args, kwargs))
+
+    def update(self, ref, *args, **kwargs):
+        self.writes.append(('update', ref, args, kwargs))
+
+    def delete(self, ref, *args, **kwargs):
+        self.writes.append(('delete', ref, args, kwargs))
+
+    def apply(self, transaction):
+        for method, ref, args, kwargs in self.writes:
+            getattr(transaction, method)(unwrap(ref), *args, **kwargs)
+
+    def refs(self):
+        return [ref for _, ref, _, _ in self.writes]
+
+
+def bucket_add(bucket, uid, dose_id, dose):
+    """Adds a dose to a bucket, replacing a dose having the same id
+
+    Args:
+        bucket (dict): The bucket document, None for a new bucket
+        uid (str): The id of the user
+        dose_id (str): The id of the dose
+        dose (dict): A dictionary representing the dose
+
+    Returns:
+        dict: The new bucket document
+    """
+
+    doses = bucket_doses([bucket] if bucket != None else [], -1)
+    doses[dose_id] = dose
+    doses = sorted(doses.items(), key=lambda item: (
+        item[1]['timestamp'], item[0]))
+
+    bucket = {'user': str(uid), 'start': int(dose['timestamp']//BUCKET_SECONDS*BUCKET_SECONDS),
+              'ids': [id for id, _ in doses],
+              'guilds': [','.join(dose.get('guild', [])) for _, dose in doses],
+              'guild': sorted({guild for _, dose in doses for guild in dose.get('guild', [])})}
+
+    for field in BUCKET_FIELDS:
+        bucket[field] = [dose.get(field) for _, dose in doses]
+
+    return bucket
+
+
+def bucket_remove(bucket, dose_id):
+    """Removes a dose from a bucket
+
+    Args:
+        bucket (dict): The bucket document
+        dose_id (str): The id of the dose
+
+    Returns:
+        dict: The new bucket document
+    """
+
+    keep = [i for i, id in enumerate(bucket['ids']) if id != dose_id]
+
+    remaining = dict(bucket)
+    for field in BUCKET_FIELDS + ['ids', 'guilds']:
+        remaining[field] = [bucket[field][i] for i in keep]
+
+    remaining['guild'] = sorted({guild for guilds in remaining['guilds']
+                                 for guild in guilds.split(',') if guild != ''})
+
+    return remaining
+
+
+def bucket_doses(buckets, time_low, time_high=None, guild=None, inclusive=False):
+    """Unpacks the doses of buckets between time_low and time_high
+
+    Args:
+        buckets (list): A list of bucket documents
+        time_low (float): A float defining the lower limit for the dose timestamps
+        time_high (float): A float defining the upper limit for the dose timestamps
+            (default None, no upper limit)
+        guild (str): The id of a guild the doses have to be visible in
+            (default None, any dose)
+        inclusive (bool): A boolean defining whether the limits are included
+            (default False)
+
+    Returns:
+        dict: A dictionary of the doses keyed by the dose id, ordered by the timestamps
+    """
+
+    time_high = MAX_TIMESTAMP if time_high == None else time_high
+
+    doses = []
+    for bucket in buckets:
+        for i, dose_id in enumerate(bucket['ids']):
+            dose = {field: bucket[field][i] for field in BUCKET_FIELDS}
+            dose['user'] = bucket['user']
+            dose['guild'] = [
+                guild for guild in bucket['guilds'][i].split(',') if guild != '']
+
+            if inclusive:
+                in_range = time_low <= dose['timestamp'] <= time_high
+            else:
+                in_range = time_low < dose['timestamp'] < time_high
+
+            if in_range and (guild == None or guild in dose['guild']):
+                doses.append((dose_id, dose))
+
+    return dict(sorted(doses, key=lambda item: (item[1]['timestamp'], item[0])))
+
+
+class SQLiteRepository(Repository):
+    """Users, doses and basic drinks stored in a local SQLite database, or in memory with path ':memory:'
+    """
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        """Initialize the SQLite repository and create the tables
+
+        Args:
+            path (str): The path of the database file
+                (default DEFAULT_SQLITE_PATH)
+        """
+
+        # The connection is shared by the storage threads, one statement at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id text PRIMARY KEY,
+                    name text,
+                    data text NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS user_guilds (
+                    user text NOT NULL,
+                    guild text NOT NULL,
+                    nick text,
+                    member integer,
+                    PRIMARY KEY (user, guild)
+                );
+                CREATE INDEX IF NOT EXISTS user_guilds_guild ON user_guilds (guild, member, nick);
+                CREATE TABLE IF NOT EXISTS doses (
+                    user text NOT NULL,
+                    id text NOT NULL,
+                    timestamp integer NOT NULL,
+                    data text NOT NULL,
+                    PRIMARY KEY (user, id)
+                );
+                CREATE INDEX IF NOT EXISTS doses_user_timestamp ON doses (user, timestamp);
+                CREATE TABLE IF NOT EXISTS dose_guilds (
+                    guild text NOT NULL,
+                    timestamp integer NOT NULL,
+                    user text NOT NULL,
+                    dose text NOT NULL,
+                    PRIMARY KEY (guild, timestamp, user, dose)
+                );
+                CREATE INDEX IF NOT EXISTS dose_guilds_dose ON dose_guilds (user, dose);
+                CREATE TABLE IF NOT EXISTS rollups (
+                    user text NOT NULL,
+                    day text NOT NULL,
+                    data text NOT NULL,
+                    PRIMARY KEY (user, day)
+                );
+                CREATE TABLE IF NOT EXISTS basic_drinks (
+                    name text PRIMARY KEY,
+                    volume real,
+                    alcohol real
+                );
+            """)
+
+    def get_user(self, uid):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM users WHERE id = ?', (str(uid),)).fetchone()
+
+        return json.loads(row[0]) if row != None else None
+
+    def get_users(self, uids):
+        uids = [str(uid) for uid in uids]
+        users = {uid: None for uid in uids}
+
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT id, data FROM users WHERE id IN ({",".join("?"*len(uids))})', uids).fetchall()
+
+        for uid, data in rows:
+            users[uid] = json.loads(data)
+
+        return users
+
+    def set_user(self, uid, data):
+        with self.lock, self.connection:
+            self._set_user(uid, data)
+
+    def _set_user(self, uid, data):
+        self.connection.execute('INSERT OR REPLACE INTO users (id, name, data) VALUES (?, ?, ?)',
+                                (str(uid), data.get('name'), json.dumps(data)))
+        self.connection.execute(
+            'DELETE FROM user_guilds WHERE user = ?', (str(uid),))
+        self.connection.executemany('INSERT INTO user_guilds (user, guild, nick, member) VALUES (?, ?, ?, ?)',
+                                    [(str(uid), gid, guild.get('nick'), guild.get('member'))
+                                     for gid, guild in (data.get('guilds') or {}).items()])
+
+    def update_user(self, uid, changes):
+        with self.lock, self.connection:
+            self._update_user(uid, changes)
+
+    def _update_user(self, uid, changes):
+        row = self.connection.execute(
+            'SELECT data FROM users WHERE id = ?', (str(uid),)).fetchone()
+        if row == None:
+            raise KeyError(f'No user {uid} to update')
+
+        data = json.loads(row[0])
+        for field, value in changes.items():
+            # Firestore style field paths, e.g. guilds.`123`.nick
+            path = [key.strip('`') for key in field.split('.')]
+            target = data
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+        self._set_user(uid, data)
+
+    def delete_user(self, uid):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM dose_guilds WHERE user = ?', (str(uid),))
+            self.connection.execute(
+                'DELETE FROM doses WHERE user = ?', (str(uid),))
+            self.connection.execute(
+                'DELETE FROM rollups WHERE user = ?', (str(uid),))
+            self.connection.execute(
+                'DELETE FROM user_guilds WHERE user = ?', (str(uid),))
+            self.connection.execute(
+                'DELETE FROM users WHERE id = ?', (str(uid),))
+
+    def stream_users(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, data FROM users ORDER BY id').fetchall()
+
+        for uid, data in rows:
+            yield uid, json.loads(data)
+
+    def get_guild_users(self, gid, names=None):
+        with self.lock:
+            if names != None:
+                marks = ",".join("?"*len(names))
+                rows = self.connection.execute(f"""SELECT user FROM user_guilds WHERE guild = ? AND nick IN ({marks})
+                    UNION SELECT g.user FROM user_guilds g JOIN users u ON u.id = g.user
+                    WHERE g.guild = ? AND g.member = 1 AND g.nick IS NULL AND u.name IN ({marks})
+                    ORDER BY user""", [str(gid)] + list(names) + [str(gid)] + list(names)).fetchall()
+            else:
+                rows = self.connection.execute(
+                    'SELECT user FROM user_guilds WHERE guild = ? AND member = 1 ORDER BY user', (str(gid),)).fetchall()
+
+        return [row[0] for row in rows]
+
+    def get_active_users(self, gid, time_low, time_high):
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT user FROM dose_guilds WHERE guild = ? AND timestamp >= ? AND timestamp <= ?',
+                                           (str(gid), time_low, time_high)).fetchall()
+
+        return {row[0] for row in rows}
+
+    def get_doses(self, uid, time_low, time_high=None):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, data FROM doses WHERE user = ? AND timestamp > ? AND timestamp < ? ORDER BY timestamp, id',
+                                           (str(uid), time_low, time_high if time_high != None else MAX_TIMESTAMP)).fetchall()
+
+        return {dose_id: json.loads(data) for dose_id, data in rows}
+
+    def get_doses_by_uids(self, uids, time_low, time_high=None):
+        uids = [str(uid) for uid in uids]
+        doses = {uid: {} for uid in uids}
+
+        with self.lock:
+            rows = self.connection.execute(f'SELECT user, id, data FROM doses WHERE user IN ({",".join("?"*len(uids))}) AND timestamp > ? AND timestamp < ? ORDER BY timestamp, id',
+                                           uids + [time_low, time_high if time_high != None else MAX_TIMESTAMP]).fetchall()
+
+        for uid, dose_id, data in rows:
+            doses[uid][dose_id] = json.loads(data)
+
+        return doses
+
+    def stream_doses(self, uid, time_low, time_high=None):
+        # Pages continue after the timestamp and id of the previous page's last dose
+        after = (time_low, '')
+
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT id, timestamp, data FROM doses WHERE user = ? AND (timestamp, id) > (?, ?) AND timestamp > ? AND timestamp < ? ORDER BY timestamp, id LIMIT ?',
+                                               (str(uid), *after, time_low, time_high if time_high != None else MAX_TIMESTAMP, DOSE_PAGE_SIZE)).fetchall()
+
+            if len(rows) > 0:
+                yield [(dose_id, json.loads(data)) for dose_id, _, data in rows]
+
+            if len(rows) < DOSE_PAGE_SIZE:
+                return
+
+            after = (rows[-1][1], rows[-1][0])
+
+    def get_previous_dose(self, uid, time_low=0, time_high=MAX_TIMESTAMP, guild=None):
+        with self.lock:
+            if guild != None:
+                row = self.connection.execute("""SELECT d.id, d.data FROM dose_guilds g JOIN doses d ON d.user = g.user AND d.id = g.dose
+                    WHERE g.guild = ? AND g.user = ? AND g.timestamp >= ? AND g.timestamp <= ? ORDER BY g.timestamp DESC LIMIT 1""",
+                                              (guild, str(uid), time_low, time_high)).fetchone()
+            else:
+                row = self.connection.execute('SELECT id, data FROM doses WHERE user = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp DESC LIMIT 1',
+                                              (str(uid), time_low, time_high)).fetchone()
+
+        return {row[0]: json.loads(row[1])} if row != None else {}
+
+    def set_dose(self, uid, dose_id, dose):
+        with self.lock, self.connection:
+            self._set_dose(uid, dose_id, dose)
+
+    def _set_dose(self, uid, dose_id, dose):
+        self._delete_dose(uid, dose_id)
+        self.connection.execute('INSERT INTO doses (user, id, timestamp, data) VALUES (?, ?, ?, ?)',
+                                (str(uid), dose_id, dose['timestamp'], json.dumps(dose)))
+        self.connection.executemany('INSERT OR IGNORE INTO dose_guilds (guild, timestamp, user, dose) VALUES (?, ?, ?, ?)',
+                                    [(guild, dose['timestamp'], str(uid), dose_id) for guild in dose.get('guild', [])])
+
+    def delete_dose(self, uid, dose_id):
+        with self.lock, self.connection:
+            self._delete_dose(uid, dose_id)
+
+    def _delete_dose(self, uid, dose_id):
+        self.connection.execute(
+            'DELETE FROM dose_guilds WHERE user = ? AND dose = ?', (str(uid), dose_id))
+        self.connection.execute(
+            'DELETE FROM doses WHERE user = ? AND id = ?', (str(uid), dose_id))
+
+    def get_rollups(self, uid, day_low, day_high):
+        return self.get_rollups_by_uids([uid], day_low, day_high)[str(uid)]
+
+    def get_rollups_by_uids(self, uids, day_low, day_high):
+        uids = [str(uid) for uid in uids]
+        rollups = {uid: {} for uid in uids}
+
+        with self.lock:
+            rows = self.connection.execute(f'SELECT user, day, data FROM rollups WHERE user IN ({",".join("?"*len(uids))}) AND day >= ? AND day <= ? ORDER BY day',
+                                           uids + [day_low, day_high]).fetchall()
+
+        for uid, day, data in rows:
+            rollups[uid][day] = json.loads(data)
+
+        return rollups
+
+    def set_rollup(self, uid, day, rollup):
+        with self.lock, self.connection:
+            self._set_rollup(uid, day, rollup)
+
+    def _set_rollup(self, uid, day, rollup):
+        self.connection.execute('INSERT OR REPLACE INTO rollups (user, day, data) VALUES (?, ?, ?)',
+                                (str(uid), day, json.dumps(rollup)))
+
+    def get_basic_drink(self, name):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT volume, alcohol FROM basic_drinks WHERE name = ?', (name,)).fetchone()
+
+        return {'volume': row[0], 'alcohol': row[1]} if row != None else None
+
+    def get_basic_drinks(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, volume, alcohol FROM basic_drinks ORDER BY name').fetchall()
+
+        return {name: {'volume': volume, 'alcohol': alcohol} for name, volume, alcohol in rows}
+
+    def set_basic_drink(self, name, drink):
+        with self.lock, self.connection:
+            self._set_basic_drink(name, drink)
+
+    def _set_basic_drink(self, name, drink):
+        self.connection.execute('INSERT OR REPLACE INTO basic_drinks (name, volume, alcohol) VALUES (?, ?, ?)',
+                                (name, drink['volume'], drink['alcohol']))
+
+    def batch(self):
+        return SQLiteBatch(self)
+
+
+class SQLiteBatch():
+    """Writes committed at once in a single SQLite transaction
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.writes = []
+
+    def set_user(self, uid, data):
+        self.writes.append(lambda: self.repository._set_user(uid, data))
+
+    def update_user(self, uid, changes):
+        self.writes.append(lambda: self.repository._update_user(uid, changes))
+
+    def set_dose(self, uid, dose_id, dose):
+        self.writes.append(
+            lambda: self.repository._set_dose(uid, dose_id, dose))
+
+    def set_rollup(self, uid, day, rollup):
+        self.writes.append(
+            lambda: self.repository._set_rollup(uid, day, rollup))
+
+    def set_basic_drink(self, name, drink):
+        self.writes.append(
+            lambda: self.repository._set_basic_drink(name, drink))
+
+    def commit(self):
+        with self.repository.lock, self.repository.connection:
+            for write in self.writes:
+                write()
+
+
+def connect(url=None):
+    """Creates the repository described by url
+
+    Args:
+        url (str): 'firestore', 'firestore:buckets', 'sqlite:<path>' or 'memory'
+            (default None, which means firestore)
+
+    Returns:
+        Repository: The repository
+    """
+
+    if url == None or url == 'firestore':
+        return FirestoreRepository()
+    elif url == 'firestore:buckets':
+        return FirestoreBucketRepository()
+    elif url == 'memory':
+        return SQLiteRepository(':memory:')
+    elif url.startswith('sqlite'):
+        return SQLiteRepository(url.split(':', 1)[1] if ':' in url else DEFAULT_SQLITE_PATH)
+
+    raise ValueError(f'Unknown storage {url}')
+
+
+def migrate_doses(source, target, delete=False):
+    """Copies every user's doses from one repository to another, e.g. from the dose documents of
+    FirestoreRepository to the buckets of FirestoreBucketRepository
+
+    Args:
+        source (Repository): The repository to copy the doses from
+        target (Repository): The repository to copy the doses to
+        delete (bool): A boolean defining whether to delete the copied doses from source
+            (default False)
+
+    Returns:
+        int: The number of copied doses
+    """
+
+    copied = 0
+
+    for uid, _ in source.stream_users():
+        doses = list(source.get_doses(uid, -1).items())
+
+        for i in range(0, len(doses), MIGRATION_BATCH_DOSES):
+            batch = target.batch()
+            for dose_id, dose in doses[i:i+MIGRATION_BATCH_DOSES]:
+                batch.set_dose(uid, dose_id, dose)
+            batch.commit()
+
+        if delete:
+            for dose_id, _ in doses:
+                source.delete_dose(uid, dose_id)
+
+        copied += len(doses)
+        print(f'Copied {len(doses)} doses of user {uid}')
+
+    return copied
@@ -0,0 +1,130 @@
+import datetime
+import numpy as np
+from dateutil import tz
+
+from . import bac
+
+# Days are calendar days in Finland, like the times on the plots
+ROLLUP_TIMEZONE = tz.gettz('Europe/Helsinki')
+ROLLUP_THRESHOLD_PER_MILLE = 0.5
+ROLLUP_NULL = {'pure_alcohol': 0.0, 'doses': 0,
+               'peak_per_mille': 0.0, 'seconds_over': 0.0}
+
+# Periods the daily rollups can be summed to, keyed by the %annokset parameter
+ROLLUP_PERIOD_FORMATS = {'päivät': '%Y-%m-%d', 'viikot': '%G-W%V',
+                         'kuukaudet': '%Y-%m', 'vuodet': '%Y'}
+
+
+def day_of(timestamp):
+    """Gets the day a timestamp falls in
+
+    Args:
+        timestamp (float): A unix timestamp
+
+    Returns:
+        str: The day as an ISO date, e.g. '2021-03-30'
+    """
+
+    return datetime.datetime.fromtimestamp(timestamp, tz=ROLLUP_TIMEZONE).strftime('%Y-%m-%d')
+
+
+def day_bounds(day):
+    """Gets the first moment of a day and of the day after it. Days are 23 or 25 hours long when the
+    daylight saving time changes
+
+    Args:
+        day (str): The day as an ISO date
+
+    Returns:
+        float: The unix timestamp of the start of the day
+        float: The unix timestamp of the start of the next day
+    """
+
+    date = datetime.date.fromisoformat(day)
+    next_date = date + datetime.timedelta(days=1)
+
+    start = datetime.datetime(
+        date.year, date.month, date.day, tzinfo=ROLLUP_TIMEZONE)
+    end = datetime.datetime(
+        next_date.year, next_date.month, next_date.day, tzinfo=ROLLUP_TIMEZONE)
+
+    return start.timestamp(), end.timestamp()
+
+
+def days_between(t_low, t_high):
+    """Gets the days between two timestamps, both included
+
+    Args:
+        t_low (float): The first unix timestamp
+        t_high (float): The last unix timestamp
+
+    Returns:
+        list: A list of ISO dates
+    """
+
+    day = datetime.date.fromisoformat(day_of(t_low))
+    last_day = datetime.date.fromisoformat(day_of(t_high))
+
+    days = []
+    while day <= last_day:
+        days.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+
+    return days
+
+
+def compute(t_doses, pure_alcohol, t_points, per_mille_points, days):
+    """Computes the daily rollups of a user
+
+    Args:
+        t_doses (np.array): Unix timestamps of the doses
+        pure_alcohol (np.array): Pure alcohol of the doses in centiliters
+        t_points (np.array): Ordered timestamps of the vertices of the per mille curve
+        per_mille_points (np.array): Per mille values at the vertices
+        days (list): The days to compute as ISO dates
+
+    Returns:
+        dict: A dictionary having the total pure alcohol, the number of doses, the peak per mille and the
+            seconds over ROLLUP_THRESHOLD_PER_MILLE per day
+    """
+
+    t_doses = np.asarray(t_doses, dtype=float)
+    pure_alcohol = np.asarray(pure_alcohol, dtype=float)
+
+    rollups = {}
+    for day in days:
+        t_start, t_end = day_bounds(day)
+        in_day = (t_doses >= t_start) & (t_doses < t_end)
+        t_day, values = bac.window(t_points, per_mille_points, t_start, t_end)
+
+        rollups[day] = {'pure_alcohol': float(np.sum(pure_alcohol[in_day])), 'doses': int(np.sum(in_day)),
+                        'peak_per_mille': float(np.max(values)),
+                        'seconds_over': bac.time_over(t_day, values, ROLLUP_THRESHOLD_PER_MILLE)}
+
+    return rollups
+
+
+def summarize(rollups, period):
+    """Sums daily rollups to longer periods
+
+    Args:
+        rollups (dict): Daily rollups keyed by ISO dates
+        period (str): One of ROLLUP_PERIOD_FORMATS
+
+    Returns:
+        dict: A dictionary of rollups keyed by the periods, in the order of the days
+    """
+
+    summary = {}
+    for day, rollup in rollups.items():
+        key = datetime.date.fromisoformat(
+            day).strftime(ROLLUP_PERIOD_FORMATS[period])
+        total = summary.setdefault(key, dict(ROLLUP_NULL))
+
+        total['pure_alcohol'] += rollup['pure_alcohol']
+        total['doses'] += rollup['doses']
+        total['peak_per_mille'] = max(
+            total['peak_per_mille'], rollup['peak_per_mille'])
+        total['seconds_over'] += rollup['seconds_over']
+
+    return summary
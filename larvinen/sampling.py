@@ -0,0 +1,256 @@
+import random
+import numpy as np
+
+from .cache import LRUCache
+
+# Filters matching a part of a text column, like 'tyyppi like %?%'
+TEXT_PARAMS = {'tyyppi': 'tyyppi', 'alatyyppi': 'alatyyppi',
+               'luonnehdinta': 'luonnehdinta'}
+# Filters limiting a number column, excluding the limit
+RANGE_PARAMS = {'hinta_min': ('hinta', 'min'), 'hinta_max': ('hinta', 'max'),
+                'vol_min': ('alkoholi', 'min'), 'vol_max': ('alkoholi', 'max')}
+
+# Failed random picks in a row before the products matching a range are listed exactly
+SAMPLER_REJECTION_TRIES = 32
+# Matching products kept per filter combination
+SAMPLER_CACHE_SIZE = 256
+
+
+class DrinkSampler():
+    """Picks random products of the standard selection matching the %suosittele filters. The products of each
+    value of the text columns are indexed when the catalogue loads, so a pick takes constant time instead of
+    sorting the matching rows of the catalogue. Ranges of price and alcohol are checked by rejection, and listed
+    exactly if few products fall in them"""
+
+    def __init__(self, connection):
+        """Initialize sampler
+
+        Args:
+            connection (sqlite3.Connection): Connection to the database having the juomat table
+        """
+
+        rows = connection.execute(
+            'SELECT id, tyyppi, alatyyppi, luonnehdinta, hinta, alkoholi FROM juomat WHERE valikoima == "vakiovalikoima" ORDER BY id').fetchall()
+
+        self.ids = np.array([row[0] for row in rows], dtype=int)
+
+        # Positions of the products per lower cased value of each text column, NULLs never match
+        self.text_index = {}
+        for i, column in enumerate(['tyyppi', 'alatyyppi', 'luonnehdinta']):
+            index = {}
+            for position, row in enumerate(rows):
+                if row[i+1] != None:
+                    index.setdefault(str(row[i+1]).lower(), []).append(position)
+
+            self.text_index[column] = {value: np.array(positions, dtype=int)
+                                       for value, positions in index.items()}
+
+        # NULLs are nan, which fails every comparison like NULL in SQL
+        self.numbers = {column: np.array([row[i] if row[i] != None else np.nan for row in rows], dtype=float)
+                        for i, column in [(4, 'hinta'), (5, 'alkoholi')]}
+
+        self.matches = LRUCache(SAMPLER_CACHE_SIZE)
+        self.random = random.Random()
+
+    def text_matches(self, column, text):
+        """Gets the products whose column contains text
+
+        Args:
+            column (str): The text column
+            text (str): The lower cased text
+
+        Returns:
+            np.array: Ordered positions of the products
+        """
+
+        positions = [positions for value, positions in self.text_index[column].items()
+                     if text in value]
+
+        return np.unique(np.concatenate(positions)) if len(positions) > 0 else np.array([], dtype=int)
+
+    def candidates(self, text_filters):
+        """Gets the products matching all text filters
+
+        Args:
+            text_filters (tuple): A tuple of (column, lower cased text) tuples
+
+        Returns:
+            np.array: Ordered positions of the products
+        """
+
+        positions = self.matches.get(text_filters)
+
+        if positions is None:
+            positions = np.arange(len(self.ids))
+            for column, text in text_filters:
+                positions = np.intersect1d(
+                    positions, self.text_matches(column, text), assume_unique=True)
+
+            self.matches.set(text_filters, positions)
+
+        return positions
+
+    def in_ranges(self, positions, ranges):
+        """Checks which products are within the ranges
+
+        Args:
+            positions (np.array or int): Positions of the products
+            ranges (tuple): A tuple of (column, 'min' or 'max', limit) tuples
+
+        Returns:
+            np.array or bool: True for the products within all ranges
+        """
+
+        inside = True
+        for column, side, limit in ranges:
+            values = self.numbers[column][positions]
+            inside = inside & ((values > limit) if side ==
+                               'min' else (values < limit))
+
+        return inside
+
+    def positions_of(self, ids):
+        """Gets the positions of products in the index
+
+        Args:
+            ids (np.array): Ordered ids of the products in juomat
+
+        Returns:
+            np.array: Ordered positions of the products, leaving out the products not in the index
+        """
+
+        positions = np.searchsorted(self.ids, ids)
+        positions = positions[positions < len(self.ids)]
+
+        return positions[self.ids[positions] == ids[:len(positions)]]
+
+    def sample(self, params, ids=None):
+        """Picks random products matching the filters, each product at most once
+
+        Args:
+            params (dict): A dictionary of the %suosittele filters
+            ids (np.array): Ordered ids of the products to pick from, e.g. the products in stock in a store
+                (default None, which means all products)
+
+        Raises:
+            ValueError: If a range limit isn't a number
+
+        Yields:
+            int: The id of a product in juomat, in uniformly random order
+        """
+
+        text_filters = tuple(sorted([(TEXT_PARAMS[param], params[param].lower())
+                                     for param in params if param in TEXT_PARAMS]))
+        ranges = tuple(sorted([(*RANGE_PARAMS[param], float(params[param]))
+                               for param in params if param in RANGE_PARAMS]))
+
+        positions = self.candidates(text_filters)
+        seen = set()
+
+        if ids is not None:
+            # The products are only a part of the catalogue, so the ranges are checked for all of them at once
+            positions = np.intersect1d(
+                positions, self.positions_of(ids), assume_unique=True)
+            if len(ranges) > 0:
+                positions = positions[self.in_ranges(positions, ranges)]
+
+        elif len(ranges) > 0:
+            exact = self.matches.get((text_filters, ranges))
+
+            # Rejection sampling is fast as long as a good part of the candidates is within the ranges
+            misses = 0
+            while exact is None and len(positions) > 0 and misses < SAMPLER_REJECTION_TRIES:
+                position = int(positions[self.random.randrange(len(positions))])
+
+                if position in seen or not self.in_ranges(position, ranges):
+                    misses += 1
+                    continue
+
+                misses = 0
+                seen.add(position)
+                yield int(self.ids[position])
+
+            if exact is None:
+                exact = positions[self.in_ranges(positions, ranges)]
+                self.matches.set((text_filters, ranges), exact)
+
+            positions = exact
+
+        if len(seen) > 0:
+            positions = positions[~np.isin(positions, list(seen))]
+
+        for position in shuffled(positions, self.random):
+            yield int(self.ids[position])
+
+
+def shuffled(values, rng):
+    """Iterates values in a random order without copying them. Each step of the Fisher-Yates shuffle
+    is taken when the next value is needed, and the swapped positions are kept in a dictionary
+
+    Args:
+        values (np.array): The values
+        rng (random.Random): The random number generator
+
+    Yields:
+        object: The values in a uniformly random order
+    """
+
+    swaps = {}
+    for i in range(len(values)):
+        j = rng.randrange(i, len(values))
+        yield values[swaps.get(j, j)]
+        swaps[j] = swaps.get(i, i)
+
+
+def benchmark(num_products=12000, repeats=5, number=200, seed=0):
+    """Compares picking random products with the sampler to ORDER BY RANDOM() on a generated catalogue
+
+    Args:
+        num_products (int): Number of products in the catalogue
+        repeats (int): How many times each case is timed, the best time is reported
+        number (int): How many picks are made in each timing
+        seed (int): Seed for generating the catalogue
+
+    """
+
+    import sqlite3
+    import timeit
+
+    rng = np.random.default_rng(seed)
+    types = ['punaviinit', 'valkoviinit', 'oluet', 'siiderit',
+             'viskit', 'liköörit', 'rommit', 'kuohuviinit']
+    subtypes = ['Täyteläinen', 'Kevyt', 'Pehmeä', 'Hapokas', 'Makea', 'Vahva']
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute(
+        'CREATE TABLE juomat (id integer PRIMARY KEY, numero text, nimi text, tyyppi text, alatyyppi text, luonnehdinta text, hinta real, alkoholi real, pullokoko real, valikoima text)')
+    connection.executemany('INSERT INTO juomat VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(i, str(100000+i), f'Tuote {i}', types[rng.integers(len(types))],
+                             subtypes[rng.integers(len(subtypes))], None, float(
+                                 rng.uniform(2, 80)),
+                             float(rng.uniform(0, 45)), 0.75,
+                             'vakiovalikoima' if rng.uniform() < 0.6 else 'tilausvalikoima') for i in range(num_products)])
+
+    sampler = DrinkSampler(connection)
+
+    cases = {'no filters': ({}, ''),
+             'type': ({'tyyppi': 'viinit'}, ' AND tyyppi like ?'),
+             'type and price': ({'tyyppi': 'oluet', 'hinta_max': '10'}, ' AND tyyppi like ? AND hinta < ?'),
+             'narrow range': ({'hinta_min': '75', 'vol_min': '40'}, ' AND hinta > ? AND alkoholi > ?')}
+
+    print(f'{"filters":>16}{"ORDER BY RANDOM() [ms]":>25}{"sampler [ms]":>15}{"speedup":>10}')
+    for label, (params, where) in cases.items():
+        values = [('%'+value+'%') if param in TEXT_PARAMS else value for param,
+                  value in params.items()]
+        query = f'SELECT id FROM juomat WHERE valikoima == "vakiovalikoima"{where} ORDER BY RANDOM() LIMIT 1'
+
+        t_query = min(timeit.repeat(lambda: connection.execute(
+            query, values).fetchone(), number=number, repeat=repeats))
+        t_sampler = min(timeit.repeat(lambda: next(
+            sampler.sample(params)), number=number, repeat=repeats))
+
+        print(f'{label:>16}{t_query/number*1000:>25.3f}{t_sampler/number*1000:>15.3f}{t_query/t_sampler:>10.1f}')
+
+
+if __name__ == "__main__":
+    benchmark()
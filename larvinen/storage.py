@@ -0,0 +1,86 @@
+import asyncio
+import functools
+import contextvars
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import phase
+
+# Maximum number of blocking database calls in flight at once
+STORAGE_WORKERS = 8
+
+executor = ThreadPoolExecutor(
+    max_workers=STORAGE_WORKERS, thread_name_prefix='storage')
+locks = weakref.WeakValueDictionary()
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking database call on the storage thread pool, so that the event loop keeps serving
+    other commands meanwhile. The call sees the context variables of the caller, e.g. the trace of the command
+
+    Args:
+        func (function): The blocking function to call
+        *args: Positional arguments of the function
+        **kwargs: Keyword arguments of the function
+
+    Returns:
+        object: The return value of the function
+    """
+
+    loop = asyncio.get_running_loop()
+    with phase('storage'):
+        return await loop.run_in_executor(executor, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+
+def lock(key):
+    """Gets a lock to serialize the commands modifying the same state, e.g. the same user
+
+    Args:
+        key (hashable): The key of the state, e.g. the user id
+
+    Returns:
+        asyncio.Lock: The lock of the key, alive while someone holds or waits for it
+    """
+
+    key_lock = locks.get(key)
+
+    if key_lock == None:
+        key_lock = asyncio.Lock()
+        locks[key] = key_lock
+
+    return key_lock
+
+
+def load_test(num_commands=100, latency_seconds=0.05):
+    """Compares the throughput of blocking database calls made on the event loop to calls made through run
+
+    Args:
+        num_commands (int): Number of simulated commands
+        latency_seconds (float): Simulated round trip time of one database call
+
+    """
+
+    import time
+
+    def blocking_call():
+        time.sleep(latency_seconds)
+
+    async def on_loop():
+        blocking_call()
+
+    async def off_loop():
+        await run(blocking_call)
+
+    async def load(handler):
+        start = time.monotonic()
+        await asyncio.gather(*[handler() for _ in range(num_commands)])
+        return time.monotonic() - start
+
+    print(f'{"mode":>10}{"time [s]":>12}{"commands/s":>14}')
+    for name, handler in [('on loop', on_loop), ('off loop', off_loop)]:
+        elapsed = asyncio.run(load(handler))
+        print(f'{name:>10}{elapsed:>12.2f}{num_commands/elapsed:>14.1f}')
+
+
+if __name__ == "__main__":
+    load_test()
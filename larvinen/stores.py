@@ -0,0 +1,153 @@
+import re
+import unicodedata
+from collections import Counter
+
+# Stores suggested for a name that matches several stores or none
+STORE_SUGGESTIONS = 5
+# Share of common trigrams needed for a misspelled name to match a store, and the lead it needs over the runner-up
+STORE_FUZZY_MIN_SIMILARITY = 0.4
+STORE_FUZZY_MIN_LEAD = 0.1
+# Stores sharing fewer trigrams with a misspelled name than this aren't suggested
+STORE_SUGGESTION_MIN_SIMILARITY = 0.2
+
+
+def fold(name):
+    """Normalizes a store name for matching. The name is lower cased, the diacritics are removed and everything
+    but letters and digits separates words, so 'Itä-Pasila' and 'ita pasila' are the same
+
+    Args:
+        name (str): The name
+
+    Returns:
+        str: The words of the name separated by single spaces
+    """
+
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = ''.join([char for char in name if not unicodedata.combining(char)])
+
+    return ' '.join(re.findall(r'[^\W_]+', name))
+
+
+def trigrams(key):
+    """Gets the trigrams of the words of a folded name, the words padded with spaces
+
+    Args:
+        key (str): The folded name
+
+    Returns:
+        set: The trigrams
+    """
+
+    grams = set()
+    for word in key.split(' '):
+        padded = f' {word} '
+        grams.update([padded[i:i+3] for i in range(len(padded)-2)])
+
+    return grams
+
+
+class StoreIndex():
+    """The Alko stores by their folded names. A name is resolved to one store if it is the name of the store, if its
+    words start the words of only that store's name, e.g. 'kamp' or 'hels kamppi', or if it is misspelled but
+    still clearly closest to that store's name. Otherwise the closest stores are suggested"""
+
+    def __init__(self, names):
+        """Initialize store index
+
+        Args:
+            names (list): The names of the stores as Alko writes them
+        """
+
+        self.names = list(dict.fromkeys(names))
+        self.keys = [fold(name) for name in self.names]
+        self.exact = {key: i for i, key in enumerate(self.keys)}
+
+        # A trie of the words of the names, each node having the stores with a word starting with its prefix
+        self.trie = {}
+        self.grams = {}
+        for i, key in enumerate(self.keys):
+            for word in key.split(' '):
+                node = self.trie
+                for char in word:
+                    node = node.setdefault(char, {})
+                    node.setdefault(None, set()).add(i)
+
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, set()).add(i)
+
+    def prefixed(self, word):
+        """Gets the stores having a word that starts with word
+
+        Args:
+            word (str): A folded word
+
+        Returns:
+            set: Positions of the stores, a copy the caller may change
+        """
+
+        node = self.trie
+        for char in word:
+            node = node.get(char)
+            if node == None:
+                return set()
+
+        return set(node.get(None, ()))
+
+    def similar(self, key):
+        """Gets the stores sharing trigrams with a folded name
+
+        Args:
+            key (str): The folded name
+
+        Returns:
+            list: A list of (similarity, position) tuples, the most similar first
+        """
+
+        grams = trigrams(key)
+        common = Counter()
+        for gram in grams:
+            for i in self.grams.get(gram, ()):
+                common[i] += 1
+
+        # Jaccard similarity of the trigram sets
+        scores = [(count/(len(grams) + len(trigrams(self.keys[i])) - count), i)
+                  for i, count in common.items()]
+
+        return sorted(scores, key=lambda score: (-score[0], self.names[score[1]]))
+
+    def resolve(self, name):
+        """Finds the store a user means
+
+        Args:
+            name (str): The name of the store as the user wrote it
+
+        Returns:
+            str: The name of the store as Alko writes it, None if the name doesn't resolve to one store
+            list: The names of at most STORE_SUGGESTIONS stores the user may mean, empty if the name resolved
+        """
+
+        key = fold(name)
+        if key == '':
+            return None, []
+
+        if key in self.exact:
+            return self.names[self.exact[key]], []
+
+        matches = None
+        for word in key.split(' '):
+            stores = self.prefixed(word)
+            matches = stores if matches == None else matches & stores
+
+        if len(matches) == 1:
+            return self.names[next(iter(matches))], []
+
+        if len(matches) > 1:
+            return None, sorted([self.names[i] for i in matches])[:STORE_SUGGESTIONS]
+
+        scores = self.similar(key)
+        if len(scores) > 0 and scores[0][0] >= STORE_FUZZY_MIN_SIMILARITY and \
+                (len(scores) == 1 or scores[0][0] - scores[1][0] >= STORE_FUZZY_MIN_LEAD):
+            return self.names[scores[0][1]], []
+
+        return None, [self.names[i] for score, i in scores[:STORE_SUGGESTIONS]
+                      if score >= STORE_SUGGESTION_MIN_SIMILARITY]
@@ -0,0 +1,368 @@
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+
+from .metrics import metrics
+
+# A command reading more documents than this is logged with the queries it made
+DEFAULT_READ_BUDGET = 100
+# A query made this many times with different values in one command is logged as a possible N+1 query
+N_PLUS_ONE_MIN_QUERIES = 5
+
+read_budget = DEFAULT_READ_BUDGET
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace():
+    """The Firestore operations of one command. The operations may be made from the storage threads"""
+
+    def __init__(self, name):
+        """Initialize trace
+
+        Args:
+            name (str): The name of the command
+        """
+
+        self.name = name
+        self.reads = 0
+        self.writes = 0
+        self.queries = Counter()
+        self.query_reads = Counter()
+        self.repeats = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, fingerprint, key, reads=0, writes=0):
+        """Records an operation
+
+        Args:
+            fingerprint (str): The collection and the filters of the operation, without the values
+            key (str): The operation with the values, equal for identical operations
+            reads (int): The number of documents read
+            writes (int): The number of documents written
+        """
+
+        with self.lock:
+            self.reads += reads
+            self.writes += writes
+
+            if writes == 0:
+                self.queries[fingerprint] += 1
+                self.query_reads[fingerprint] += reads
+                self.repeats[(fingerprint, key)] += 1
+
+    def warnings(self, budget):
+        """Gets the problems found in the operations
+
+        Args:
+            budget (int): The number of reads allowed
+
+        Returns:
+            list: A list of strings describing the problems
+        """
+
+        warnings = []
+
+        with self.lock:
+            for (fingerprint, key), count in self.repeats.items():
+                if count > 1:
+                    warnings.append(
+                        f'{self.name}: identical query ran {count} times: {key}')
+
+            for fingerprint, count in self.queries.items():
+                keys = len([key for f, key in self.repeats if f == fingerprint])
+                if keys >= N_PLUS_ONE_MIN_QUERIES:
+                    warnings.append(
+                        f'{self.name}: possible N+1 query, ran {count} times with {keys} different values: {fingerprint}')
+
+            if self.reads > budget:
+                heaviest = ', '.join([f'{fingerprint} ({reads})'
+                                      for fingerprint, reads in self.query_reads.most_common(5)])
+                warnings.append(
+                    f'{self.name}: read {self.reads} documents, over the budget of {budget}: {heaviest}')
+
+        return warnings
+
+
+class Totals():
+    """The Firestore reads and writes of all commands, for the metrics endpoint"""
+
+    def __init__(self):
+        """Initialize totals
+        """
+
+        self.reads = Counter()
+        self.writes = Counter()
+        self.over_budget = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, trace, over_budget):
+        """Adds the operations of a finished command
+
+        Args:
+            trace (Trace): The trace of the command
+            over_budget (bool): Whether the command read more than the budget
+        """
+
+        with self.lock:
+            self.reads[trace.name] += trace.reads
+            self.writes[trace.name] += trace.writes
+            self.over_budget[trace.name] += int(over_budget)
+
+    def collect(self):
+        """Renders the totals
+
+        Returns:
+            list: A list of lines in Prometheus text format
+        """
+
+        lines = []
+
+        with self.lock:
+            for metric, counts, description in [('reads', self.reads, 'Firestore documents read'),
+                                                ('writes', self.writes,
+                                                 'Firestore documents written'),
+                                                ('over_budget', self.over_budget, 'Commands over the read budget')]:
+                lines += [f'# HELP larvinen_firestore_{metric}_total {description} by command',
+                          f'# TYPE larvinen_firestore_{metric}_total counter']
+                lines += [f'larvinen_firestore_{metric}_total{{command="{command}"}} {count}'
+                          for command, count in sorted(counts.items())]
+
+        return lines
+
+
+totals = Totals()
+metrics.register(totals.collect)
+
+
+@contextlib.contextmanager
+def trace(name):
+    """Traces the Firestore operations of a command and logs the problems found when it finishes
+
+    Args:
+        name (str): The name of the command
+    """
+
+    command_trace = Trace(name)
+    token = current_trace.set(command_trace)
+
+    try:
+        yield command_trace
+    finally:
+        current_trace.reset(token)
+
+        for warning in command_trace.warnings(read_budget):
+            print(f'Firestore: {warning}')
+
+        totals.add(command_trace, command_trace.reads > read_budget)
+
+
+def record(fingerprint, key, reads=0, writes=0):
+    """Records an operation to the trace of the command being handled, if any
+
+    Args:
+        fingerprint (str): The collection and the filters of the operation, without the values
+        key (str): The operation with the values
+        reads (int): The number of documents read
+        writes (int): The number of documents written
+    """
+
+    command_trace = current_trace.get()
+    if command_trace != None:
+        command_trace.record(fingerprint, key, reads, writes)
+
+
+def record_writes(refs):
+    """Records a write of each document, e.g. of a committed batch or transaction
+
+    Args:
+        refs (list): The written document references, traced or not
+    """
+
+    for ref in refs:
+        path = unwrap(ref).path
+        record(path_fingerprint(path), path, writes=1)
+
+
+def path_fingerprint(path):
+    """Gets the fingerprint of a document path, having the document ids replaced with *
+
+    Args:
+        path (str): The path of a document, e.g. 'users/123/doses/456'
+
+    Returns:
+        str: The fingerprint, e.g. 'users/*/doses/*'
+    """
+
+    return '/'.join(['*' if i % 2 == 1 else segment for i, segment in enumerate(path.split('/'))])
+
+
+def unwrap(ref):
+    return ref.ref if isinstance(ref, TracedReference) else ref
+
+
+class TracedReference():
+    """A Firestore collection, document or query that records the documents it reads and writes. Everything
+    else is passed to the wrapped reference"""
+
+    def __init__(self, ref, fingerprint, key, document=False):
+        self.ref = ref
+        self.fingerprint = fingerprint
+        self.key = key
+        self.document_ref = document
+
+    def __getattr__(self, name):
+        return getattr(self.ref, name)
+
+    def refine(self, ref, shape, values=''):
+        return TracedReference(ref, f'{self.fingerprint} {shape}', f'{self.key} {shape} {values}'.rstrip())
+
+    def collection(self, name):
+        return TracedReference(self.ref.collection(name), f'{self.fingerprint}/{name}', f'{self.key}/{name}')
+
+    def document(self, *args, **kwargs):
+        ref = self.ref.document(*args, **kwargs)
+        return TracedReference(ref, f'{self.fingerprint}/*', f'{self.key}/{ref.id}', document=True)
+
+    def where(self, *args, **kwargs):
+        shape = f'where {args[0]} {args[1]}' if len(args) >= 2 else 'where filter'
+        return self.refine(self.ref.where(*args, **kwargs), shape, repr(args[2:]) + (repr(kwargs) if kwargs else ''))
+
+    def order_by(self, field, *args, **kwargs):
+        shape = ' '.join([f'order by {field}'] + [str(value) for value in list(args) + list(kwargs.values())])
+        return self.refine(self.ref.order_by(field, *args, **kwargs), shape)
+
+    def limit(self, count):
+        return self.refine(self.ref.limit(count), 'limit', str(count))
+
+    def select(self, fields):
+        return self.refine(self.ref.select(fields), f'select {list(fields)}')
+
+    def start_after(self, document):
+        if isinstance(document, TracedSnapshot):
+            document = document.snapshot
+
+        return self.refine(self.ref.start_after(document), 'start after', str(getattr(document, 'id', document)))
+
+    def stream(self, *args, **kwargs):
+        # Firestore bills a query that matches nothing as one read
+        reads = 0
+        try:
+            for snapshot in self.ref.stream(*args, **kwargs):
+                reads += 1
+                yield TracedSnapshot(snapshot)
+        finally:
+            record(self.fingerprint, self.key, reads=max(reads, 1))
+
+    def get(self, *args, **kwargs):
+        if not self.document_ref:
+            return list(self.stream(*args, **kwargs))
+
+        record(self.fingerprint, self.key, reads=1)
+        return TracedSnapshot(self.ref.get(*args, **kwargs))
+
+    def create(self, *args, **kwargs):
+        record(self.fingerprint, self.key, writes=1)
+        return self.ref.create(*args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        record(self.fingerprint, self.key, writes=1)
+        return self.ref.set(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        record(self.fingerprint, self.key, writes=1)
+        return self.ref.update(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        record(self.fingerprint, self.key, writes=1)
+        return self.ref.delete(*args, **kwargs)
+
+
+class TracedSnapshot():
+    """A Firestore document snapshot whose reference records its operations"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getattr__(self, name):
+        return getattr(self.snapshot, name)
+
+    @property
+    def reference(self):
+        ref = self.snapshot.reference
+        return TracedReference(ref, path_fingerprint(ref.path), ref.path, document=True)
+
+
+class TracedBatch():
+    """A Firestore write batch recording its writes when committed"""
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.refs = []
+
+    def __getattr__(self, name):
+        return getattr(self.batch, name)
+
+    def create(self, ref, *args, **kwargs):
+        self.refs.append(ref)
+        return self.batch.create(unwrap(ref), *args, **kwargs)
+
+    def set(self, ref, *args, **kwargs):
+        self.refs.append(ref)
+        return self.batch.set(unwrap(ref), *args, **kwargs)
+
+    def update(self, ref, *args, **kwargs):
+        self.refs.append(ref)
+        return self.batch.update(unwrap(ref), *args, **kwargs)
+
+    def delete(self, ref, *args, **kwargs):
+        self.refs.append(ref)
+        return self.batch.delete(unwrap(ref), *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        record_writes(self.refs)
+
+        self.refs = []
+        return self.batch.commit(*args, **kwargs)
+
+
+class TracedClient():
+    """A Firestore client recording the documents each command reads and writes, the queries it makes, and
+    the queries it repeats. The client works as usual outside commands"""
+
+    def __init__(self, client):
+        """Initialize traced client
+
+        Args:
+            client (firestore.Client): The Firestore client to wrap
+        """
+
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def collection(self, name):
+        return TracedReference(self.client.collection(name), name, name)
+
+    def collection_group(self, name):
+        return TracedReference(self.client.collection_group(name), f'**/{name}', f'**/{name}')
+
+    def get_all(self, references, *args, **kwargs):
+        references = list(references)
+        fingerprint = 'get all ' + \
+            ', '.join(sorted({path_fingerprint(unwrap(ref).path)
+                      for ref in references}))
+        key = 'get all ' + ', '.join([unwrap(ref).path for ref in references])
+
+        reads = 0
+        try:
+            for snapshot in self.client.get_all([unwrap(ref) for ref in references], *args, **kwargs):
+                reads += 1
+                yield TracedSnapshot(snapshot)
+        finally:
+            record(fingerprint, key, reads=reads)
+
+    def batch(self):
+        return TracedBatch(self.client.batch())
@@ -2,37 +2,69 @@ import discord
 import datetime
 import numpy as np
 
-from google.cloud import firestore
-from scipy import interpolate
-
-from .util import delete_collection
+from . import bac
+from . import rollups
+from .bac import FIRST_DOSE_DRINKING_TIME_MINUTES, ELIMINATION_RATE
+from .cache import LRUCache, Versions
+from .drinks import drink_registry
+from .metrics import metrics
+from .repository import MAX_TIMESTAMP
 
 PAD_HOURS = 96.0
 DEFAULT_MASS = 80
 DEFAULT_SEX = 'm'
-FIRST_DOSE_DRINKING_TIME_MINUTES = 20
 
 # Males have 75% of their weight worth water, females 66%
 WATER_MULTIPLIER = {'m': 0.75, 'f': 0.66}
-HIGH_SCORE_NULL = {'per_mille': None, 'timestamp': None}
+HIGH_SCORE_NULL = {'per_mille': None, 'timestamp': None, 'period': None}
+HIGH_SCORE_TIMEFRAMES = ['ath', 'ytd', 'this_month', 'this_week']
+# A high score is kept together with the period it was reached in, an entry of a past period reads as empty
+HIGH_SCORE_PERIOD_FORMATS = {
+    'ath': 'ath', 'ytd': '%Y', 'this_month': '%Y-%m', 'this_week': '%G-W%V'}
+
+# Doses of the most recently active users are cached in process. Every dose is written by the bot, so
+# a cached window stays complete as long as add_dose and delete_dose keep it up to date
+DOSE_CACHE_MAX_USERS = 1000
+DOSE_CACHE_TTL_SECONDS = 15*60
+# Windows reaching further back than this bypass the cache, to keep its memory bounded
+DOSE_CACHE_WINDOW_HOURS = 240.0 + PAD_HOURS
+
+dose_cache = LRUCache(DOSE_CACHE_MAX_USERS, DOSE_CACHE_TTL_SECONDS)
+metrics.register_cache('doses', dose_cache)
+
+# Bumped for the user and the dose's guilds whenever something a per mille curve depends on changes
+dose_versions = Versions()
+
+# User objects are shared between commands, so that active users' documents are read only once in a while
+USER_REGISTRY_MAX_USERS = 1000
+USER_REGISTRY_TTL_SECONDS = 30*60
+
+user_registry = LRUCache(USER_REGISTRY_MAX_USERS, USER_REGISTRY_TTL_SECONDS)
+metrics.register_cache('users', user_registry)
 
 
 class User():
-    guilds = {}
-    high_score = {'ath': HIGH_SCORE_NULL, 'ytd': HIGH_SCORE_NULL,
-                  'this_month': HIGH_SCORE_NULL, 'this_week': HIGH_SCORE_NULL}
-    changed_data = {}
-    changed_guild = {}
 
-    def __init__(self, db, id):
+    def __init__(self, db, id, user_dict=None, read=True):
         """Initialize user
 
         Args:
-            db (firestore.client): The database client
+            db (Repository): The database client
             id (int): The id of the user
+            user_dict (dict): An already read user document, used when read is False
+                (default None)
+            read (bool): A boolean defining whether to read the user document from the database
+                (default True)
         """
         self.id = str(id)
-        user_dict = db.collection('users').document(self.id).get().to_dict()
+        self.changed_data = {}
+        self.changed_guild = {}
+        self.guilds = {}
+        self.high_score = {timeframe: dict(HIGH_SCORE_NULL)
+                           for timeframe in HIGH_SCORE_TIMEFRAMES}
+
+        if read:
+            user_dict = db.get_user(self.id)
 
         if user_dict != None:
             self.sex = user_dict['sex'] if 'sex' in user_dict else None
@@ -41,13 +73,17 @@ class User():
             self.address = user_dict['address'] if 'address' in user_dict else None
             self.guilds = user_dict['guilds'] if 'guilds' in user_dict else self.guilds
             self.high_score = user_dict['high_score'] if 'high_score' in user_dict else self.high_score
+            self.bac_checkpoint = user_dict['bac_checkpoint'] if 'bac_checkpoint' in user_dict else None
+            self.bac_checkpoint_previous = user_dict[
+                'bac_checkpoint_previous'] if 'bac_checkpoint_previous' in user_dict else None
             self.in_db = True
         else:
             self.sex = None
             self.mass = None
             self.name = None
-            self.guilds = None
             self.address = None
+            self.bac_checkpoint = None
+            self.bac_checkpoint_previous = None
             self.in_db = False
 
     @property
@@ -107,13 +143,15 @@ class User():
     def asdict(self):
         return {'id': self.id, 'name': self.name, 'mass': self.mass, 'sex': self.sex, 'in_db': self.in_db}
 
-    def update_info(self, db, message, params={}):
+    def update_info(self, db, message, params={}, batch=None):
         """Updates user's info to match params and message
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             message (discord.Message): The message that triggered the event
             params (dict): Dictionary that contains the params to update
+            batch (object): A batch from Repository.batch to add the writes to instead of writing them immediately
+                (default None)
 
         """
 
@@ -125,6 +163,9 @@ class User():
             self.sex = params['sex']
             self.changed_data['sex'] = params['sex']
 
+        if 'mass' in self.changed_data or 'sex' in self.changed_data:
+            dose_versions.bump(self.id)
+
         if self.name != message.author.name:
             self.name = message.author.name
             self.changed_data['name'] = message.author.name
@@ -139,55 +180,64 @@ class User():
                 self.changed_guild[sgid]['member'] = True
                 self.changed_guild[sgid]['guildname'] = message.guild.name
 
-            if (sgid not in self.guilds) or (message.author.nick != self.guilds[sgid]['nick']) or (message.guild.name != self.guilds[sgid]['guildname']):
+            elif (message.author.nick != self.guilds[sgid]['nick']) or (message.guild.name != self.guilds[sgid]['guildname']):
                 self.changed_guild[sgid] = {}
                 self.changed_guild[sgid]['nick'] = message.author.nick
                 self.changed_guild[sgid]['guildname'] = message.guild.name
 
         if len(self.changed_guild) > 0:
-            self.changed_data['guilds'] = {}
-            self.changed_data['guilds'][sgid] = self.changed_guild[sgid]
+            for sgid, guild in self.changed_guild.items():
+                self.guilds.setdefault(sgid, {}).update(guild)
+
+            # The whole map is written, since the user object is kept up to date in the registry
+            self.changed_data['guilds'] = self.guilds
+            self.changed_guild = {}
 
         if self.in_db:
-            self.update_database(db)
+            self.update_database(db, batch)
         else:
             self.changed_data['high_score'] = self.high_score
-            self.insert_to_database(db)
+            self.insert_to_database(db, batch)
+
+        user_registry.set(self.id, self)
 
     def delete_user(self, db):
         """Deletes user from database, along with one's doses
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
 
         """
 
-        doses_ref = db.collection('users').document(
-            self.id).collection('doses')
-        delete_collection(doses_ref, 16)
-
-        db.collection('users').document(self.id).delete()
+        db.delete_user(self.id)
+        dose_cache.invalidate(self.id)
+        dose_versions.bump(self.id)
+        user_registry.invalidate(self.id)
 
-    def update_database(self, db):
+    def update_database(self, db, batch=None):
         """Updates user's info to database
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
+            batch (object): A batch from Repository.batch to add the write to instead of writing it immediately
+                (default None)
 
         """
         if len(self.changed_data) > 0:
-            db.collection('users').document(self.id).update(self.changed_data)
+            (batch or db).update_user(self.id, self.changed_data)
             self.changed_data = {}
 
-    def insert_to_database(self, db):
+    def insert_to_database(self, db, batch=None):
         """Updates user's info to database
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
+            batch (object): A batch from Repository.batch to add the write to instead of writing it immediately
+                (default None)
 
         """
 
-        db.collection('users').document(self.id).set(self.changed_data)
+        (batch or db).set_user(self.id, self.changed_data)
         self.changed_data = {}
         self.in_db = True
 
@@ -214,7 +264,7 @@ class User():
         """Gets user's all doses before date_high until duration_seconds has passed
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             duration_seconds (int): An int describing the length of the query in seconds
             date_high (datetime): A datetime object defining the upper limit for the dose timestamps
                 (default None)
@@ -225,20 +275,44 @@ class User():
         """
 
         date_high = datetime.datetime.now() if date_high == None else date_high
-        doses_ref = db.collection('users').document(self.id).collection('doses').where(
-            'timestamp', '>', date_high.timestamp()-duration_seconds).where('timestamp', '<', date_high.timestamp()).stream()
-        doses = {}
+        time_low = date_high.timestamp()-duration_seconds
+
+        if not is_cacheable(time_low):
+            return db.get_doses(self.id, time_low, date_high.timestamp())
+
+        cached = dose_cache.get(
+            self.id, valid=lambda cached: cached['since'] <= time_low)
+
+        if cached == None:
+            cached = self.cache_doses(db, time_low)
+
+        return filter_doses(cached['doses'], time_low, date_high.timestamp())
+
+    def cache_doses(self, db, time_low):
+        """Reads user's all doses after time_low to the dose cache
+
+        Args:
+            db (Repository): The database client
+            time_low (float): A float defining the lower limit for the dose timestamps
+
+        Returns:
+            dict: The cached window having the lower limit and the doses
+
+        """
 
-        for dose in doses_ref:
-            doses[dose.id] = dose.to_dict()
+        # A dose added or deleted during the read isn't in the result, which is then left uncached
+        version = dose_versions.current()
+        cached = {'since': time_low, 'doses': db.get_doses(self.id, time_low)}
+        dose_versions.if_unchanged(
+            [self.id], version, dose_cache.set, self.id, cached)
 
-        return doses
+        return cached
 
-    def get_previous_dose(self, db, time_low=0, time_high=90000000000):
+    def get_previous_dose(self, db, time_low=0, time_high=MAX_TIMESTAMP):
         """Gets users previous dose of alcohol
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             time_low (int): An int describing the earliest valid timestamp for the previous dose
             time_high (int): An int describing the latest valid timestamp for the previous dose
 
@@ -247,40 +321,215 @@ class User():
 
         """
 
-        doses_ref = db.collection('users').document(self.id).collection('doses').where('timestamp', '>=', time_low).where(
-            'timestamp', '<=', time_high).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream()
+        def previous_cached(cached):
+            doses = filter_doses(
+                cached['doses'], time_low, time_high, inclusive=True)
+            return dict(list(doses.items())[-1:])
+
+        cached = dose_cache.get(self.id, valid=lambda cached: cached['since'] < time_low or len(
+            previous_cached(cached)) == 1)
+        if cached != None:
+            return previous_cached(cached)
+
+        return db.get_previous_dose(self.id, time_low, time_high)
+
+    def delete_dose(self, db, dose_id, timestamp):
+        """Deletes one of user's doses from the database and the dose cache
+
+        Args:
+            db (Repository): The database client
+            dose_id (str): The id of the dose document
+            timestamp (int): The timestamp of the dose
+
+        """
+
+        # The dose affects the rollups until the user was to get sober with it
+        _, sober_in = self.per_mille(db)
+        t_sober = max(datetime.datetime.now().timestamp(),
+                      timestamp) + sober_in*60*60
+
+        db.delete_dose(self.id, dose_id)
+        dose_versions.bump(self.id)
 
-        doses = {}
-        for dose in doses_ref:
-            doses[dose.id] = dose.to_dict()
+        # Roll the checkpoint back to the previous dose. Without one it's rebuilt from the doses when needed
+        if self.bac_checkpoint != None:
+            if self.bac_checkpoint['dose'] == dose_id:
+                self.bac_checkpoint = self.bac_checkpoint_previous
+            else:
+                self.bac_checkpoint = None
+
+            self.bac_checkpoint_previous = None
+            db.update_user(
+                self.id, {'bac_checkpoint': self.bac_checkpoint, 'bac_checkpoint_previous': None})
+
+        # Cached windows are replaced instead of modified, since other threads may be reading them
+        cached = dose_cache.peek(self.id)
+        if cached != None:
+            doses = {id: dose for id,
+                     dose in cached['doses'].items() if id != dose_id}
+            dose_cache.set(self.id, {'since': cached['since'], 'doses': doses})
 
-        return doses
+        self.update_rollups(
+            db, timestamp-FIRST_DOSE_DRINKING_TIME_MINUTES*60, t_sober)
 
-    def update_high_score(self, db, score_new, timestamp_new):
+    def update_high_score(self, db, score_new, timestamp_new, changes=None, batch=None):
         """Updates high score to object
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             score_new (float): Float describing the per_mille value of the user at a given time
             timestamp_new (int): An int describing the unix timestamp of the dose
+            changes (dict): Other fields of the user document to be updated in the same write
+                (default None)
+            batch (object): A batch from Repository.batch to add the write to instead of writing it immediately
+                (default None)
         """
 
-        changed = False
-        for timeframe, values in self.high_score.items():
+        changes = {} if changes == None else changes
+        current = self.current_high_score(timestamp_new)
+
+        for timeframe, values in current.items():
             if (values['per_mille'] or 0) < score_new:
-                self.high_score[timeframe]['per_mille'] = score_new
-                self.high_score[timeframe]['timestamp'] = timestamp_new
-                changed = True
+                current[timeframe] = {'per_mille': score_new, 'timestamp': timestamp_new,
+                                      'period': high_score_period(timeframe, timestamp_new)}
+                changes['high_score'] = current
+
+        if 'high_score' in changes:
+            self.high_score = current
+
+        if len(changes) > 0:
+            (batch or db).update_user(self.id, changes)
+            user_registry.set(self.id, self)
+
+    def current_high_score(self, timestamp=None):
+        """Gets user's high scores of the periods timestamp falls in. Entries of past periods are returned empty
+
+        Args:
+            timestamp (float): A unix timestamp defining the current periods
+                (default None, which means now)
+
+        Returns:
+            dict: A dictionary having the high score of each timeframe
+        """
+
+        timestamp = datetime.datetime.now().timestamp() if timestamp == None else timestamp
+
+        current = {}
+        for timeframe in HIGH_SCORE_TIMEFRAMES:
+            values = self.high_score.get(timeframe) or HIGH_SCORE_NULL
+
+            # Entries written before the period was stored get it from their timestamp
+            period = values.get('period') or (high_score_period(timeframe, values['timestamp'])
+                                              if values.get('timestamp') != None else None)
+
+            if period != None and period == high_score_period(timeframe, timestamp):
+                current[timeframe] = dict(values, period=period)
+            else:
+                current[timeframe] = dict(HIGH_SCORE_NULL)
+
+        return current
+
+    def update_rollups(self, db, t_low, t_high, new_doses=None, batch=None):
+        """Recomputes user's daily rollups after the per mille curve has changed between t_low and t_high. The
+        curve is linear from the vertex before t_low on, so the days are recomputed starting from that vertex
+
+        Args:
+            db (Repository): The database client
+            t_low (float): A unix timestamp of the first moment the curve may have changed
+            t_high (float): A unix timestamp of the last moment the curve may have changed
+            new_doses (dict): Doses that are not inserted yet, keyed by the dose id
+                (default None)
+            batch (object): A batch from Repository.batch to add the writes to instead of writing them immediately
+                (default None)
+
+        """
+
+        t_start, _ = rollups.day_bounds(rollups.day_of(t_low))
+        _, t_end = rollups.day_bounds(rollups.day_of(t_high))
+
+        doses = self.get_doses(db, t_end-t_start+PAD_HOURS*60*60,
+                               datetime.datetime.fromtimestamp(t_end))
+        doses.update(new_doses or {})
+        doses = dict(sorted(doses.items(), key=lambda dose: int(dose[0])))
+
+        mass = (self.mass or DEFAULT_MASS)
+        t_doses = np.array([int(t) for t in doses.keys()] +
+                           [int(t_end)], dtype=np.int64)
+        pure_alcohol = np.array([dose['pure_alcohol']
+                                for dose in doses.values()] + [0.0], dtype=float)
+
+        t_points, g_points = bac.breakpoints(t_doses, pure_alcohol, mass)
+        order = np.argsort(t_points, kind='stable')
+        t_points = t_points[order]
+        per_mille_points = g_points[order] / \
+            WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass
+
+        t_before = t_points[t_points < t_low]
+        days = rollups.days_between(
+            t_before[-1] if len(t_before) > 0 else t_low, t_high)
+
+        for day, rollup in rollups.compute(t_doses[:-1], pure_alcohol[:-1], t_points, per_mille_points, days).items():
+            (batch or db).set_rollup(self.id, day, rollup)
+
+    def get_rollups(self, db, t_low, t_high):
+        """Gets user's daily rollups of the days between t_low and t_high
+
+        Args:
+            db (Repository): The database client
+            t_low (float): A unix timestamp in the first day
+            t_high (float): A unix timestamp in the last day
+
+        Returns:
+            dict: A dictionary of the rollups keyed by the ISO dates
+        """
+
+        return db.get_rollups(self.id, rollups.day_of(t_low), rollups.day_of(t_high))
+
+    def valid_checkpoint(self):
+        """Gets user's body alcohol content checkpoint if it was computed with user's current info
+
+        Returns:
+            dict: A dictionary having the body alcohol content in grams right after the latest dose, the
+                timestamp and id of the dose, and the mass and sex used. None if there is no valid checkpoint
+
+        """
+
+        checkpoint = self.bac_checkpoint
+        if checkpoint == None or checkpoint['mass'] != (self.mass or DEFAULT_MASS) or checkpoint['sex'] != (self.sex or DEFAULT_SEX):
+            return None
+
+        return checkpoint
+
+    def rebuild_checkpoint(self, db):
+        """Computes user's body alcohol content checkpoint from the doses
+
+        Args:
+            db (Repository): The database client
+
+        Returns:
+            dict: A dictionary describing the checkpoint, see valid_checkpoint
+
+        """
+
+        g_alcohol, t_doses, _ = self.get_alcohol_grams(
+            db, datetime.datetime.now())
+
+        checkpoint = {'grams': 0.0, 'timestamp': 0, 'dose': None,
+                      'mass': (self.mass or DEFAULT_MASS), 'sex': (self.sex or DEFAULT_SEX)}
+
+        # The last value is the current moment, the one before it the latest dose
+        if not np.any(g_alcohol == None) and len(t_doses) > 1:
+            checkpoint['grams'] = float(g_alcohol[-2])
+            checkpoint['timestamp'] = int(t_doses[-2])
+            checkpoint['dose'] = str(int(t_doses[-2]))
 
-        if changed:
-            db.collection('users').document(str(self.id)).update(
-                {'high_score': self.high_score})
+        return checkpoint
 
     def add_dose(self, db, message, params):
         """Adds as dose for user to the database
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             message (discord.message): The message that triggered the event
             params (list): A list of parameters parsed from the message
 
@@ -289,10 +538,13 @@ class User():
 
         """
 
-        self.update_info(db, message)
+        # All writes of a dose are committed at once, so that a dose is never saved without its high score
+        batch = db.batch()
 
-        drink = db.collection('basic_drinks').document(
-            params[0]).get().to_dict()
+        self.update_info(db, message, batch=batch)
+
+        drink = drink_registry.get(db, params[0])
+        new_drink = None
 
         if drink != None:
             new_dose = float(params[1] or drink['volume']) * \
@@ -306,12 +558,14 @@ class User():
                 if params[3] != None and params[3] != 'public':
                     drink_name = '%' + params[3].replace('%', '')
                     params[0] = drink_name
-                    db.collection('basic_drinks').document(drink_name).set(
-                        {'alcohol': float(params[2]), 'volume': float(params[1])})
+                    new_drink = {'alcohol': float(
+                        params[2]), 'volume': float(params[1])}
+                    batch.set_basic_drink(drink_name, new_drink)
 
             elif (params[0] == '%sama'):
                 previous_dose = list(self.get_previous_dose(db).values())[-1]
                 if previous_dose == None:
+                    self.commit_batch(batch)
                     return 0
                 else:
                     params[0] = previous_dose['drink']
@@ -319,6 +573,7 @@ class User():
                     params[2] = previous_dose['alcohol']
                     new_dose = previous_dose['pure_alcohol']
             else:
+                self.commit_batch(batch)
                 return None
 
         # Convert time to be utc always
@@ -338,39 +593,77 @@ class User():
 
         document['guild'] = guild
 
-        per_mille, sober_in = self.per_mille_not_inserted(db, document)
-
-        self.update_high_score(db, per_mille, t)
+        per_mille, sober_in, checkpoint = self.per_mille_not_inserted(
+            db, document)
 
         # Convert to int first to get rid of decimals
-        db.collection('users').document(self.id).collection(
-            'doses').document(str(int(message.created_at.timestamp()))).set(document)
+        dose_id = str(int(message.created_at.timestamp()))
+        checkpoint['dose'] = dose_id
+
+        self.bac_checkpoint_previous = self.valid_checkpoint()
+        self.bac_checkpoint = checkpoint
+
+        self.update_high_score(db, per_mille, t, {
+                               'bac_checkpoint': self.bac_checkpoint, 'bac_checkpoint_previous': self.bac_checkpoint_previous}, batch)
+
+        t_sober = t + checkpoint['grams']/ELIMINATION_RATE / \
+            (self.mass or DEFAULT_MASS)*60*60
+        self.update_rollups(db, t-FIRST_DOSE_DRINKING_TIME_MINUTES*60, t_sober,
+                            {dose_id: document}, batch)
+
+        batch.set_dose(self.id, dose_id, document)
+        self.commit_batch(batch)
+        dose_versions.bump(self.id, *document['guild'])
+
+        if new_drink != None:
+            drink_registry.set(params[0], new_drink)
+
+        cached = dose_cache.peek(self.id)
+        if cached != None:
+            doses = dict(cached['doses'])
+            doses[dose_id] = document
+            dose_cache.set(self.id, {'since': cached['since'], 'doses': doses})
 
         return {'per_milles': per_mille, 'sober_in': sober_in}
 
+    def commit_batch(self, batch):
+        """Commits a batch of user's writes. If the commit fails, the user is dropped from the registry,
+        since its state no longer matches the database
+
+        Args:
+            batch (object): The batch from Repository.batch to be committed
+
+        """
+
+        try:
+            batch.commit()
+        except Exception:
+            user_registry.invalidate(self.id)
+            raise
+
     def per_mille_not_inserted(self, db, new_dose):
         """Gets users blood alcohol content at the current timestamp
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             new_dose (dict): A dictionary representing the new dose that's not inserted yet
 
         Returns:
             float: A float describing the current state of the user
             float: A float describing the time in hours it takes the user to get sober
+            dict: A dictionary describing the checkpoint after the new dose, see valid_checkpoint
 
         """
         mass = (self.mass or DEFAULT_MASS)
 
-        g_alcohol, t_doses, _ = self.get_alcohol_grams(
-            db, datetime.datetime.now())
+        checkpoint = self.valid_checkpoint() or self.rebuild_checkpoint(db)
 
-        if np.any(g_alcohol == None):
-            g_alcohol = [0]
-            t_doses = [0]
+        duration = new_dose['timestamp']-checkpoint['timestamp']
+        g_alcohol = max(checkpoint['grams'] - 0.1*mass*duration/60/60, 0)
 
-        duration = new_dose['timestamp']-t_doses[-1]
-        g_alcohol = max(g_alcohol[-1] - 0.1*mass*duration/60/60, 0)
+        # The checkpoint follows the same model as the plots, where the absorption is drawn as a ramp
+        g_checkpoint = max(checkpoint['grams'] - ELIMINATION_RATE*mass *
+                           max(duration, 1)/60/60, 0.0) + new_dose['pure_alcohol']*bac.ALCOHOL_DENSITY
 
         if g_alcohol == 0:
             g_alcohol += new_dose['pure_alcohol']*7.9
@@ -379,13 +672,16 @@ class User():
         else:
             g_alcohol += new_dose['pure_alcohol']*7.9
 
-        return g_alcohol/WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass, g_alcohol/0.1/mass
+        new_checkpoint = {'grams': float(g_checkpoint), 'timestamp': new_dose['timestamp'], 'dose': None,
+                          'mass': mass, 'sex': (self.sex or DEFAULT_SEX)}
+
+        return g_alcohol/WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass, g_alcohol/0.1/mass, new_checkpoint
 
     def per_mille(self, db):
         """Gets users blood alcohol content at the current timestamp
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
 
         Returns:
             float: A float describing the current state of the user
@@ -394,11 +690,20 @@ class User():
         """
         mass = (self.mass or DEFAULT_MASS)
 
-        g_alcohol, _, _ = self.get_alcohol_grams(db, datetime.datetime.now())
-        if np.any(g_alcohol == None):
-            g_alcohol = [0]
+        checkpoint = self.valid_checkpoint()
+        if checkpoint == None:
+            checkpoint = self.rebuild_checkpoint(db)
 
-        return g_alcohol[-1]/WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass, g_alcohol[-1]/0.1/mass
+            if self.in_db:
+                self.bac_checkpoint = checkpoint
+                db.update_user(self.id, {'bac_checkpoint': checkpoint})
+
+        duration = max(int(datetime.datetime.now().timestamp()) -
+                       checkpoint['timestamp'], 1)
+        g_alcohol = max(checkpoint['grams'] - ELIMINATION_RATE *
+                        mass*duration/60/60, 0.0)
+
+        return g_alcohol/WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass, g_alcohol/0.1/mass
 
     # https://www.terveyskirjasto.fi/dlk01084/alkoholihumala-ja-muita-alkoholin-valittomia-vaikutuksia?q=alkoholi%20palaminen
     # Alkoholimäärä grammoina = 7.9 × (pullon tilavuus senttilitroina) × (alkoholipitoisuus tilavuusprosentteina)
@@ -408,18 +713,19 @@ class User():
     # Nyrkkisääntö alkoholin palamiselle ilman tietoja, 0,1 g/h/kg
 
     def get_alcohol_grams(self, db, now, duration_seconds=86400):
-        """Gets a single user's body alcohol content in grams, timestamps and zeros to insert for plotting
+        """Gets a single user's body alcohol content in grams at dose timestamps, and the vertices of the content for plotting
 
         Args:
-            db (firestore.Client): The database client
+            db (Repository): The database client
             now (datetime): A datetime object representing the last moment in time, to get the body alcohol content
             duration_seconds (int): Int determining the period of querying the data before now
                 (default is 86400 seconds = 24 hours)
 
         Returns:
             np.array: an array of values representing the body alcohol content at specific times
-            list: a list that has the timestamps of the values
-            list: a list of timestamps and indices to insert zeros for when the alcohol content has reached zero
+            np.array: an array that has the timestamps of the values
+            tuple: a tuple of arrays having the timestamps and values of the piecewise linear body alcohol content,
+                including the moments when the alcohol content has reached zero
         """
 
         user_doses = self.get_doses(db, duration_seconds+PAD_HOURS*60*60, now)
@@ -429,124 +735,238 @@ class User():
 
         mass = (self.mass or DEFAULT_MASS)
 
-        t_doses = list(user_doses.keys())
         # Make last datapoint to be at current timestamp
-        t_doses.append(int(now.timestamp()))
-        user_doses[str(int(now.timestamp()))] = {'pure_alcohol': 0.0}
-        t_doses = [int(t) for t in t_doses]
+        t_doses = np.array([int(t) for t in user_doses.keys()] + [int(now.timestamp())], dtype=np.int64)
+        pure_alcohol = np.array([dose['pure_alcohol']
+                                for dose in user_doses.values()] + [0.0], dtype=float)
 
-        g_alcohol = 0.0
-        values = np.zeros(len(t_doses), dtype=float)
-        zeros_to_insert = []
+        values, _ = bac.dose_grams(t_doses, pure_alcohol, mass)
 
-        for i in range(len(t_doses)):
-            if i == 0:
-                absorption_time = FIRST_DOSE_DRINKING_TIME_MINUTES*60
-            else:
-                absorption_time = min(
-                    FIRST_DOSE_DRINKING_TIME_MINUTES*60, t_doses[i]-t_doses[i-1])
-
-                g_alcohol -= 0.1*mass*(max(t_doses[i]-t_doses[i-1], 1))/60/60
-
-            if g_alcohol <= 0:
-                if int(t_doses[i]-absorption_time) < int(t_doses[i] + g_alcohol/0.1/mass*60*60):
-                    zeros_to_insert.append(
-                        [i, int(t_doses[i]-absorption_time)])
-                    if i != 0:
-                        zeros_to_insert.append(
-                            [i, int(t_doses[i] + g_alcohol/0.1/mass*60*60)])
-                else:
-                    zeros_to_insert.append(
-                        [i, int(t_doses[i] + g_alcohol/0.1/mass*60*60)])
+        return values, t_doses, bac.breakpoints(t_doses, pure_alcohol, mass)
 
-                    if i < (len(t_doses)-1):
-                        zeros_to_insert.append(
-                            [i, int(t_doses[i]-absorption_time)])
+    def guilds_to_list(self):
+        """Converts user's guild memberships to as list of strings
 
-                g_alcohol = 0.0
+        Returns:
+            list: A list of strings representing user's guild memberships
+        """
 
-            g_alcohol += user_doses[str(t_doses[i])]['pure_alcohol']*7.9
+        list_of_gids = []
 
-            g_alcohol = max(g_alcohol, 0.0)
-            values[i] = g_alcohol
+        for gid in self.guilds:
+            list_of_gids.append(str(gid))
 
-        return values, t_doses, zeros_to_insert
+        return list_of_gids
 
-    def per_mille_values(self, db, duration_seconds, now, t_interp):
-        """Gets user's per mille values interpolated to t_interp timestamps
 
-        Args:
-            db (firestore.Client): The database client
-            duration_seconds (int): An int used to define the duration of the interpolation
-            now (datetime): A datetime object defining the last moment of interpolation
-            t_interp (np.array): A numpy array defining the interpolation points
+def high_score_period(timeframe, timestamp):
+    """Gets the high score period of a timeframe that timestamp falls in, e.g. '2020-W05' for this_week
 
-        Returns:
-            np.array: An array having the interpolated points
-            np.array: An array having the points used for interpolation
-            list: A list having the timestamps of interpolation points
+    Args:
+        timeframe (str): One of HIGH_SCORE_TIMEFRAMES
+        timestamp (float): A unix timestamp
 
-        """
-        mass = (self.mass or DEFAULT_MASS)
+    Returns:
+        str: The ISO year and week, the year and month, the year or 'ath'
+    """
 
-        values, t_doses, zeros_to_insert = self.get_alcohol_grams(
-            db, now, duration_seconds)
+    return datetime.datetime.fromtimestamp(timestamp).strftime(HIGH_SCORE_PERIOD_FORMATS[timeframe])
 
-        if np.any(values == None):
-            return [0], [0], [0]
 
-        for i in range(len(zeros_to_insert)):
-            t_doses.insert(zeros_to_insert[i][0]+i, zeros_to_insert[i][1])
-            values = np.insert(values, zeros_to_insert[i][0]+i, 0.0)
+def is_cacheable(time_low):
+    """Checks whether a dose query starting from time_low can be answered from the dose cache
 
-        if t_interp[0] < t_doses[0]:
-            t_doses.insert(0, t_interp[0]-1)
-            values = np.insert(values, 0, 0.0)
+    Args:
+        time_low (float): A float defining the lower limit for the dose timestamps
 
-        f = interpolate.interp1d(t_doses, values, kind='linear')
-        interp_values = f(t_interp)
+    Returns:
+        bool: True if the query fits the cached window
 
-        return interp_values/WATER_MULTIPLIER[(self.sex or DEFAULT_SEX)]/mass, values[1:-1], t_doses[1:-1]
+    """
 
-    def guilds_to_list(self):
-        """Converts user's guild memberships to as list of strings
+    return time_low >= datetime.datetime.now().timestamp()-DOSE_CACHE_WINDOW_HOURS*60*60
 
-        Returns:
-            list: A list of strings representing user's guild memberships
-        """
 
-        list_of_gids = []
+def filter_doses(doses, time_low, time_high, inclusive=False):
+    """Filters doses to a time interval, ordered by their timestamps
 
-        for gid in self.guilds:
-            list_of_gids.append(str(gid))
+    Args:
+        doses (dict): A dictionary of doses keyed by their ids
+        time_low (float): A float defining the lower limit for the dose timestamps
+        time_high (float): A float defining the upper limit for the dose timestamps
+        inclusive (bool): A boolean defining whether the limits are included in the interval
+            (default False)
 
-        return list_of_gids
+    Returns:
+        dict: A dictionary of doses in the time interval
 
-    @ staticmethod
-    def get_previous_dose_by_uid(db, uid, time_low=0, time_high=90000000000, guild='private'):
-        """Gets users previous dose of alcohol
+    """
 
-        Args:
-            db (firestore.Client): The database client
-            uid (int): An int describing the user's id
-            time_low (int): An int describing the earliest valid timestamp for the previous dose
-                (default is 0)
-            time_high (int): An int describing the latest valid timestamp for the previous dose
-                (default is 90000000000)
-            guild (str): An string describing the guilds id
-                (default is private)
+    if inclusive:
+        return {id: dose for id, dose in sorted(doses.items(), key=lambda item: item[1]['timestamp'])
+                if time_low <= dose['timestamp'] <= time_high}
 
+    return {id: dose for id, dose in sorted(doses.items(), key=lambda item: item[1]['timestamp'])
+            if time_low < dose['timestamp'] < time_high}
 
-        Returns:
-            dict: A dictionary representing the user's previous dose
 
-        """
+def get_user(db, id):
+    """Gets a user from the registry, or from the database if it's not registered
+
+    Args:
+        db (Repository): The database client
+        id (int): The id of the user
+
+    Returns:
+        User: The user object shared between commands
+
+    """
+
+    user = user_registry.get(str(id))
+
+    if user == None:
+        user = User(db, id)
+        user_registry.set(user.id, user)
+
+    return user
+
+
+def get_users(db, uids):
+    """Gets several users from the registry, and the unregistered ones with a single batched read
+
+    Args:
+        db (Repository): The database client
+        uids (list): A list of user ids
+
+    Returns:
+        dict: A dictionary of User objects keyed by the string user id
+
+    """
+
+    users = {}
+    uncached = []
+
+    for uid in uids:
+        user = user_registry.get(str(uid))
+        if user != None:
+            users[user.id] = user
+        else:
+            uncached.append(str(uid))
+
+    if len(uncached) > 0:
+        for uid, user_dict in db.get_users(uncached).items():
+            users[uid] = User(db, uid, user_dict, read=False)
+            user_registry.set(uid, users[uid])
+
+    return users
+
+
+def get_doses_by_uids(db, uids, duration_seconds, date_high=None):
+    """Gets several users' doses before date_high until duration_seconds has passed
+
+    Args:
+        db (Repository): The database client
+        uids (list): A list of user ids
+        duration_seconds (int): An int describing the length of the query in seconds
+        date_high (datetime): A datetime object defining the upper limit for the dose timestamps
+            (default None)
+
+    Returns:
+        dict: A dictionary having a dictionary of doses in the time interval per string user id
+
+    """
+
+    date_high = datetime.datetime.now() if date_high == None else date_high
+    time_low = date_high.timestamp()-duration_seconds
+    cacheable = is_cacheable(time_low)
+    uids = [str(uid) for uid in uids]
+    doses = {}
+    uncached = []
+
+    for uid in uids:
+        cached = dose_cache.get(
+            uid, valid=lambda cached: cached['since'] <= time_low) if cacheable else None
+
+        if cached != None:
+            doses[uid] = filter_doses(
+                cached['doses'], time_low, date_high.timestamp())
+        else:
+            doses[uid] = {}
+            uncached.append(uid)
+
+    # A dose added or deleted during the read isn't in the result, which is then left uncached
+    version = dose_versions.current()
+    if len(uncached) > 0:
+        doses.update(db.get_doses_by_uids(
+            uncached, time_low, None if cacheable else date_high.timestamp()))
+
+    if cacheable:
+        for uid in uncached:
+            dose_versions.if_unchanged([uid], version, dose_cache.set, uid, {
+                                       'since': time_low, 'doses': doses[uid]})
+            doses[uid] = filter_doses(
+                doses[uid], time_low, date_high.timestamp())
+
+    return doses
+
+
+def per_mille_curves(db, uids, duration_seconds, now, t_start):
+    """Gets several users' per mille curves as the vertices of the piecewise linear curves
+
+    Args:
+        db (Repository): The database client
+        uids (list): A list of user ids
+        duration_seconds (int): An int used to define the duration of the curves
+        now (datetime): A datetime object defining the last moment of the curves
+        t_start (float): The first timestamp the curves should cover
+
+    Returns:
+        dict: A dictionary of User objects keyed by the string user id
+        dict: A dictionary having the timestamps and per mille values of the vertices, ordered by the
+            timestamps, per string user id. Users without doses are left out
+
+    """
+
+    uids = [str(uid) for uid in uids]
+    users = get_users(db, uids)
+    user_doses = get_doses_by_uids(
+        db, uids, duration_seconds+PAD_HOURS*60*60, now)
+    t_now = int(now.timestamp())
+
+    curves = {}
+    for uid in uids:
+        if len(user_doses[uid]) == 0:
+            continue
+
+        mass = (users[uid].mass or DEFAULT_MASS)
+        t_points, g_points = bac.breakpoints(
+            [int(t) for t in user_doses[uid].keys()] + [t_now],
+            [dose['pure_alcohol'] for dose in user_doses[uid].values()] + [0.0], mass)
+        t_points, g_points = bac.pad_start(t_points, g_points, t_start)
+
+        order = np.argsort(t_points, kind='stable')
+        curves[uid] = (t_points[order], g_points[order] /
+                       WATER_MULTIPLIER[(users[uid].sex or DEFAULT_SEX)]/mass)
+
+    return users, curves
+
+
+def rebuild_rollups(db):
+    """Recomputes every user's daily rollups from all of their doses, e.g. for the doses added before the rollups
+    existed
+
+    Args:
+        db (Repository): The database client
+
+    """
 
-        doses_ref = db.collection('users').document(str(uid)).collection('doses').where('timestamp', '>=', time_low).where(
-            'timestamp', '<=', time_high).where('guild', 'array_contains', guild).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream()
+    for uid, user_dict in db.stream_users():
+        doses = db.get_doses(uid, 0)
+        if len(doses) == 0:
+            continue
 
-        doses = {}
-        for dose in doses_ref:
-            doses[dose.id] = dose.to_dict()
+        user = User(db, uid, user_dict, read=False)
+        t_doses = [int(t) for t in doses.keys()]
 
-        return doses
+        # Two days after the last dose covers the time it takes to get sober
+        user.update_rollups(db, min(t_doses), max(t_doses) + 2*24*60*60)
@@ -1,5 +1,6 @@
 import datetime
 from .alko import DRINK_QUERY_PARAMS
+from .drinks import drink_registry
 
 
 def round_date_to_minutes(date, round_up=False):
@@ -24,22 +25,14 @@ def generate_drink_list(db):
     """A function that sends a list of doses one has enjoyed to user requesting them
 
     Args:
-        db (firestore.Client): The database client
+        db (Repository): The database client
 
     Returns:
         str: A string containing all the drinks formatted to a table
         list: A list containing all the drinks in the database
     """
 
-    drinks_ref = db.collection('basic_drinks').stream()
-    drink_string = ''
-    drink_list = []
-    for drink in drinks_ref:
-        drink_dict = drink.to_dict()
-        drink_string += f'{drink.id}\t\t{drink_dict["volume"]:.1f} cl \t\t{drink_dict["alcohol"]:.1f} %\n'
-        drink_list.append(drink.id)
-
-    return drink_string, drink_list
+    return drink_registry.menu_list(db)
 
 
 def parse_params(msg):
@@ -61,6 +54,23 @@ def parse_params(msg):
     return attributes
 
 
+def parse_command(msg):
+    """A function to parse space separated parameters from the message once, both as written and lower cased
+
+    Args:
+        msg (str): A string containing the message that triggered the event
+
+    Returns:
+        list: A list of lower cased parameters
+        list: A list of parameters as written
+    """
+
+    capital_params = parse_params(msg)
+    params = [param.lower() if param != None else None for param in capital_params]
+
+    return params, capital_params
+
+
 def parse_recommend(msg):
     """A function to parse space separated keyed parameters from message
 
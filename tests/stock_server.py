@@ -0,0 +1,66 @@
+import time
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+class StockServer():
+    """A local stand-in for the stock pages of alko.fi. The stock, the delay and the failures of each product can
+    be set, and the requests are recorded"""
+
+    def __init__(self):
+        """Initialize stock server
+        """
+
+        self.stock = {}
+        self.delays = {}
+        self.failing = set()
+        self.requests = []
+        self.starts = []
+        self.active = 0
+        self.max_active = 0
+        self.server = None
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/stock', self.handle)
+
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+        return self
+
+    async def __aexit__(self, *args):
+        await self.server.close()
+
+    @property
+    def url(self):
+        return str(self.server.make_url('/stock')) + '?SKU='
+
+    def requested(self):
+        return [numero for numero, _ in self.requests]
+
+    async def handle(self, request):
+        numero = request.query['SKU']
+        self.requests.append((numero, dict(request.headers)))
+        self.starts.append(time.monotonic())
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delays.get(numero, 0))
+        finally:
+            self.active -= 1
+
+        if numero in self.failing:
+            return web.Response(status=500)
+
+        stores = self.stock.get(numero, {})
+        etag = f'"{numero}-{abs(hash(tuple(sorted(stores.items()))))}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+
+        rows = ''.join([f'{store}\n{qty}\n' for store, qty in stores.items()])
+        page = f'<html><head><meta charset="utf-8"></head><body><div>Myymälä Määrä\n{rows}</div></body></html>'
+
+        return web.Response(text=page, content_type='text/html', headers={'ETag': etag})
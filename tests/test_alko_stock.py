@@ -0,0 +1,130 @@
+import time
+import asyncio
+import pytest
+
+from larvinen import alko
+
+from stock_server import StockServer
+
+
+@pytest.fixture(autouse=True)
+def fresh_stock(monkeypatch):
+    alko.stock_cache.clear()
+    monkeypatch.setattr(alko, 'http_session', None)
+    # Set to the local server by run
+    monkeypatch.setattr(alko, 'STOCK_URL', alko.STOCK_URL)
+
+
+def run(test):
+    async def with_server():
+        async with StockServer() as server:
+            alko.STOCK_URL = server.url
+            try:
+                await test(server)
+            finally:
+                await alko.close_stock_session()
+
+    asyncio.run(with_server())
+
+
+# The candidates of these tests are the product numbers themselves
+async def product(numero):
+    return {'numero': numero, 'nimi': f'Tuote {numero}'}
+
+
+def test_probes_at_most_the_concurrency_limit_at_once():
+    async def test(server):
+        for numero in range(100, 110):
+            server.delays[str(numero)] = 0.05
+
+        drink = await alko.first_in_stock([str(numero) for numero in range(100, 110)], product, 'helsinki kamppi')
+
+        assert drink == None
+        assert sorted(server.requested()) == [str(numero) for numero in range(100, 110)]
+        assert server.max_active == alko.STOCK_PROBE_CONCURRENCY
+
+    run(test)
+
+
+def test_gives_up_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(alko, 'STOCK_PROBE_DEADLINE_SECONDS', 0.2)
+
+    async def test(server):
+        server.stock['100'] = {'Helsinki Kamppi': '3'}
+        server.delays['100'] = 2
+
+        start = time.monotonic()
+        drink = await alko.first_in_stock(['100'], product, 'helsinki kamppi')
+
+        assert drink == None
+        assert time.monotonic() - start < 1
+
+    run(test)
+
+
+def test_first_answer_in_stock_wins():
+    async def test(server):
+        server.stock = {'100': {'Helsinki Kamppi': '3'}, '101': {'Espoo Iso Omena': '1'},
+                        '102': {'Helsinki Kamppi': '5', 'Espoo Iso Omena': '2'}}
+        server.delays = {'100': 0.5, '101': 0, '102': 0.05}
+
+        drink = await alko.first_in_stock(['100', '101', '102'], product, 'helsinki kamppi')
+
+        assert drink['numero'] == '102'
+        assert drink['saatavuus'] == {'Helsinki Kamppi': '5', 'Espoo Iso Omena': '2'}
+
+    run(test)
+
+
+def test_looks_up_only_the_probed_candidates():
+    async def test(server):
+        server.stock['100'] = {'Helsinki Kamppi': '3'}
+        for numero in range(101, 110):
+            server.delays[str(numero)] = 0.2
+
+        looked_up = []
+
+        async def lookup(numero):
+            looked_up.append(numero)
+            return await product(numero)
+
+        drink = await alko.first_in_stock([str(numero) for numero in range(100, 110)], lookup, 'helsinki kamppi')
+
+        assert drink['numero'] == '100'
+        # The slot the first answer frees may start one more probe before the rest are cancelled
+        assert len(looked_up) <= alko.STOCK_PROBE_CONCURRENCY + 1
+
+    run(test)
+
+
+def test_failed_lookup_is_cached_briefly(monkeypatch):
+    monkeypatch.setattr(alko, 'STOCK_FAILURE_TTL_SECONDS', 0.2)
+
+    async def test(server):
+        server.failing.add('100')
+
+        assert await alko.get_alko_stock('100') == {}
+        assert await alko.get_alko_stock('100') == {}
+        assert server.requested() == ['100']
+
+        await asyncio.sleep(0.3)
+        server.failing.clear()
+        server.stock['100'] = {'Helsinki Kamppi': '3'}
+
+        assert await alko.get_alko_stock('100') == {'Helsinki Kamppi': '3'}
+        assert server.requested() == ['100', '100']
+
+    run(test)
+
+
+def test_concurrent_lookups_share_one_request():
+    async def test(server):
+        server.stock['100'] = {'Helsinki Kamppi': '3'}
+        server.delays['100'] = 0.1
+
+        stocks = await asyncio.gather(*[alko.get_alko_stock('100') for _ in range(5)])
+
+        assert stocks == [{'Helsinki Kamppi': '3'}]*5
+        assert server.requested() == ['100']
+
+    run(test)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from larvinen import bac
+
+MASS = 80
+T_NOW = 1600000000
+
+
+# The doses end at the current moment, like in User.get_alcohol_grams
+def curves(t_doses, pure_alcohol, t_interp):
+    t_doses = np.append(np.asarray(t_doses, dtype=np.int64), T_NOW)
+    pure_alcohol = np.append(np.asarray(pure_alcohol, dtype=float), 0.0)
+
+    legacy = bac._legacy_per_mille_values(t_doses, pure_alcohol, MASS, t_interp)
+    t_points, g_points = bac.pad_start(*bac.breakpoints(t_doses, pure_alcohol, MASS), t_interp[0])
+
+    return legacy, bac.interpolate(t_points, g_points, t_interp)
+
+
+def minutes(hours):
+    return np.arange(-hours*60, 1)*60.0 + T_NOW
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_doses(seed):
+    rng = np.random.default_rng(seed)
+    t_doses = np.unique(rng.integers(T_NOW - 48*60*60, T_NOW, 50))
+    pure_alcohol = rng.uniform(1.0, 3.0, len(t_doses))
+
+    legacy, values = curves(t_doses, pure_alcohol, minutes(24))
+
+    assert np.allclose(legacy, values)
+
+
+def test_no_doses():
+    legacy, values = curves([], [], minutes(24))
+
+    assert np.allclose(legacy, values)
+    assert np.all(values == 0)
+
+
+def test_single_dose():
+    legacy, values = curves([T_NOW - 2*60*60], [2.0], minutes(6))
+
+    assert np.allclose(legacy, values)
+    assert np.max(values) == pytest.approx(2.0*bac.ALCOHOL_DENSITY)
+
+
+def test_doses_after_sober_time():
+    # Every dose is eliminated long before the next one
+    t_doses = T_NOW - np.array([30, 20, 10, 1])*60*60
+    legacy, values = curves(t_doses, [1.0, 2.0, 1.5, 1.0], minutes(36))
+
+    assert np.allclose(legacy, values)
+    assert np.sum(values == 0) > 0
+
+
+def test_identical_timestamps():
+    t_doses = T_NOW - np.array([3*60*60 + 30, 3*60*60 + 30, 3*60*60 + 30, 2*60*60 + 30, 2*60*60 + 30])
+    legacy, values = curves(t_doses, [1.0, 2.0, 1.5, 1.0, 3.0], minutes(6))
+
+    assert np.allclose(legacy, values)
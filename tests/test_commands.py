@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+
+from larvinen.commands import CommandRouter
+
+DRINKS = ['%olut', '%viini']
+
+
+def router(calls):
+    router = CommandRouter()
+
+    @router.command('%help')
+    async def send_help(message):
+        calls.append(('%help', message))
+
+    @router.command('%kuvaaja', 'user', 'params', 'capital_params')
+    async def send_plot(message, user, params, capital_params):
+        calls.append(('%kuvaaja', message, user, params, capital_params))
+
+    @router.command('%olut', 'params')
+    async def send_beer(message, params):
+        calls.append(('%olut', message, params))
+
+    @router.default('drink', lambda name: name in DRINKS, 'params', 'user')
+    async def add_drink(message, params, user):
+        calls.append(('drink', message, params, user))
+
+    return router
+
+
+def test_resolves_the_whole_first_word():
+    commands = router([])
+
+    assert commands.resolve('%help')[0] == commands.commands['%help']
+    assert commands.resolve('%HeLp kaikki')[0] == commands.commands['%help']
+    assert commands.resolve('%helpme')[0] == None
+    assert commands.resolve('%hel')[0] == None
+    assert commands.resolve('help')[0] == None
+
+
+def test_words_that_are_not_commands_go_to_the_fallback():
+    commands = router([])
+
+    assert commands.resolve('%viini 12 13')[0] == commands.fallback
+    assert commands.resolve('%VIINI')[0] == commands.fallback
+    assert commands.resolve('%siideri')[0] == None
+    # A command is preferred to the fallback matching the same word
+    assert commands.resolve('%olut')[0] == commands.commands['%olut']
+
+
+def test_parses_the_params_once():
+    command, params, capital_params = router([]).resolve('%kuvaaja 48 [Matti,Teppo]')
+
+    assert params == ['%kuvaaja', '48', '[matti,teppo]', None, None]
+    assert capital_params == ['%kuvaaja', '48', '[Matti,Teppo]', None, None]
+
+
+def test_rejects_duplicate_commands_and_unknown_arguments():
+    commands = router([])
+
+    with pytest.raises(ValueError):
+        commands.command('%help')(None)
+
+    with pytest.raises(ValueError):
+        commands.command('%uusi', 'guild')(None)
+
+
+def test_dispatch_passes_the_declared_arguments():
+    calls = []
+    users = []
+
+    async def get_user():
+        users.append('user')
+        return 'user'
+
+    async def dispatch():
+        commands = router(calls)
+
+        assert await commands.dispatch('message', '%help', get_user) == True
+        assert users == []
+
+        assert await commands.dispatch('message', '%Kuvaaja 48 [Matti]', get_user) == True
+        assert await commands.dispatch('message', '%viini 12', get_user) == True
+        assert await commands.dispatch('message', 'Hei kaikki', get_user) == False
+
+    asyncio.run(dispatch())
+
+    assert calls == [('%help', 'message'),
+                     ('%kuvaaja', 'message', 'user', ['%kuvaaja', '48', '[matti]', None, None],
+                      ['%Kuvaaja', '48', '[Matti]', None, None]),
+                     ('drink', 'message', ['%viini', '12', None, None, None], 'user')]
+    assert users == ['user', 'user']
@@ -0,0 +1,171 @@
+import json
+import asyncio
+import sqlite3
+import pytest
+
+from larvinen import alko
+from larvinen.crawler import StockCrawler
+
+from stock_server import StockServer
+
+
+PRODUCTS = [(1, '100', 'Punaviini', 'punaviinit', 'vakiovalikoima'),
+            (2, '101', 'Valkoviini', 'valkoviinit', 'vakiovalikoima'),
+            (3, '102', 'Olut', 'oluet', 'vakiovalikoima'),
+            (4, '103', 'Tilausviini', 'punaviinit', 'tilausvalikoima')]
+
+
+@pytest.fixture
+def db_name(tmp_path, monkeypatch):
+    db_name = str(tmp_path / 'alko.db')
+    connection = sqlite3.connect(db_name)
+    connection.execute('CREATE TABLE juomat (id integer PRIMARY KEY, numero text, nimi text, tyyppi text, alatyyppi text, '
+                       'luonnehdinta text, hinta real, alkoholi real, pullokoko real, valikoima text)')
+    connection.executemany('INSERT INTO juomat VALUES (?, ?, ?, ?, NULL, NULL, 10.0, 12.0, 0.75, ?)', PRODUCTS)
+    connection.commit()
+    connection.close()
+
+    stores = tmp_path / 'stores.json'
+    stores.write_text(json.dumps({'stores': ['Helsinki Kamppi', 'Espoo Iso Omena']}))
+
+    monkeypatch.setattr(alko, 'DB_NAME', db_name)
+    monkeypatch.setattr(alko, 'STORE_JSON_PATH', str(stores))
+    monkeypatch.setattr(alko, 'http_session', None)
+    # Set to the local server by run
+    monkeypatch.setattr(alko, 'STOCK_URL', alko.STOCK_URL)
+    alko.stock_cache.clear()
+
+    return db_name
+
+
+def run(test):
+    async def with_server():
+        async with StockServer() as server:
+            server.stock = {'100': {'Helsinki Kamppi': '3', 'Espoo Iso Omena': '0'},
+                            '101': {'Espoo Iso Omena': '2'},
+                            '102': {'Helsinki Kamppi': 'yli 20', 'Tampere Keskusta': '1'},
+                            '103': {'Helsinki Kamppi': '1'}}
+            alko.STOCK_URL = server.url
+            try:
+                await test(server)
+            finally:
+                await alko.close_stock_session()
+
+    asyncio.run(with_server())
+
+
+def stock(db_name):
+    connection = sqlite3.connect(db_name)
+    rows = connection.execute(
+        'SELECT numero, store, store_key, qty FROM stock ORDER BY numero, store').fetchall()
+    connection.close()
+
+    return rows
+
+
+def test_crawls_the_standard_selection(db_name):
+    async def test(server):
+        crawler = StockCrawler(db_name, server.url, interval=0)
+
+        assert await crawler.crawl() == {'fetched': 3}
+        assert sorted(server.requested()) == ['100', '101', '102']
+        assert crawler.stale_products() == []
+
+    run(test)
+
+    assert stock(db_name) == [('100', 'Espoo Iso Omena', 'espoo iso omena', 0),
+                              ('100', 'Helsinki Kamppi', 'helsinki kamppi', 3),
+                              ('101', 'Espoo Iso Omena', 'espoo iso omena', 2),
+                              ('102', 'Helsinki Kamppi', 'helsinki kamppi', 20),
+                              ('102', 'Tampere Keskusta', 'tampere keskusta', 1)]
+
+
+def test_unchanged_pages_are_not_downloaded_again(db_name):
+    async def test(server):
+        crawler = StockCrawler(db_name, server.url, interval=0)
+        await crawler.crawl()
+
+        crawler.max_age = -1
+        server.requests.clear()
+
+        assert await crawler.crawl() == {'unchanged': 3}
+        assert all([headers.get('If-None-Match') != None for _, headers in server.requests])
+
+    run(test)
+
+    assert len(stock(db_name)) == 5
+
+
+def test_failed_products_are_crawled_again_first(db_name):
+    async def test(server):
+        server.failing.add('101')
+        crawler = StockCrawler(db_name, server.url, interval=0)
+
+        assert await crawler.crawl() == {'fetched': 2, 'failed': 1}
+
+        server.failing.clear()
+        server.requests.clear()
+
+        assert await crawler.crawl() == {'fetched': 1}
+        assert server.requested() == ['101']
+
+    run(test)
+
+
+def test_starts_fetches_at_the_interval(db_name):
+    async def test(server):
+        crawler = StockCrawler(db_name, server.url, concurrency=3, interval=0.1)
+        await crawler.crawl()
+
+        gaps = [later - earlier for earlier, later in zip(server.starts, server.starts[1:])]
+        assert len(gaps) == 2
+        assert min(gaps) > 0.09
+
+    run(test)
+
+
+def test_store_filter_uses_the_store_key_index(db_name):
+    async def test(server):
+        await StockCrawler(db_name, server.url, interval=0).crawl()
+
+    run(test)
+
+    drinks = alko.Alko()
+
+    assert list(drinks.in_stock_ids('Helsinki Kamppi')) == [1, 3]
+    assert list(drinks.in_stock_ids('Espoo Iso Omena')) == [2]
+
+    plan = drinks.connection.execute('EXPLAIN QUERY PLAN SELECT DISTINCT juomat.id FROM stock JOIN juomat ON juomat.numero = stock.numero '
+                                     'WHERE stock.store_key = ? AND stock.qty > 0 ORDER BY juomat.id', ('helsinki kamppi',)).fetchall()
+    assert any(['stock_store_key' in row[-1] for row in plan])
+
+
+def test_random_drink_confirms_a_pick_from_the_snapshot(db_name):
+    async def test(server):
+        await StockCrawler(db_name, server.url, interval=0).crawl()
+        server.requests.clear()
+
+        drink = await alko.Alko().random_drink({'myymälä': 'kamp', 'tyyppi': 'punaviinit'})
+
+        assert drink['numero'] == '100'
+        assert server.requested() == ['100']
+
+    run(test)
+
+
+def test_random_drink_without_a_store_reads_one_product(db_name):
+    drinks = alko.Alko()
+    looked_up = []
+    drink = drinks.drink
+
+    def counted(row_id):
+        looked_up.append(row_id)
+        return drink(row_id)
+
+    drinks.drink = counted
+
+    async def test(server):
+        assert (await drinks.random_drink({'tyyppi': 'viinit'}))['numero'] in ['100', '101']
+        assert len(looked_up) == 1
+
+    run(test)
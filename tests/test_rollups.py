@@ -0,0 +1,77 @@
+import datetime
+import numpy as np
+import pytest
+
+from larvinen import rollups
+from larvinen import user as users
+from larvinen.repository import SQLiteRepository
+from larvinen.user import rebuild_rollups
+
+
+def local(*args):
+    return datetime.datetime(*args, tzinfo=rollups.ROLLUP_TIMEZONE).timestamp()
+
+
+def test_days_change_at_local_midnight():
+    assert rollups.day_of(local(2021, 3, 30, 23, 59)) == '2021-03-30'
+    assert rollups.day_of(local(2021, 3, 31, 0, 0)) == '2021-03-31'
+    assert rollups.days_between(local(2021, 3, 30, 12), local(2021, 4, 2)) == [
+        '2021-03-30', '2021-03-31', '2021-04-01', '2021-04-02']
+
+
+def test_day_lengths_over_daylight_saving_time():
+    for day, hours in [('2021-03-28', 23), ('2021-03-29', 24), ('2021-10-31', 25)]:
+        t_start, t_end = rollups.day_bounds(day)
+
+        assert t_end - t_start == hours*60*60
+        assert rollups.day_of(t_start) == day
+        assert rollups.day_of(t_end - 1) == day
+
+
+def test_compute_splits_the_curve_at_midnight():
+    # 2021-10-31 is 25 hours long, the curve is 1.0 from 23:00 to 01:00 over its midnight
+    t_doses = np.array([local(2021, 10, 30, 22), local(2021, 10, 31, 0, 30)])
+    t_points = np.array([local(2021, 10, 30, 22), local(2021, 10, 30, 23), local(2021, 10, 31, 1), local(2021, 10, 31, 2)])
+    per_mille_points = np.array([0.0, 1.0, 1.0, 0.0])
+
+    days = rollups.compute(t_doses, [2.0, 3.0], t_points, per_mille_points, ['2021-10-30', '2021-10-31', '2021-11-01'])
+
+    assert days['2021-10-30'] == {'pure_alcohol': 2.0, 'doses': 1, 'peak_per_mille': 1.0,
+                                  'seconds_over': pytest.approx(60*60 + 30*60)}
+    assert days['2021-10-31'] == {'pure_alcohol': 3.0, 'doses': 1, 'peak_per_mille': 1.0,
+                                  'seconds_over': pytest.approx(60*60 + 30*60)}
+    assert days['2021-11-01'] == rollups.ROLLUP_NULL
+
+
+def test_summarize_sums_days_to_periods():
+    days = {'2021-03-28': {'pure_alcohol': 2.0, 'doses': 1, 'peak_per_mille': 0.4, 'seconds_over': 0.0},
+            '2021-03-29': {'pure_alcohol': 5.0, 'doses': 3, 'peak_per_mille': 1.1, 'seconds_over': 7200.0},
+            '2021-04-01': {'pure_alcohol': 1.0, 'doses': 1, 'peak_per_mille': 0.2, 'seconds_over': 0.0}}
+
+    assert rollups.summarize(days, 'viikot') == {
+        '2021-W12': {'pure_alcohol': 2.0, 'doses': 1, 'peak_per_mille': 0.4, 'seconds_over': 0.0},
+        '2021-W13': {'pure_alcohol': 6.0, 'doses': 4, 'peak_per_mille': 1.1, 'seconds_over': 7200.0}}
+    assert list(rollups.summarize(days, 'kuukaudet').keys()) == ['2021-03', '2021-04']
+    assert rollups.summarize(days, 'vuodet')['2021']['doses'] == 5
+
+
+def test_rebuild_rollups_from_the_doses():
+    users.dose_cache.clear()
+    db = SQLiteRepository(':memory:')
+    db.set_user('1', {'name': 'Testaaja', 'mass': 80, 'sex': 'm'})
+
+    # One dose just before the clocks are turned forward at 3 on 2021-03-28, one the evening after
+    for t, pure_alcohol in [(local(2021, 3, 28, 2, 50), 2.0), (local(2021, 3, 28, 23, 45), 4.0)]:
+        db.set_dose('1', str(int(t)), {'pure_alcohol': pure_alcohol, 'timestamp': int(t), 'guild': ['private'],
+                                       'user': '1', 'drink': '%juoma', 'volume': 50.0, 'alcohol': 4.0})
+
+    rebuild_rollups(db)
+    days = db.get_rollups('1', '2021-03-27', '2021-03-31')
+
+    assert [day for day, rollup in days.items() if rollup['doses'] > 0] == ['2021-03-28']
+    assert days['2021-03-28']['doses'] == 2
+    assert days['2021-03-28']['pure_alcohol'] == pytest.approx(6.0)
+    # 4 cl is about 0.5 per mille for 80 kg, and it is eliminated after midnight
+    assert days['2021-03-29']['peak_per_mille'] > 0
+    assert days['2021-03-29']['doses'] == 0
+    assert '2021-03-27' not in days
@@ -0,0 +1,33 @@
+from larvinen.stores import StoreIndex, fold
+
+
+STORES = ['Helsinki Kamppi', 'Helsinki Itäkeskus', 'Helsinki Itä-Pasila', 'Espoo Tapiola', 'Tampere Keskusta']
+
+
+def test_fold():
+    assert fold('Itä-Pasila') == 'ita pasila'
+    assert fold('  HELSINKI   Kamppi ') == 'helsinki kamppi'
+
+
+def test_resolves_the_same_prefix_again():
+    index = StoreIndex(STORES)
+
+    for _ in range(2):
+        assert index.resolve('kamp') == ('Helsinki Kamppi', [])
+        assert index.resolve('tapi') == ('Espoo Tapiola', [])
+        assert index.resolve('hels kamppi') == ('Helsinki Kamppi', [])
+
+
+def test_resolves_names_and_misspellings():
+    index = StoreIndex(STORES)
+
+    assert index.resolve('helsinki itäkeskus') == ('Helsinki Itäkeskus', [])
+    assert index.resolve('ita pasila') == ('Helsinki Itä-Pasila', [])
+    assert index.resolve('tampere keskutsa') == ('Tampere Keskusta', [])
+
+
+def test_suggests_stores_for_an_ambiguous_name():
+    index = StoreIndex(STORES)
+
+    assert index.resolve('helsinki ita') == (None, ['Helsinki Itä-Pasila', 'Helsinki Itäkeskus'])
+    assert index.resolve('') == (None, [])
@@ -0,0 +1,130 @@
+import datetime
+import pytest
+from types import SimpleNamespace
+
+from larvinen import rollups
+from larvinen import user as users
+from larvinen.repository import SQLiteRepository
+from larvinen.user import User, HIGH_SCORE_NULL, high_score_period
+
+
+def timestamp(*args):
+    return datetime.datetime(*args).timestamp()
+
+
+def score(per_mille, *args):
+    return {'per_mille': per_mille, 'timestamp': timestamp(*args), 'period': None}
+
+
+def test_period_of_each_timeframe():
+    t = timestamp(2021, 3, 30, 22)
+
+    assert high_score_period('ath', t) == 'ath'
+    assert high_score_period('ytd', t) == '2021'
+    assert high_score_period('this_month', t) == '2021-03'
+    assert high_score_period('this_week', t) == '2021-W13'
+
+
+def test_scores_of_past_periods_read_as_empty():
+    user = User(None, 1, {'high_score': {'ath': score(2.1, 2020, 6, 1), 'ytd': score(1.5, 2021, 1, 10),
+                                         'this_month': score(1.2, 2021, 2, 27), 'this_week': score(1.0, 2021, 3, 22)}}, read=False)
+
+    current = user.current_high_score(timestamp(2021, 3, 30, 22))
+
+    assert current['ath']['per_mille'] == 2.1
+    assert current['ytd'] == dict(score(1.5, 2021, 1, 10), period='2021')
+    assert current['this_month'] == HIGH_SCORE_NULL
+    assert current['this_week'] == HIGH_SCORE_NULL
+
+
+def test_week_continues_over_the_new_year():
+    # 2021-01-01 is a Friday of the last ISO week of 2020
+    user = User(None, 1, {'high_score': {'ytd': score(1.5, 2020, 12, 29), 'this_month': score(1.5, 2020, 12, 29),
+                                         'this_week': score(1.5, 2020, 12, 29)}}, read=False)
+
+    current = user.current_high_score(timestamp(2021, 1, 2, 12))
+
+    assert current['this_week']['period'] == '2020-W53'
+    assert current['ytd'] == HIGH_SCORE_NULL
+    assert current['this_month'] == HIGH_SCORE_NULL
+    assert current['ath'] == HIGH_SCORE_NULL
+
+
+def test_new_period_replaces_a_higher_past_score():
+    db = SQLiteRepository(':memory:')
+    db.set_user('1', {'high_score': {'ath': score(2.0, 2021, 3, 1), 'ytd': score(2.0, 2021, 3, 1),
+                                     'this_month': score(2.0, 2021, 3, 1), 'this_week': score(2.0, 2021, 3, 1)}})
+    user = User(db, 1)
+
+    user.update_high_score(db, 0.5, timestamp(2021, 4, 1, 20))
+
+    high_score = db.get_user('1')['high_score']
+    assert high_score['ath']['per_mille'] == 2.0
+    assert high_score['ytd']['per_mille'] == 2.0
+    assert high_score['this_month'] == {'per_mille': 0.5, 'timestamp': timestamp(2021, 4, 1, 20), 'period': '2021-04'}
+    assert high_score['this_week']['period'] == '2021-W13'
+
+
+@pytest.fixture
+def db():
+    users.dose_cache.clear()
+    users.user_registry.clear()
+
+    return SQLiteRepository(':memory:')
+
+
+def drink(db, user, minutes_ago, volume='33', alcohol='4.7'):
+    created_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=minutes_ago)
+    message = SimpleNamespace(author=SimpleNamespace(id=1, name='Testaaja'), created_at=created_at, guild=None)
+
+    return user.add_dose(db, message, ['%juoma', volume, alcohol, None])
+
+
+def rebuilt_per_mille(db):
+    user = User(db, 1)
+    user.bac_checkpoint = None
+
+    return user.per_mille(db)
+
+
+def total_doses(db):
+    now = datetime.datetime.now().timestamp()
+    days = db.get_rollups(1, rollups.day_of(now - 24*60*60), rollups.day_of(now))
+
+    return sum([rollup['doses'] for rollup in days.values()]), sum([rollup['pure_alcohol'] for rollup in days.values()])
+
+
+def test_checkpoint_matches_a_rebuild_after_adding_a_dose(db):
+    user = User(db, 1)
+
+    for minutes_ago, volume in [(90, '50'), (40, '33'), (5, '12')]:
+        drink(db, user, minutes_ago, volume)
+
+        assert user.per_mille(db) == pytest.approx(rebuilt_per_mille(db), abs=1e-3)
+
+
+def test_checkpoint_matches_a_rebuild_after_deleting_a_dose(db):
+    user = User(db, 1)
+    drink(db, user, 60, '50')
+    drink(db, user, 10, '33')
+
+    dose = user.get_previous_dose(db)
+    dose_id = list(dose.keys())[0]
+    user.delete_dose(db, dose_id, dose[dose_id]['timestamp'])
+
+    assert user.per_mille(db) == pytest.approx(rebuilt_per_mille(db), abs=1e-3)
+    assert user.per_mille(db)[0] > 0
+
+
+def test_deleting_a_dose_decrements_its_rollup(db):
+    user = User(db, 1)
+    drink(db, user, 30, '50', '5')
+    drink(db, user, 10, '33', '5')
+
+    assert total_doses(db) == (2, pytest.approx(4.15))
+
+    dose = user.get_previous_dose(db)
+    dose_id = list(dose.keys())[0]
+    user.delete_dose(db, dose_id, dose[dose_id]['timestamp'])
+
+    assert total_doses(db) == (1, pytest.approx(2.5))